@@ -0,0 +1,3 @@
+# Microbenchmarks for bot.py. Run from the repo root:
+#   python -m benchmarks --questions-per-chapter 500 --users 100000 --out bench.json
+#   python -m benchmarks.generate --users 100000 -o database.json
@@ -0,0 +1,99 @@
+import argparse
+import json
+import random
+import time
+
+# Deterministic synthetic database.json in the layout bot.py writes: same seed + params -> same bytes
+SUBJECTS = {
+    "Hindi-Gadya": 12, "Hindi-Padya": 12, "Hindi-Grammar": 10,
+    "English-Prose": 10, "English-Poetry": 8, "English-Grammar": 10,
+    "Maths": 14, "Biology": 16, "Chemistry": 14, "Physics": 14,
+}
+for _base in ["Hindi", "English", "Maths", "Biology", "Chemistry", "Physics"]:
+    SUBJECTS[f"{_base}-PYQ"] = 6
+    SUBJECTS[f"{_base}-YouTube"] = 4
+
+WORDS = ("what which energy force reaction cell acid value equation poem author chapter current "
+         "motion light carbon plant human triangle matrix grammar verb noun tense writer story").split()
+BASE_TIME = 1_700_000_000   # fixed clock so review due dates do not depend on when the file was made
+
+def sentence(rng, lo, hi):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi))).capitalize()
+
+def generate_db(questions_per_chapter=100, users=1000, mistakes_per_user=20, stats_subjects=4,
+                chapter_scale=1.0, owner_id=1, seed=42):
+    rng = random.Random(seed)
+    questions, qid = {"BSEB": {}}, 1
+    by_subject = {}
+    for sub, n_chaps in SUBJECTS.items():
+        chaps = {}
+        for c in range(max(1, int(n_chaps * chapter_scale))):
+            qs = []
+            for _ in range(questions_per_chapter):
+                qs.append({"id": qid, "question": sentence(rng, 8, 24) + "?",
+                           "options": [sentence(rng, 1, 4) for _ in range(4)], "correct": rng.randrange(4)})
+                qid += 1
+            chaps[f"Chapter {c + 1}: {sentence(rng, 1, 3)}"] = qs
+        questions["BSEB"][sub] = chaps
+        by_subject[sub] = (qid - len(chaps) * questions_per_chapter, qid)
+
+    subjects = list(SUBJECTS)
+    stats, user_data, reviews, all_users = {}, {}, {}, []
+    for i in range(users):
+        uid = 10_000_000 + i * 7
+        uid_str = str(uid)
+        all_users.append(uid)
+        stats[uid_str] = {"BSEB": {}}
+        for sub in rng.sample(subjects, min(stats_subjects, len(subjects))):
+            total = rng.randint(10, 500)
+            correct = rng.randint(0, total)
+            stats[uid_str]["BSEB"][sub] = {"total": total, "correct": correct, "wrong": total - correct}
+        ud = {"seen_intro": True}
+        if mistakes_per_user and questions_per_chapter:
+            mistakes = {}
+            for _ in range(mistakes_per_user):
+                sub = rng.choice(subjects)
+                lo, hi = by_subject[sub]
+                if hi <= lo: continue
+                q = rng.randrange(lo, hi)
+                mistakes.setdefault(sub, set()).add(q)
+                if rng.random() < 0.5:
+                    reviews.setdefault(uid_str, {})[str(q)] = [rng.randint(0, 3), BASE_TIME + rng.randint(-30, 30) * 86400]
+            ud["mistakes"] = {"BSEB": {sub: sorted(ids) for sub, ids in mistakes.items()}}
+        user_data[uid_str] = ud
+
+    return {
+        "questions": questions, "admins": [owner_id], "stats": stats, "user_data": user_data,
+        "all_users": all_users, "current_polls": {}, "quiz_sessions": {}, "qstats": {}, "reviews": reviews,
+        "maintenance_mode": False, "next_qid": qid, "broadcast": None,
+    }
+
+def write_db(path, data):
+    with open(path, "w", encoding="utf-8") as f: json.dump(data, f)
+
+def add_arguments(p):
+    p.add_argument("--questions-per-chapter", type=int, default=100)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--mistakes-per-user", type=int, default=20)
+    p.add_argument("--stats-subjects", type=int, default=4, help="subjects with stats per user")
+    p.add_argument("--chapter-scale", type=float, default=1.0, help="multiplier on chapters per subject")
+    p.add_argument("--seed", type=int, default=42)
+
+def params_from(args):
+    return {"questions_per_chapter": args.questions_per_chapter, "users": args.users,
+            "mistakes_per_user": args.mistakes_per_user, "stats_subjects": args.stats_subjects,
+            "chapter_scale": args.chapter_scale, "seed": args.seed}
+
+def main():
+    p = argparse.ArgumentParser(description="Generate a synthetic database.json")
+    add_arguments(p)
+    p.add_argument("-o", "--output", default="database.json")
+    args = p.parse_args()
+    t0 = time.perf_counter()
+    data = generate_db(**params_from(args))
+    write_db(args.output, data)
+    print(f"✅ {args.output}: {data['next_qid'] - 1} questions, {len(data['all_users'])} users "
+          f"in {time.perf_counter() - t0:.1f}s")
+
+if __name__ == "__main__":
+    main()
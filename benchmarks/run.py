@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.generate import add_arguments, generate_db, params_from, write_db
+from benchmarks.stubs import StubContext, callback_update, poll_answer_update
+
+# Each benchmark is a setup(bot, rng) -> op() pair. op() runs `iterations` times per round; rounds are
+# timed separately and summarized by median/min. Memory comes from one extra round under tracemalloc,
+# kept apart so tracing overhead never leaks into the timings.
+
+def git_commit():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception: return None
+
+def import_bot(workdir, json_path):
+    # bot.py reads its paths at import and loads (migrates) the database right away
+    os.environ["DB_FILE"] = json_path
+    os.environ["SQLITE_FILE"] = os.path.join(workdir, "bench.sqlite3")
+    os.environ["BACKUP_DIR"] = os.path.join(workdir, "backups")
+    os.environ.setdefault("OWNER_ID", "1")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    t0 = time.perf_counter()
+    import bot
+    return bot, time.perf_counter() - t0
+
+def run_async(coro_fn):
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(coro_fn())
+
+# --- benchmarks ---
+
+def bench_load_db(bot, rng):
+    return bot.load_db
+
+def bench_save_db_full(bot, rng):
+    return lambda: bot.save_db(bot.snapshot_db(bot.db))
+
+def bench_save_db_delta(bot, rng):
+    # A typical flush: 100 users' stats plus their user rows
+    uids = rng.sample(list(bot.db["stats"]), min(100, len(bot.db["stats"])))
+    changes = [("stats", u) for u in uids] + [("user", u) for u in uids]
+    return lambda: bot.save_db(bot.snapshot_changes(bot.db, changes), *changes)
+
+def bench_save_db_json(bot, rng):
+    # Legacy JSON backend: full dump + atomic replace
+    def op():
+        backend = bot.DB_BACKEND
+        bot.DB_BACKEND = 'json'
+        try: bot.save_db(bot.snapshot_db(bot.db))
+        finally: bot.DB_BACKEND = backend
+    return op
+
+def bench_get_random_questions(bot, rng):
+    picks = []
+    for _ in range(64):
+        cat, sub = rng.choice(list(bot.QINDEX.subjects))
+        chaps = list(bot.db["questions"][cat][sub])
+        picks.append((cat, sub, rng.sample(chaps, min(3, len(chaps)))))
+    it = iter(picks * 10**6)
+    def op():
+        cat, sub, chaps = next(it)
+        bot.get_random_questions(cat, sub, chaps, 10)
+    return op
+
+def bench_mistake_questions(bot, rng):
+    # get_mistake_questions is now SRS.due: due reviews across a subject's mistake sections
+    users = [u for u, ud in bot.db["user_data"].items() if ud.get("mistakes")]
+    picks = [(int(u), sub.split('-')[0]) for u in rng.sample(users, min(256, len(users)))
+             for sub in list(bot.db["user_data"][u]["mistakes"].get("BSEB", {}))[:1]]
+    it = iter(picks * 10**6)
+    def op():
+        uid, subject = next(it)
+        bot.SRS.due(uid, "BSEB", subject, 10)
+    return op
+
+def bench_mistake_heap_build(bot, rng):
+    # First use per user builds the review heaps
+    users = [int(u) for u, ud in bot.db["user_data"].items() if ud.get("mistakes")]
+    it = iter(rng.sample(users, len(users)) * 100)
+    def op():
+        bot.SRS.reset()
+        bot.SRS.due(next(it), "BSEB", "Physics", 10)
+    return op
+
+def bench_handle_poll_answer(bot, rng):
+    users = [int(u) for u in rng.sample(list(bot.db["stats"]), min(1000, len(bot.db["stats"])))]
+    qids = list(bot.QINDEX.bank)
+    state = {"n": 0}
+    async def op():
+        n = state["n"] = state["n"] + 1
+        q = bot.QINDEX.bank[rng.choice(qids)]
+        cat, sub, _ = bot.QINDEX.loc[q.id]
+        uid = users[n % len(users)]
+        poll_id = f"bench{n}"
+        bot.POLLS.add(poll_id, cat, sub, uid, 'normal', q, 30)
+        await bot.handle_poll_answer(poll_answer_update(poll_id, uid, rng.randrange(4)), None)
+    return run_async(op)
+
+def bench_show_chapter_selection(bot, rng):
+    cat, sub = max(bot.QINDEX.subjects, key=lambda k: len(bot.db["questions"][k[0]][k[1]]))
+    ctx = StubContext()
+    ctx.user_data.update(quiz_cat=cat, quiz_sub=sub, selected_chapters=list(bot.db["questions"][cat][sub])[:2])
+    query = callback_update(1).callback_query
+    state = {"page": 0}
+    async def op():
+        state["page"] = (state["page"] + 1) % 3
+        await bot.show_chapter_selection(query, ctx, True, state["page"])
+    return run_async(op)
+
+BENCHMARKS = {
+    "load_db": (bench_load_db, 1),
+    "save_db_full": (bench_save_db_full, 1),
+    "save_db_delta": (bench_save_db_delta, 10),
+    "save_db_json": (bench_save_db_json, 1),
+    "get_random_questions": (bench_get_random_questions, 1000),
+    "mistake_questions_due": (bench_mistake_questions, 1000),
+    "mistake_heap_build": (bench_mistake_heap_build, 200),
+    "handle_poll_answer": (bench_handle_poll_answer, 1000),
+    "show_chapter_selection": (bench_show_chapter_selection, 500),
+}
+
+def measure(op, iterations, rounds):
+    times = []
+    for _ in range(rounds):
+        gc.collect()
+        t0 = time.perf_counter()
+        for _ in range(iterations): op()
+        times.append((time.perf_counter() - t0) / iterations * 1e6)
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for _ in range(iterations): op()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"iterations": iterations, "rounds": rounds, "median_us": statistics.median(times), "min_us": min(times),
+            "mean_us": statistics.fmean(times), "stdev_us": statistics.stdev(times) if len(times) > 1 else 0.0,
+            "peak_kib": (peak - base) / 1024, "retained_kib": (current - base) / 1024}
+
+def compare(base_path, results):
+    with open(base_path, encoding="utf-8") as f: base = json.load(f)["results"]
+    print(f"\n{'benchmark':<26}{'base us':>12}{'now us':>12}{'change':>10}")
+    for name, r in results.items():
+        if name not in base: continue
+        old, new = base[name]["median_us"], r["median_us"]
+        print(f"{name:<26}{old:>12.1f}{new:>12.1f}{(new / old - 1) * 100 if old else 0:>9.1f}%")
+
+def main():
+    p = argparse.ArgumentParser(description="Run bot.py microbenchmarks")
+    add_arguments(p)
+    p.add_argument("--rounds", type=int, default=5)
+    p.add_argument("--scale", type=float, default=1.0, help="multiplier on per-benchmark iterations")
+    p.add_argument("--only", nargs="*", choices=list(BENCHMARKS))
+    p.add_argument("--out", default="bench.json")
+    p.add_argument("--compare", metavar="BASE_JSON", help="print median changes against an earlier run")
+    args = p.parse_args()
+
+    params = params_from(args)
+    with tempfile.TemporaryDirectory(prefix="quizbench-") as workdir:
+        json_path = os.path.join(workdir, "database.json")
+        t0 = time.perf_counter()
+        write_db(json_path, generate_db(**params))
+        gen_s = time.perf_counter() - t0
+        bot, import_s = import_bot(workdir, json_path)
+        print(f"Generated {bot.db['next_qid'] - 1} questions / {len(bot.db['stats'])} users in {gen_s:.1f}s; "
+              f"import + migrate {import_s:.1f}s")
+
+        results = {}
+        for name in args.only or BENCHMARKS:
+            setup, iterations = BENCHMARKS[name]
+            rng = random.Random(params["seed"])
+            op = setup(bot, rng)
+            results[name] = r = measure(op, max(1, int(iterations * args.scale)), args.rounds)
+            print(f"{name:<26} median {r['median_us']:>12.1f}us  min {r['min_us']:>12.1f}us  peak {r['peak_kib']:>10.1f}KiB")
+
+    report = {"meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                       "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "params": params, "rounds": args.rounds,
+                       "import_migrate_s": import_s},
+              "results": results}
+    with open(args.out, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+    print(f"✅ Results -> {args.out}")
+    if args.compare: compare(args.compare, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+# Just enough of the PTB surface for handlers to run without a network; calls are counted, not sent
+
+class StubBot:
+    def __init__(self):
+        self.calls = 0
+        self._n = 0
+
+    async def _record(self, *args, **kwargs):
+        self.calls += 1
+        self._n += 1
+        return SimpleNamespace(message_id=self._n, poll=SimpleNamespace(id=f"bench{self._n}"))
+
+    send_message = send_poll = stop_poll = edit_message_text = send_document = _record
+
+class StubQuery:
+    def __init__(self, user_id, data=""):
+        self.from_user = SimpleNamespace(id=user_id, username=None, first_name="Bench")
+        self.data = data
+        self.message = SimpleNamespace(chat_id=user_id, message_id=1)
+        self.edits = 0
+
+    async def answer(self, *args, **kwargs): pass
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        self.edits += 1
+
+class StubContext:
+    def __init__(self, bot=None):
+        self.bot = bot or StubBot()
+        self.user_data = {}
+        self.args = []
+
+def poll_answer_update(poll_id, user_id, option):
+    return SimpleNamespace(poll_answer=SimpleNamespace(poll_id=poll_id, user=SimpleNamespace(id=user_id), option_ids=[option]),
+                           effective_user=SimpleNamespace(id=user_id))
+
+def callback_update(user_id, data=""):
+    query = StubQuery(user_id, data)
+    return SimpleNamespace(callback_query=query, effective_user=query.from_user, effective_chat=SimpleNamespace(id=user_id, type="private"))
@@ -3,14 +3,33 @@ import asyncio
 import random
 import json
 import os
+import copy
+import time
+import heapq
+import bisect
+import tempfile
+import gzip
+import hashlib
+import sys
+import sqlite3
+import zlib
+import threading
+import traceback
+import signal
+import multiprocessing
+from contextlib import contextmanager
 from threading import Thread
-from flask import Flask
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import BadRequest
+from array import array
+from collections import OrderedDict
+from queue import Empty
+from functools import lru_cache
+from flask import Flask, Response, request
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters, 
-    ContextTypes, CallbackQueryHandler, PollAnswerHandler
+    ContextTypes, CallbackQueryHandler, PollAnswerHandler, TypeHandler, BaseUpdateProcessor
 )
 
 # ==========================================
@@ -30,12 +49,293 @@ def keep_alive():
     t = Thread(target=run)
     t.start()
 
+# Webhook mode (WEBHOOK_URL set): Telegram posts updates to this same port and they are
+# handed to the application's event loop
+WEBHOOK = {"app": None, "loop": None}
+
+@web_app.route('/webhook', methods=['POST'])
+def telegram_webhook():
+    app, loop = WEBHOOK["app"], WEBHOOK["loop"]
+    if app is None and not FRONT["inboxes"]: return "Not ready", 503
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET: return "Forbidden", 403
+    try:
+        data = request.get_json(force=True)
+        # Worker mode: the front only routes the raw update; the worker parses it
+        if FRONT["inboxes"]:
+            dispatch_update(data)
+            return "OK"
+        update = Update.de_json(data, app.bot)
+    except Exception as e:
+        logging.error(f"Webhook Parse Error: {e}")
+        return "Bad Request", 400
+    loop.call_soon_threadsafe(app.update_queue.put_nowait, update)
+    return "OK"
+
+async def register_webhook(bot):
+    # The webhook is left registered on shutdown so Telegram queues updates across restarts
+    await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}/webhook", secret_token=WEBHOOK_SECRET,
+                          allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS)
+
+def serve_application(app, attach):
+    # Runs the application without PTB's Updater; attach(loop, stop) hooks up the update source
+    async def serve():
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+        await app.initialize()
+        if app.post_init: await app.post_init(app)
+        await app.start()
+        await attach(loop, stop)
+        try: await stop.wait()
+        finally:
+            WEBHOOK["app"] = None
+            await app.stop()
+            await app.shutdown()
+            if app.post_shutdown: await app.post_shutdown(app)
+    asyncio.run(serve())
+
+def run_webhook(app):
+    async def attach(loop, stop):
+        await register_webhook(app.bot)
+        WEBHOOK["app"], WEBHOOK["loop"] = app, loop
+    serve_application(app, attach)
+
+# ==========================================
+# 1.1 METRICS (PROMETHEUS TEXT FORMAT)
+# ==========================================
+# Every metric has one writer (the event loop, or the save_db worker thread), so updates are
+# plain dict/list operations with no locks; the scrape thread only reads copies.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = []
+
+class Counter:
+    kind = "counter"
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}   # label values tuple -> count
+        METRICS.append(self)
+
+    def inc(self, key=(), n=1):
+        v = self.values
+        v[key] = v.get(key, 0) + n
+
+    def samples(self):
+        for key, val in self.values.copy().items(): yield "", key, val
+
+class Histogram:
+    kind = "histogram"
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}   # label values tuple -> [count per bucket..., overflow, sum]
+        METRICS.append(self)
+
+    def observe(self, value, key=()):
+        row = self.values.get(key)
+        if row is None: row = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self):
+        for key, row in self.values.copy().items():
+            row, total = list(row), 0
+            for le, n in zip(self.buckets + ("+Inf",), row):
+                total += n
+                yield "_bucket", key + (le,), total
+            yield "_sum", key, row[-1]
+            yield "_count", key, total
+
+class Gauge:
+    # Read at scrape time; fn returns {label values tuple: value}. kind='counter' for totals kept elsewhere.
+    def __init__(self, name, help, labels, fn, kind="gauge"):
+        self.name, self.help, self.labels, self.fn, self.kind = name, help, labels, fn, kind
+        METRICS.append(self)
+
+    def samples(self):
+        for key, val in self.fn().items(): yield "", key, val
+
+def format_labels(names, values):
+    if not values: return ""
+    esc_v = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(f'{n}="{esc_v(v)}"' for n, v in zip(names, values)) + "}"
+
+def render_metrics():
+    out = []
+    for m in METRICS:
+        names = m.labels + ("le",) if m.kind == "histogram" else m.labels
+        try: lines = [f"{m.name}{suffix}{format_labels(names if suffix == '_bucket' else m.labels, key)} {val}"
+                      for suffix, key, val in m.samples()]
+        except Exception as e:
+            logging.error(f"Metric {m.name} Error: {e}"); continue
+        out.append(f"# HELP {m.name} {m.help}\n# TYPE {m.name} {m.kind}")
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+@web_app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+UPDATES = Counter("quizbot_updates_total", "Incoming updates by type", ("type",))
+HANDLER_SECONDS = Histogram("quizbot_handler_seconds", "Handler latency", ("handler",))
+HANDLER_ERRORS = Counter("quizbot_handler_errors_total", "Handler exceptions", ("handler",))
+ROUTE_SECONDS = Histogram("quizbot_callback_route_seconds", "Callback route latency", ("route",))
+API_SECONDS = Histogram("quizbot_api_seconds", "Bot API call latency", ("method",))
+API_ERRORS = Counter("quizbot_api_errors_total", "Bot API call errors", ("method", "error"))
+API_RETRY_AFTER = Counter("quizbot_api_retry_after_total", "Bot API calls rejected with RetryAfter", ("method",))
+SAVE_SECONDS = Histogram("quizbot_save_db_seconds", "save_db duration", ("mode",))
+UPDATE_TYPES = ("message", "callback_query", "poll_answer", "edited_message", "my_chat_member", "chat_member", "poll")
+
+def db_file_size():
+    paths = (SQLITE_FILE, SQLITE_FILE + "-wal") if DB_BACKEND == 'sqlite' else (DB_FILE,)
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+def broadcast_progress():
+    job = db.get("broadcast")
+    if not job: return {}
+    return {("total",): job["total"], ("sent",): job["sent"], ("failed",): job["failed"], ("blocked",): len(job["blocked"])}
+
+def keyboard_cache_info():
+    infos = [f.cache_info() for f in (main_menu_keyboard, owner_panel_keyboard, admin_deep_keyboard, source_keyboard)]
+    return sum(i.hits for i in infos), sum(i.misses for i in infos)
+
+Gauge("quizbot_db_bytes", "Size of the database file(s) on disk", (), lambda: {(): db_file_size()})
+Gauge("quizbot_db_flushes_total", "Write-behind flushes", (), lambda: {(): PERSIST_STATS["flushes"]}, kind="counter")
+Gauge("quizbot_db_flush_errors_total", "Failed write-behind flushes", (), lambda: {(): PERSIST_STATS["errors"]}, kind="counter")
+Gauge("quizbot_db_dropped_changes_total", "Change tags dropped after repeated flush failures", (), lambda: {(): PERSIST_STATS["dropped"]}, kind="counter")
+Gauge("quizbot_db_pending_changes", "Change tags waiting for the next flush", (), lambda: {(): len(_dirty)})
+Gauge("quizbot_active_quizzes", "Running quizzes", ("kind",),
+      lambda: {("group",): sum(s.board is not None for s in list(QUIZ.sessions.values())),
+               ("private",): sum(s.board is None for s in list(QUIZ.sessions.values()))})
+Gauge("quizbot_inflight_polls", "Polls waiting for answers", (), lambda: {(): len(POLLS)})
+Gauge("quizbot_quiz_events_total", "Quiz scheduler events", ("event",),
+      lambda: {(k,): QUIZ.stats[k] for k in ("started", "completed", "aborted", "resumed", "sent", "timeouts")}, kind="counter")
+Gauge("quizbot_broadcast_messages", "Progress of the running broadcast", ("state",), broadcast_progress)
+Gauge("quizbot_cache_hits_total", "Cache hits", ("cache",),
+      lambda: {("membership",): MEMBERSHIP.hits, ("profiles",): PROFILES.hits, ("keyboards",): keyboard_cache_info()[0]}, kind="counter")
+Gauge("quizbot_cache_misses_total", "Cache misses", ("cache",),
+      lambda: {("membership",): MEMBERSHIP.misses, ("profiles",): PROFILES.misses, ("keyboards",): keyboard_cache_info()[1]}, kind="counter")
+
+def instrumented(name, fn):
+    # Wraps a PTB handler callback with a latency histogram and an error counter
+    async def handler(update, context):
+        t0 = time.perf_counter()
+        try: return await fn(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc((name,)); raise
+        finally: HANDLER_SECONDS.observe(time.perf_counter() - t0, (name,))
+    return handler
+
+class MetricsRequest(HTTPXRequest):
+    # Times every Bot API call by method; failures are counted by error class, RetryAfter on its own
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        t0 = time.perf_counter()
+        try: return await super().post(url, *args, **kwargs)
+        except RetryAfter:
+            API_RETRY_AFTER.inc((method,)); raise
+        except TelegramError as e:
+            API_ERRORS.inc((method, type(e).__name__)); raise
+        finally: API_SECONDS.observe(time.perf_counter() - t0, (method,))
+
+# ==========================================
+# 1.2 EVENT-LOOP STALL DETECTOR
+# ==========================================
+LOOP_HEARTBEAT = float(os.getenv('LOOP_HEARTBEAT', '0.25'))                 # seconds between heartbeats
+LOOP_STALL_MS = float(os.getenv('LOOP_STALL_MS', '250'))                   # lag that counts as a stall
+LOOP_LAG = Histogram("quizbot_loop_lag_seconds", "Event-loop scheduling delay of the heartbeat")
+LOOP_STALLS = Counter("quizbot_loop_stalls_total", "Event-loop stalls caught by the watchdog", ("handler",))
+HANDLER_QUALNAME = "instrumented.<locals>.handler"
+
+class LoopWatchdog:
+    # A heartbeat task stamps `beat` every LOOP_HEARTBEAT seconds. A daemon thread checks the stamp;
+    # when the loop is overdue by LOOP_STALL_MS it captures the main thread's stack once per stall,
+    # and the heartbeat books the stall's full length when the loop comes back.
+    def __init__(self):
+        self.beat = time.monotonic()
+        self.thread_id = None
+        self.running = False
+        self.pending = None    # (site, handler, update type) captured for the ongoing stall
+        self.sites = {}        # site -> [stalls, total_ms, max_ms, last handler]
+        self.stalls = 0
+        self.max_ms = 0.0
+
+    def start(self, application):
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.running = True
+        application.create_task(self._heartbeat())
+        Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    async def _heartbeat(self):
+        while self.running:
+            t0 = time.monotonic()
+            await asyncio.sleep(LOOP_HEARTBEAT)
+            now = time.monotonic()
+            lag = max(now - t0 - LOOP_HEARTBEAT, 0.0)
+            self.beat = now
+            LOOP_LAG.observe(lag)
+            if lag * 1000 > self.max_ms: self.max_ms = lag * 1000
+            stall, self.pending = self.pending, None
+            if stall: self._book(stall, lag * 1000)
+
+    def _book(self, stall, ms):
+        site, handler, kind = stall
+        self.stalls += 1
+        LOOP_STALLS.inc((handler,))
+        st = self.sites.get(site)
+        if st is None: st = self.sites[site] = [0, 0.0, 0.0, handler]
+        st[0] += 1; st[1] += ms; st[2] = max(st[2], ms); st[3] = handler
+        logging.warning(f"Event loop blocked {ms:.0f}ms at {site} ({handler}, {kind})")
+
+    def _watch(self):
+        while self.running:
+            time.sleep(LOOP_HEARTBEAT / 2)
+            overdue = (time.monotonic() - self.beat - LOOP_HEARTBEAT) * 1000
+            if overdue < LOOP_STALL_MS or self.pending: continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None: continue
+            self.pending = self.describe(frame)
+            logging.warning(f"Event loop stalled {overdue:.0f}ms, main thread stack:\n" + "".join(traceback.format_stack(frame)))
+
+    @staticmethod
+    def describe(frame):
+        # Site: innermost frame in this file. Handler: the instrumented() wrapper on the stack,
+        # else the outermost function of this file (a job or background task).
+        site = handler = kind = None
+        outer = None
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename == __file__:
+                if site is None: site = f"{code.co_name}:{frame.f_lineno}"
+                outer = code.co_name
+                if handler is None and code.co_qualname == HANDLER_QUALNAME:
+                    handler = frame.f_locals.get("name")
+                    update = frame.f_locals.get("update")
+                    kind = next((k for k in UPDATE_TYPES if getattr(update, k, None) is not None), None)
+            frame = frame.f_back
+        return site or "outside bot code", handler or (f"task:{outer}" if outer else "loop"), kind or "-"
+
+    def top_sites(self, n=3):
+        return sorted(self.sites.items(), key=lambda kv: kv[1][1], reverse=True)[:n]
+
+WATCHDOG = LoopWatchdog()
+
 # ==========================================
 # 2. CONFIGURATION
 # ==========================================
 TOKEN = os.getenv('TOKEN') 
 OWNER_ID = int(os.getenv('OWNER_ID', '0'))
-DB_FILE = 'database.json'
+DB_FILE = os.getenv('DB_FILE', 'database.json')
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'database.sqlite3')
+DB_BACKEND = os.getenv('DB_BACKEND', 'sqlite').lower()  # 'sqlite' (default) or legacy 'json'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')                    # public base url; unset = long polling
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or (hashlib.sha256(TOKEN.encode()).hexdigest()[:32] if TOKEN else None)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))  # handlers running at once; 1 = sequential
+WORKERS = int(os.getenv('WORKERS', '1'))                  # >1: a front process feeds N bot processes sharing the SQLite file
+WORKER_ID = int(os.getenv('WORKER_ID', '-1'))             # set by the front for its workers; -1 = front / single process
 
 IDS = {
     "MAIN": "@errorkid_05", 
@@ -53,8 +353,10 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 # ==========================================
 # 3. DATABASE FUNCTIONS
 # ==========================================
-def load_db():
-    default_db = {
+BASE_SUBJECTS = ["Hindi", "English", "Maths", "Biology", "Chemistry", "Physics"]
+
+def default_db():
+    return {
         "questions": {
             "BSEB": {
                 "Hindi-Gadya": {}, "Hindi-Padya": {}, "Hindi-Grammar": {},
@@ -67,47 +369,1310 @@ def load_db():
         "user_data": {},
         "all_users": [],
         "current_polls": {},
-        "maintenance_mode": False 
+        "quiz_sessions": {},
+        "qstats": {},
+        "reviews": {},
+        "maintenance_mode": False,
+        "next_qid": 1,
+        "broadcast": None
     }
 
-    if os.path.exists(DB_FILE):
+def normalize_db(data):
+    defaults = default_db()
+    if "questions" not in data: data["questions"] = defaults["questions"]
+    if "BSEB" not in data["questions"]: data["questions"]["BSEB"] = defaults["questions"]["BSEB"]
+    if "maintenance_mode" not in data: data["maintenance_mode"] = False
+
+    for sub in BASE_SUBJECTS:
+        pyq_key = f"{sub}-PYQ"
+        yt_key = f"{sub}-YouTube"
+        if pyq_key not in data["questions"]["BSEB"]: data["questions"]["BSEB"][pyq_key] = {}
+        if yt_key not in data["questions"]["BSEB"]: data["questions"]["BSEB"][yt_key] = {}
+
+    for k, v in defaults.items():
+        if k not in data: data[k] = v
+    freeze_questions(data)
+    assign_question_ids(data)
+    data["qstats"] = {int(qid): rec if isinstance(rec, array) else array('I', rec) for qid, rec in data["qstats"].items()}
+    data["reviews"] = {str(uid): {int(qid): list(st) for qid, st in items.items()} for uid, items in data["reviews"].items()}
+    migrate_mistake_copies(data)
+    return data
+
+def assign_question_ids(data):
+    # Every question gets a stable integer id; storage rows are keyed by it
+    next_qid = max(int(data.get("next_qid", 1)), 1)
+    seen = set()
+    for subs in data["questions"].values():
+        for chaps in subs.values():
+            for qs in chaps.values():
+                for q in qs:
+                    if isinstance(q.id, int) and q.id not in seen:
+                        seen.add(q.id); next_qid = max(next_qid, q.id + 1)
+                    else: q.id = None
+    for subs in data["questions"].values():
+        for chaps in subs.values():
+            for qs in chaps.values():
+                for q in qs:
+                    if q.id is None:
+                        q.id = next_qid; next_qid += 1
+    data["next_qid"] = next_qid
+
+def migrate_mistake_copies(data):
+    # Mistake books are sets of question ids; older layouts embedded full question copies
+    lookup = None
+    converted = dropped = 0
+    for ud in data["user_data"].values():
+        for cat, subs in ud.get("mistakes", {}).items():
+            for sub, items in list(subs.items()):
+                if isinstance(items, set): continue
+                ids = set()
+                for item in items:
+                    if isinstance(item, int): ids.add(item); continue
+                    if isinstance(item.get("id"), int): ids.add(item["id"]); continue
+                    if lookup is None:
+                        lookup = {}
+                        for c, s_ in data["questions"].items():
+                            for chaps in s_.values():
+                                for qs in chaps.values():
+                                    for q in qs: lookup.setdefault((c, q["question"]), q["id"])
+                    qid = lookup.get((cat, item.get("question")))
+                    if qid is None: dropped += 1
+                    else: ids.add(qid); converted += 1
+                subs[sub] = ids
+    if converted or dropped:
+        print(f"♻️ Mistake book migrated: {converted} copies -> ids, {dropped} no longer in the bank")
+    return converted + dropped
+
+def json_default(o):
+    if isinstance(o, set): return sorted(o)
+    if isinstance(o, array): return o.tolist()
+    if isinstance(o, Question): return o.to_dict()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+def esc(text):
+    if not text: return ""
+    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+POLL_QUESTION_MAX = 300   # Telegram Bot API limits for quiz polls
+POLL_OPTION_MAX = 100
+POLL_PREFIX_RESERVE = 12  # room for the "[i/N] " counter added at send time
+QUESTION_STATS = {"truncated": 0}
+
+def render_poll_text(question):
+    return esc(question)
+
+def render_poll_option(option):
+    return str(option).replace('<', '').replace('>', '')
+
+def question_problem(question, options, correct):
+    # Why Telegram would refuse this question as a quiz poll, or None if it's sendable
+    if not question.strip(): return "empty question"
+    if not 2 <= len(options) <= 10: return f"needs 2-10 options, got {len(options)}"
+    if not isinstance(correct, int): return "no correct answer (not a quiz poll)"
+    if not 0 <= correct < len(options): return f"answer {correct + 1} out of range 1-{len(options)}"
+    n = len(render_poll_text(question))
+    if n > POLL_QUESTION_MAX - POLL_PREFIX_RESERVE: return f"question too long ({n}/{POLL_QUESTION_MAX - POLL_PREFIX_RESERVE} chars)"
+    for i, opt in enumerate(options, 1):
+        n = len(render_poll_option(opt))
+        if not n: return f"option {i} is empty"
+        if n > POLL_OPTION_MAX: return f"option {i} too long ({n}/{POLL_OPTION_MAX} chars)"
+    return None
+
+class Question:
+    # Immutable question record shared by reference (bank, index, chapters, snapshots). Strings are
+    # interned and the poll payload is rendered once here, so sending only adds the "[i/N]" prefix.
+    # Item access (q["question"]) keeps the old dict-style call sites working.
+    __slots__ = ("id", "question", "options", "correct", "poll_text", "poll_options")
+
+    def __init__(self, qid, question, options, correct):
+        self.id = qid
+        self.question = sys.intern(str(question))
+        self.options = tuple(sys.intern(str(o)) for o in options)
+        self.correct = correct
+        text = render_poll_text(self.question)
+        limit = POLL_QUESTION_MAX - POLL_PREFIX_RESERVE
+        # Rows that predate ingest validation are clipped rather than failing at send time
+        if len(text) > limit: text = text[:limit - 1] + "…"; QUESTION_STATS["truncated"] += 1
+        self.poll_text = self.question if text == self.question else sys.intern(text)
+        opts = []
+        for o in self.options:
+            r = render_poll_option(o)[:POLL_OPTION_MAX] or "-"
+            opts.append(o if r == o else sys.intern(r))
+        self.poll_options = tuple(opts)
+
+    @classmethod
+    def from_dict(cls, d):
+        return d if isinstance(d, cls) else cls(d.get("id"), d["question"], d["options"], d["correct"])
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        return {"id": self.id, "question": self.question, "options": list(self.options), "correct": self.correct}
+
+def deep_sizeof(o, seen):
+    # Bytes reachable from o, counting shared (interned) objects once
+    if id(o) in seen: return 0
+    seen.add(id(o))
+    size = sys.getsizeof(o)
+    if isinstance(o, dict): size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in o.items())
+    elif isinstance(o, (list, tuple, set)): size += sum(deep_sizeof(v, seen) for v in o)
+    elif isinstance(o, Question): size += sum(deep_sizeof(getattr(o, a), seen) for a in Question.__slots__)
+    return size
+
+def question_memory_report(data):
+    # Footprint of the live question bank vs. the same questions as freshly decoded JSON dicts
+    qs = [q for subs in data["questions"].values() for chaps in subs.values() for chap in chaps.values() for q in chap]
+    as_dicts = json.loads(json.dumps(qs, default=json_default))
+    before, after = deep_sizeof(as_dicts, set()), deep_sizeof(qs, set())
+    return {"questions": len(qs), "dict_bytes": before, "record_bytes": after,
+            "saved_pct": (1 - after / before) * 100 if before else 0.0, "truncated": QUESTION_STATS["truncated"]}
+
+def freeze_questions(data):
+    # Rows a quiz can't grade (no text, fewer than 2 options, missing or out-of-range answer) are dropped
+    # and logged instead of failing the load or a later flush on questions.correct NOT NULL
+    for cat, subs in data["questions"].items():
+        for sub, chaps in subs.items():
+            for chap, qs in chaps.items():
+                kept = []
+                for i, q in enumerate(qs):
+                    try:
+                        q = Question.from_dict(q)
+                        ok = isinstance(q.correct, int) and 2 <= len(q.options) and 0 <= q.correct < len(q.options)
+                    except (KeyError, TypeError, AttributeError): ok = False
+                    if ok: kept.append(q)
+                    else: print(f"⚠️ Skipped bad question {cat}/{sub}/{chap}#{i + 1}")
+                chaps[chap] = kept
+
+def new_question(question, options, correct):
+    qid = db["next_qid"]
+    db["next_qid"] = qid + 1
+    return Question(qid, question, options, correct)
+
+class SQLiteStore:
+    # Row-level storage: one answered poll touches a handful of rows instead of rewriting everything.
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS chapters (
+        cat TEXT NOT NULL, sub TEXT NOT NULL, chap TEXT NOT NULL,
+        PRIMARY KEY (cat, sub, chap));
+    CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY, cat TEXT NOT NULL, sub TEXT NOT NULL, chap TEXT NOT NULL,
+        pos INTEGER NOT NULL, question TEXT NOT NULL, options TEXT NOT NULL, correct INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_questions_chap ON questions (cat, sub, chap, pos);
+    CREATE TABLE IF NOT EXISTS stats (
+        uid TEXT NOT NULL, cat TEXT NOT NULL, sub TEXT NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0, correct INTEGER NOT NULL DEFAULT 0, wrong INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (uid, cat, sub));
+    CREATE TABLE IF NOT EXISTS mistakes (
+        uid TEXT NOT NULL, cat TEXT NOT NULL, sub TEXT NOT NULL, qid INTEGER NOT NULL,
+        PRIMARY KEY (uid, cat, sub, qid));
+    CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY, listed INTEGER NOT NULL DEFAULT 0, data TEXT);
+    CREATE TABLE IF NOT EXISTS admins (uid INTEGER PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS current_polls (poll_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS quiz_sessions (
+        sid TEXT PRIMARY KEY, uid INTEGER NOT NULL, chat INTEGER NOT NULL, cat TEXT NOT NULL, sub TEXT NOT NULL,
+        mode TEXT NOT NULL, t INTEGER NOT NULL, qids TEXT NOT NULL,
+        cursor INTEGER NOT NULL, poll_id TEXT, message_id INTEGER, updated REAL NOT NULL, board TEXT);
+    CREATE TABLE IF NOT EXISTS quiz_scores (
+        sid TEXT NOT NULL, uid TEXT NOT NULL, correct INTEGER NOT NULL, answered INTEGER NOT NULL, ms INTEGER NOT NULL,
+        PRIMARY KEY (sid, uid));
+    CREATE TABLE IF NOT EXISTS qstats (qid INTEGER PRIMARY KEY, data BLOB NOT NULL);
+    CREATE TABLE IF NOT EXISTS reviews (
+        uid TEXT NOT NULL, qid INTEGER NOT NULL, box INTEGER NOT NULL, due REAL NOT NULL,
+        PRIMARY KEY (uid, qid));
+    """
+    META_KEYS = ["maintenance_mode", "next_qid", "broadcast"]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Schema v1 stored whole question copies in mistakes.data; keep them aside for migration
+        cols = [row[1] for row in self.conn.execute("PRAGMA table_info(mistakes)")]
+        if "data" in cols: self.conn.execute("ALTER TABLE mistakes RENAME TO mistakes_legacy")
+        cols = [row[1] for row in self.conn.execute("PRAGMA table_info(quiz_sessions)")]
+        if cols and "board" not in cols: self.conn.execute("ALTER TABLE quiz_sessions ADD COLUMN board TEXT")
+        self.conn.executescript(self.SCHEMA)
+
+    def has_legacy_mistakes(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='mistakes_legacy'").fetchone() is not None
+
+    def drop_legacy_mistakes(self):
+        with self.lock:
+            self.conn.execute("DROP TABLE IF EXISTS mistakes_legacy")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                yield cur
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM meta WHERE key='schema_version'").fetchone() is None
+
+    def load(self, owner=None):
+        # owner: a worker id (worker mode) -> content whole, but only the users, polls and quiz sessions
+        # that worker owns; qstats only for worker 0
+        data = {"questions": {}, "admins": [], "stats": {}, "user_data": {}, "all_users": [], "current_polls": {}, "quiz_sessions": {}, "qstats": {}, "reviews": {}}
+        with self.lock:
+            c = self.conn
+            data["admins"] = [uid for (uid,) in c.execute("SELECT uid FROM admins ORDER BY rowid")]
+            admins = set(data["admins"])
+            mine = (lambda uid: True) if owner is None else (lambda uid: partition(uid, admins) == owner)
+            for key, value in c.execute("SELECT key, value FROM meta"):
+                if key in self.META_KEYS: data[key] = json.loads(value)
+            for cat, sub, chap in c.execute("SELECT cat, sub, chap FROM chapters ORDER BY cat, sub, chap"):
+                data["questions"].setdefault(cat, {}).setdefault(sub, {})[chap] = []
+            for qid, cat, sub, chap, question, options, correct in c.execute(
+                    "SELECT id, cat, sub, chap, question, options, correct FROM questions ORDER BY cat, sub, chap, pos"):
+                chaps = data["questions"].setdefault(cat, {}).setdefault(sub, {})
+                chaps.setdefault(chap, []).append(Question(qid, question, json.loads(options), correct))
+            for uid, cat, sub, total, correct, wrong in c.execute("SELECT uid, cat, sub, total, correct, wrong FROM stats"):
+                if not mine(uid): continue
+                data["stats"].setdefault(uid, {}).setdefault(cat, {})[sub] = {'total': total, 'correct': correct, 'wrong': wrong}
+            for uid, listed, udata in c.execute("SELECT uid, listed, data FROM users ORDER BY rowid"):
+                if not mine(uid): continue
+                if listed: data["all_users"].append(int(uid))
+                if udata is not None: data["user_data"][uid] = json.loads(udata)
+            for uid, cat, sub, qid in c.execute("SELECT uid, cat, sub, qid FROM mistakes"):
+                if not mine(uid): continue
+                ud = data["user_data"].setdefault(uid, {})
+                ud.setdefault("mistakes", {}).setdefault(cat, {}).setdefault(sub, set()).add(qid)
+            if c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='mistakes_legacy'").fetchone():
+                for uid, cat, sub, mdata in c.execute("SELECT uid, cat, sub, data FROM mistakes_legacy ORDER BY uid, cat, sub, pos"):
+                    ud = data["user_data"].setdefault(uid, {})
+                    items = ud.setdefault("mistakes", {}).setdefault(cat, {}).setdefault(sub, [])
+                    if isinstance(items, set): ud["mistakes"][cat][sub] = items = list(items)
+                    items.append(json.loads(mdata))
+            for poll_id, pdata in c.execute("SELECT poll_id, data FROM current_polls"):
+                rec = json.loads(pdata)
+                if owner is None or session_owner(rec.get("mode"), rec["user"], admins) == owner:
+                    data["current_polls"][poll_id] = rec
+            for sid, uid, chat, cat, sub, mode, t, qids, cursor, poll_id, message_id, updated, board in c.execute(
+                    "SELECT sid, uid, chat, cat, sub, mode, t, qids, cursor, poll_id, message_id, updated, board FROM quiz_sessions"):
+                if owner is not None and session_owner(mode, uid, admins) != owner: continue
+                data["quiz_sessions"][sid] = {"user": uid, "chat": chat, "cat": cat, "sub": sub, "mode": mode, "t": t,
+                                              "qids": json.loads(qids), "cursor": cursor, "poll": poll_id, "msg": message_id, "at": updated,
+                                              "board": json.loads(board) if board else None}
+            # Group scoreboards: one row per player (the board column only holds boards saved before that)
+            for sid, uid, correct, answered, ms in c.execute("SELECT sid, uid, correct, answered, ms FROM quiz_scores"):
+                rec = data["quiz_sessions"].get(sid)
+                if rec is not None:
+                    if rec["board"] is None: rec["board"] = {}
+                    rec["board"][uid] = [correct, answered, ms]
+            for qid, blob in c.execute("SELECT qid, data FROM qstats" if owner in (None, 0) else "SELECT qid, data FROM qstats WHERE 0"):
+                rec = array('I'); rec.frombytes(blob)
+                data["qstats"][qid] = rec
+            for uid, qid, box, due in c.execute("SELECT uid, qid, box, due FROM reviews"):
+                if not mine(uid): continue
+                data["reviews"].setdefault(uid, {})[qid] = [box, due]
+        return data
+
+    # --- Partial reads for worker mode: rows another process committed ---
+    def load_chapters(self, keys):
+        # (cat, sub, chap) -> questions in order, or None for a deleted chapter
+        out = {}
+        with self.lock:
+            c = self.conn
+            for cat, sub, chap in keys:
+                if c.execute("SELECT 1 FROM chapters WHERE cat=? AND sub=? AND chap=?", (cat, sub, chap)).fetchone() is None:
+                    out[(cat, sub, chap)] = None; continue
+                out[(cat, sub, chap)] = [Question(qid, question, json.loads(options), correct) for qid, question, options, correct in c.execute(
+                    "SELECT id, question, options, correct FROM questions WHERE cat=? AND sub=? AND chap=? ORDER BY pos", (cat, sub, chap))]
+        return out
+
+    def load_users(self, uids):
+        # Per-user rows in load() layout, for a user moving between workers
+        data = {"stats": {}, "user_data": {}, "reviews": {}}
+        with self.lock:
+            c = self.conn
+            for uid in map(str, uids):
+                for cat, sub, total, correct, wrong in c.execute("SELECT cat, sub, total, correct, wrong FROM stats WHERE uid=?", (uid,)):
+                    data["stats"].setdefault(uid, {}).setdefault(cat, {})[sub] = {'total': total, 'correct': correct, 'wrong': wrong}
+                row = c.execute("SELECT data FROM users WHERE uid=?", (uid,)).fetchone()
+                if row and row[0] is not None: data["user_data"][uid] = json.loads(row[0])
+                for cat, sub, qid in c.execute("SELECT cat, sub, qid FROM mistakes WHERE uid=?", (uid,)):
+                    ud = data["user_data"].setdefault(uid, {})
+                    ud.setdefault("mistakes", {}).setdefault(cat, {}).setdefault(sub, set()).add(qid)
+                for qid, box, due in c.execute("SELECT qid, box, due FROM reviews WHERE uid=?", (uid,)):
+                    data["reviews"].setdefault(uid, {})[qid] = [box, due]
+        return data
+
+    def count_users(self):
+        # db_counts()["users"] over every worker's users
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM users WHERE listed=1 OR data IS NOT NULL").fetchone()[0]
+
+    def max_quiz_sid(self):
+        with self.lock:
+            return self.conn.execute("SELECT max(CAST(sid AS INTEGER)) FROM quiz_sessions").fetchone()[0] or 0
+
+    def listed_users(self):
+        with self.lock:
+            return [int(uid) for (uid,) in self.conn.execute("SELECT uid FROM users WHERE listed=1 ORDER BY rowid")]
+
+    # --- Writers: each change tag maps to a small set of row upserts/deletes ---
+    def apply(self, data, changes):
+        with self.transaction() as cur:
+            for change in changes:
+                getattr(self, f"_write_{change[0]}")(cur, data, *change[1:])
+
+    def write_all(self, data, owner=None):
+        # owner (worker mode): data only holds that worker's users and sessions, so rows another worker
+        # owns are replaced only where data carries them and never deleted
+        with self.transaction() as cur:
+            if owner is None:
+                for table in ["meta", "chapters", "questions", "stats", "mistakes", "users", "admins", "current_polls", "quiz_sessions", "quiz_scores", "qstats", "reviews"]:
+                    cur.execute(f"DELETE FROM {table}")
+            else:
+                for table in ["meta", "chapters", "questions", "admins"] + (["qstats"] if owner == 0 else []):
+                    cur.execute(f"DELETE FROM {table}")
+                admins = set(data["admins"])
+                stored = cur.execute("SELECT uid FROM users UNION SELECT uid FROM stats UNION SELECT uid FROM mistakes UNION SELECT uid FROM reviews").fetchall()
+                uids = {uid for (uid,) in stored if partition(uid, admins) == owner}
+                uids.update(data["stats"], data["user_data"], data.get("reviews", {}), map(str, data["all_users"]))
+                for table in ["stats", "mistakes", "users", "reviews"]:
+                    cur.executemany(f"DELETE FROM {table} WHERE uid=?", [(uid,) for uid in uids])
+                polls = [(pid, json.loads(pdata)) for pid, pdata in cur.execute("SELECT poll_id, data FROM current_polls").fetchall()]
+                cur.executemany("DELETE FROM current_polls WHERE poll_id=?",
+                                [(pid,) for pid, rec in polls if session_owner(rec.get("mode"), rec["user"], admins) == owner])
+                sids = [(sid,) for sid, mode, uid in cur.execute("SELECT sid, mode, uid FROM quiz_sessions").fetchall() if session_owner(mode, uid, admins) == owner]
+                cur.executemany("DELETE FROM quiz_sessions WHERE sid=?", sids)
+                cur.executemany("DELETE FROM quiz_scores WHERE sid=?", sids)
+            cur.execute("INSERT INTO meta (key, value) VALUES ('schema_version', '1')")
+            self._write_meta(cur, data)
+            for cat, subs in data["questions"].items():
+                for sub, chaps in subs.items():
+                    for chap in chaps: self._write_chapter(cur, data, cat, sub, chap)
+            for uid in data["stats"]: self._write_stats(cur, data, uid)
+            for uid in data["user_data"]:
+                self._write_user(cur, data, uid)
+                self._write_mistakes(cur, data, uid)
+            for uid in data["all_users"]: self._write_listed(cur, data, uid)
+            self._write_admins(cur, data)
+            for poll_id in data["current_polls"]: self._write_poll(cur, data, poll_id)
+            for sid in data.get("quiz_sessions", {}): self._write_quiz(cur, data, sid)
+            for qid in data.get("qstats", {}): self._write_qstat(cur, data, qid)
+            for uid, items in data.get("reviews", {}).items():
+                for qid in items: self._write_review(cur, data, uid, qid)
+
+    def _write_meta(self, cur, data):
+        cur.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                        [(k, json.dumps(data[k])) for k in self.META_KEYS if k in data])
+
+    def _write_chapter(self, cur, data, cat, sub, chap):
+        qs = data["questions"].get(cat, {}).get(sub, {}).get(chap)
+        if qs is None:
+            cur.execute("DELETE FROM chapters WHERE cat=? AND sub=? AND chap=?", (cat, sub, chap))
+            cur.execute("DELETE FROM questions WHERE cat=? AND sub=? AND chap=?", (cat, sub, chap))
+            return
+        cur.execute("INSERT OR IGNORE INTO chapters (cat, sub, chap) VALUES (?, ?, ?)", (cat, sub, chap))
+        stored = {qid for (qid,) in cur.execute("SELECT id FROM questions WHERE cat=? AND sub=? AND chap=?", (cat, sub, chap))}
+        live = {q["id"] for q in qs}
+        cur.executemany("DELETE FROM questions WHERE id=?", [(qid,) for qid in stored - live])
+        cur.executemany(
+            "INSERT OR REPLACE INTO questions (id, cat, sub, chap, pos, question, options, correct) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(q["id"], cat, sub, chap, pos, q["question"], json.dumps(q["options"]), q["correct"]) for pos, q in enumerate(qs)])
+
+    def _write_question(self, cur, data, cat, sub, chap, pos):
+        # Appended question: one row, without rewriting the rest of its chapter
+        qs = data["questions"].get(cat, {}).get(sub, {}).get(chap)
+        if qs is None: return
+        q = qs[pos]
+        cur.execute("INSERT OR IGNORE INTO chapters (cat, sub, chap) VALUES (?, ?, ?)", (cat, sub, chap))
+        cur.execute("INSERT OR REPLACE INTO questions (id, cat, sub, chap, pos, question, options, correct) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (q["id"], cat, sub, chap, pos, q["question"], json.dumps(q["options"]), q["correct"]))
+
+    def _write_stats(self, cur, data, uid):
+        uid = str(uid)
+        cur.execute("DELETE FROM stats WHERE uid=?", (uid,))
+        rows = []
+        for cat, subs in data["stats"].get(uid, {}).items():
+            for sub, e in subs.items():
+                rows.append((uid, cat, sub, e.get('total', 0), e.get('correct', 0), e.get('wrong', 0)))
+        cur.executemany("INSERT INTO stats (uid, cat, sub, total, correct, wrong) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def _write_user(self, cur, data, uid):
+        uid = str(uid)
+        udata = data["user_data"].get(uid)
+        if udata is None:
+            cur.execute("UPDATE users SET data=NULL WHERE uid=?", (uid,))
+            return
+        rest = json.dumps({k: v for k, v in udata.items() if k != "mistakes"})
+        cur.execute("INSERT INTO users (uid, data) VALUES (?, ?) ON CONFLICT(uid) DO UPDATE SET data=excluded.data", (uid, rest))
+
+    def _write_listed(self, cur, data, uid):
+        cur.execute("INSERT INTO users (uid, listed) VALUES (?, 1) ON CONFLICT(uid) DO UPDATE SET listed=1", (str(uid),))
+
+    def _write_unlisted(self, cur, data, uid):
+        cur.execute("UPDATE users SET listed=0 WHERE uid=?", (str(uid),))
+
+    def _write_mistakes(self, cur, data, uid):
+        uid = str(uid)
+        cur.execute("DELETE FROM mistakes WHERE uid=?", (uid,))
+        rows = []
+        for cat, subs in data["user_data"].get(uid, {}).get("mistakes", {}).items():
+            for sub, ids in subs.items():
+                rows.extend((uid, cat, sub, qid) for qid in ids)
+        cur.executemany("INSERT INTO mistakes (uid, cat, sub, qid) VALUES (?, ?, ?, ?)", rows)
+
+    def _write_mistake(self, cur, data, uid, cat, sub, qid):
+        uid = str(uid)
+        if qid in data["user_data"].get(uid, {}).get("mistakes", {}).get(cat, {}).get(sub, ()):
+            cur.execute("INSERT OR IGNORE INTO mistakes (uid, cat, sub, qid) VALUES (?, ?, ?, ?)", (uid, cat, sub, qid))
+        else:
+            cur.execute("DELETE FROM mistakes WHERE uid=? AND cat=? AND sub=? AND qid=?", (uid, cat, sub, qid))
+
+    def _write_admins(self, cur, data):
+        cur.execute("DELETE FROM admins")
+        cur.executemany("INSERT OR IGNORE INTO admins (uid) VALUES (?)", [(a,) for a in data["admins"]])
+
+    def _write_poll(self, cur, data, poll_id):
+        p_data = data["current_polls"].get(poll_id)
+        if p_data is None: cur.execute("DELETE FROM current_polls WHERE poll_id=?", (poll_id,))
+        else: cur.execute("INSERT OR REPLACE INTO current_polls (poll_id, data) VALUES (?, ?)", (poll_id, json.dumps(p_data)))
+
+    def _write_quiz(self, cur, data, sid):
+        # Whole session row, written once when the quiz starts (and deleted when it ends)
+        rec = data["quiz_sessions"].get(sid)
+        cur.execute("DELETE FROM quiz_scores WHERE sid=?", (sid,))
+        if rec is None:
+            cur.execute("DELETE FROM quiz_sessions WHERE sid=?", (sid,))
+            return
+        cur.execute("INSERT OR REPLACE INTO quiz_sessions (sid, uid, chat, cat, sub, mode, t, qids, cursor, poll_id, message_id, updated, board) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                    (sid, rec["user"], rec["chat"], rec["cat"], rec["sub"], rec["mode"], rec["t"], json.dumps(rec["qids"]),
+                     rec["cursor"], rec["poll"], rec["msg"], rec["at"]))
+        cur.executemany("INSERT INTO quiz_scores (sid, uid, correct, answered, ms) VALUES (?, ?, ?, ?, ?)",
+                        [(sid, uid, *row) for uid, row in (rec.get("board") or {}).items()])
+
+    def _write_quiz_cursor(self, cur, data, sid):
+        # Per-question checkpoint: a fixed-size UPDATE whatever the quiz length
+        rec = data["quiz_sessions"].get(sid)
+        if rec is None: return
+        cur.execute("UPDATE quiz_sessions SET cursor=?, poll_id=?, message_id=?, updated=? WHERE sid=?",
+                    (rec["cursor"], rec["poll"], rec["msg"], rec["at"], sid))
+
+    def _write_quiz_score(self, cur, data, sid, uid):
+        # One group player's running score, written only when a poll they answered closes
+        row = data["quiz_sessions"].get(sid, {}).get("board", {}).get(uid)
+        if row is not None:
+            cur.execute("INSERT OR REPLACE INTO quiz_scores (sid, uid, correct, answered, ms) VALUES (?, ?, ?, ?, ?)", (sid, uid, *row))
+
+    def _write_qstat(self, cur, data, qid):
+        rec = data["qstats"].get(qid)
+        if rec is None: cur.execute("DELETE FROM qstats WHERE qid=?", (qid,))
+        else: cur.execute("INSERT OR REPLACE INTO qstats (qid, data) VALUES (?, ?)", (qid, rec.tobytes()))
+
+    def _write_review(self, cur, data, uid, qid):
+        st = data["reviews"].get(str(uid), {}).get(qid)
+        if st is None: cur.execute("DELETE FROM reviews WHERE uid=? AND qid=?", (str(uid), qid))
+        else: cur.execute("INSERT OR REPLACE INTO reviews (uid, qid, box, due) VALUES (?, ?, ?, ?)", (str(uid), qid, st[0], st[1]))
+
+_store = None
+
+def get_store():
+    global _store
+    if _store is None: _store = SQLiteStore(SQLITE_FILE)
+    return _store
+
+def partition(user_id, admins=None):
+    # Worker mode: the worker that handles a user's updates (section 10); admins default to the live list
+    user_id = int(user_id)
+    if user_id == OWNER_ID or user_id in (db["admins"] if admins is None else admins): return 0
+    return zlib.crc32(str(user_id).encode()) % WORKERS
+
+def session_owner(mode, user_id, admins=None):
+    # Group quizzes and their polls live on worker 0, private ones on their user's worker
+    return 0 if mode == 'group' else partition(user_id, admins)
+
+def read_json_db(path):
+    with open(path, 'r') as f:
+        return normalize_db(json.load(f))
+
+def migrate_json_to_sqlite(json_path=None, store=None):
+    # One-shot import of the legacy database.json layout into SQLite
+    json_path = json_path or DB_FILE
+    store = store or get_store()
+    data = read_json_db(json_path)
+    store.write_all(data)
+    n_q = sum(len(qs) for subs in data["questions"].values() for chaps in subs.values() for qs in chaps.values())
+    print(f"✅ Migrated {json_path} -> {store.path}: {n_q} questions, {len(data['user_data'])} users")
+    return data
+
+def load_db():
+    # Any read or migration error stops startup: falling back to an empty database would get it
+    # persisted over the real one by the first flush
+    if DB_BACKEND == 'sqlite':
+        store = get_store()
+        if store.is_empty():
+            if os.path.exists(DB_FILE):
+                try: return migrate_json_to_sqlite(DB_FILE, store)
+                except Exception as e:
+                    print(f"DB Migration Error: {e}")
+                    raise
+            data = normalize_db(default_db())
+            store.write_all(data)
+            return data
         try:
-            with open(DB_FILE, 'r') as f:
-                data = json.load(f)
-                
-                if "questions" not in data: data["questions"] = default_db["questions"]
-                if "BSEB" not in data["questions"]: data["questions"]["BSEB"] = default_db["questions"]["BSEB"]
-                if "maintenance_mode" not in data: data["maintenance_mode"] = False
-                
-                base_subjects = ["Hindi", "English", "Maths", "Biology", "Chemistry", "Physics"]
-                for sub in base_subjects:
-                    pyq_key = f"{sub}-PYQ"
-                    yt_key = f"{sub}-YouTube"
-                    if pyq_key not in data["questions"]["BSEB"]: data["questions"]["BSEB"][pyq_key] = {}
-                    if yt_key not in data["questions"]["BSEB"]: data["questions"]["BSEB"][yt_key] = {}
-
-                for k, v in default_db.items():
-                    if k not in data: data[k] = v
-                return data
+            # Worker mode loads only this process's users (the front none); a legacy migration needs everyone
+            owner = WORKER_ID if WORKERS > 1 and not store.has_legacy_mistakes() else None
+            data = normalize_db(store.load(owner))
+            if store.has_legacy_mistakes():
+                store.apply(data, [("mistakes", uid) for uid in data["user_data"]])
+                store.drop_legacy_mistakes()
+            return data
         except Exception as e:
             print(f"DB Load Error: {e}")
-            return default_db
-    
-    base_subjects = ["Hindi", "English", "Maths", "Biology", "Chemistry", "Physics"]
-    for sub in base_subjects:
-        default_db["questions"]["BSEB"][f"{sub}-PYQ"] = {}
-        default_db["questions"]["BSEB"][f"{sub}-YouTube"] = {}
-        
-    return default_db
+            raise
 
-def save_db(data):
+    if os.path.exists(DB_FILE):
+        try: return read_json_db(DB_FILE)
+        except Exception as e:
+            print(f"DB Load Error: {e}")
+            raise
+    return normalize_db(default_db())
+
+def write_file_atomic(path, payload):
+    # Temp file + fsync + os.replace: a crash leaves either the old or the new file, never a truncated one
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def save_db(data, *changes):
+    # Synchronous writer (runs in a worker thread via flush_db).
+    # changes: tags like ("stats", uid) / ("chapter", cat, sub, chap); none means full sync
+    t0 = time.perf_counter()
     try:
-        with open(DB_FILE, 'w') as f:
-            json.dump(data, f, indent=4)
-    except: pass
+        if DB_BACKEND == 'sqlite':
+            if changes: get_store().apply(data, changes)
+            else: get_store().write_all(data, WORKER_ID if WORKERS > 1 else None)
+            return 0
+        payload = json.dumps(data, default=json_default).encode('utf-8')
+        write_file_atomic(DB_FILE, payload)
+        return len(payload)
+    finally: SAVE_SECONDS.observe(time.perf_counter() - t0, ("delta" if changes else "full",))
+
+# ==========================================
+# 3.1 WRITE-BEHIND PERSISTENCE
+# ==========================================
+FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '2'))
+FULL_SYNC = ("*",)
+
+_dirty = {}          # change tag -> None (insertion-ordered set)
+_dirty_marks = 0     # mark_dirty() calls since the last flush
+_flush_lock = asyncio.Lock()
+DB_LOCK = asyncio.Lock()   # admin content edits (imports, chapters, uploads, restore) and broadcast start, one at a time
+FLUSH_MAX_RETRIES = int(os.getenv('FLUSH_MAX_RETRIES', '3'))   # failed flushes before a change tag is dropped
+
+_failures = {}       # change tag -> flushes it has failed in a row
+PERSIST_STATS = {"flushes": 0, "errors": 0, "dropped": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0,
+                 "last_coalesced": 0, "total_coalesced": 0, "last_bytes": 0}
+
+def mark_dirty(*changes):
+    # Handlers only record what changed; flush_db() writes it later in one batch
+    global _dirty_marks
+    _dirty_marks += 1
+    if not changes: changes = (FULL_SYNC,)
+    for change in changes:
+        _dirty[change] = None
+        # Worker mode always takes full backups from the store
+        if WORKERS < 2 and change[0] not in BACKUP_TRANSIENT:
+            _backup_changes[change] = None
+            if len(_backup_changes) > BACKUP_MAX_CHANGES:
+                _backup_changes.clear(); _backup_changes[FULL_SYNC] = None
+
+def clone_tree(o):
+    if isinstance(o, dict): return {k: clone_tree(v) for k, v in o.items()}
+    if isinstance(o, list): return [clone_tree(v) for v in o]
+    if isinstance(o, set): return set(o)
+    if isinstance(o, array): return array(o.typecode, o)
+    return o
+
+def snapshot_db(data):
+    # Consistent copy for background serialization. Question dicts are never edited after
+    # ingest, so they are shared; everything users can mutate is copied.
+    snap = {k: clone_tree(v) for k, v in data.items() if k != "questions"}
+    snap["questions"] = {cat: {sub: {chap: list(qs) for chap, qs in chaps.items()} for sub, chaps in subs.items()}
+                         for cat, subs in data["questions"].items()}
+    return snap
+
+def snapshot_changes(data, changes):
+    # Copies only the rows named by `changes`, so the worker thread never reads live state
+    part = {"questions": {}, "stats": {}, "user_data": {}, "all_users": [], "current_polls": {}, "quiz_sessions": {}, "qstats": {},
+            "reviews": {}, "admins": list(data["admins"])}
+    for k in SQLiteStore.META_KEYS:
+        if k in data: part[k] = copy.deepcopy(data[k])
+    for change in changes:
+        kind = change[0]
+        if kind == 'chapter':
+            cat, sub, chap = change[1:]
+            qs = data["questions"].get(cat, {}).get(sub, {}).get(chap)
+            # Question dicts are never edited after ingest, so copying the list is enough
+            if qs is not None: part["questions"].setdefault(cat, {}).setdefault(sub, {})[chap] = list(qs)
+            else: part["questions"].get(cat, {}).get(sub, {}).pop(chap, None)
+        elif kind == 'question':
+            cat, sub, chap, pos = change[1:]
+            qs = data["questions"].get(cat, {}).get(sub, {}).get(chap)
+            if qs is None or pos >= len(qs): continue
+            # {pos: q} stands in for the list; a full 'chapter' copy in the same flush wins
+            chap_part = part["questions"].setdefault(cat, {}).setdefault(sub, {}).setdefault(chap, {})
+            if isinstance(chap_part, dict): chap_part[pos] = qs[pos]
+        elif kind == 'stats':
+            uid = str(change[1])
+            if uid in data["stats"]: part["stats"][uid] = copy.deepcopy(data["stats"][uid])
+        elif kind in ('user', 'mistakes'):
+            uid = str(change[1])
+            if uid in data["user_data"]: part["user_data"][uid] = copy.deepcopy(data["user_data"][uid])
+        elif kind == 'mistake':
+            uid, cat, sub, qid = str(change[1]), change[2], change[3], change[4]
+            live = data["user_data"].get(uid, {}).get("mistakes", {}).get(cat, {}).get(sub, ())
+            ids = part["user_data"].setdefault(uid, {}).setdefault("mistakes", {}).setdefault(cat, {}).setdefault(sub, set())
+            if qid in live: ids.add(qid)
+        elif kind == 'poll':
+            if change[1] in data["current_polls"]: part["current_polls"][change[1]] = copy.deepcopy(data["current_polls"][change[1]])
+        elif kind in ('quiz', 'quiz_cursor'):
+            # Shallow copy: the qids list is never modified after the session starts
+            rec = data["quiz_sessions"].get(change[1])
+            if rec is not None: part["quiz_sessions"][change[1]] = dict(rec, board=clone_tree(rec.get("board")))
+        elif kind == 'quiz_score':
+            sid, uid = change[1:]
+            row = ((data["quiz_sessions"].get(sid) or {}).get("board") or {}).get(uid)
+            if row is None or "qids" in part["quiz_sessions"].get(sid, {}): continue   # a full session copy already has it
+            part["quiz_sessions"].setdefault(sid, {"board": {}})["board"][uid] = list(row)
+        elif kind == 'qstat':
+            rec = data["qstats"].get(change[1])
+            if rec is not None: part["qstats"][change[1]] = array('I', rec)
+        elif kind == 'review':
+            uid, qid = str(change[1]), change[2]
+            st = data["reviews"].get(uid, {}).get(qid)
+            if st is not None: part["reviews"].setdefault(uid, {})[qid] = list(st)
+    return part
+
+def save_each(data, changes):
+    # Worker thread, after a failed batch: one transaction per change tag; returns [(change, error)]
+    failed = []
+    for change in changes:
+        try: get_store().apply(data, [change])
+        except Exception as e: failed.append((change, e))
+    return failed
+
+async def flush_db():
+    global _dirty_marks
+    async with _flush_lock:
+        if not _dirty: return
+        changes, marks = list(_dirty), _dirty_marks
+        _dirty.clear(); _dirty_marks = 0
+        t0 = time.perf_counter()
+        full = DB_BACKEND != 'sqlite' or FULL_SYNC in changes
+        part = None if full else snapshot_changes(db, changes)
+        try:
+            if full: size = await asyncio.to_thread(save_db, snapshot_db(db))
+            else: size = await asyncio.to_thread(save_db, part, *changes)
+        except Exception as e:
+            PERSIST_STATS["errors"] += 1
+            logging.error(f"DB Flush Error: {e}")
+            _dirty_marks += marks
+            if full:
+                # Keep the changes queued so the next flush retries them
+                for change in changes: _dirty.setdefault(change, None)
+                return
+            # One bad row must not hold back the rest: commit tag by tag, requeue only the failures and
+            # drop a tag once it has failed FLUSH_MAX_RETRIES flushes in a row
+            failed = await asyncio.to_thread(save_each, part, changes)
+            for change, err in failed:
+                _failures[change] = _failures.get(change, 0) + 1
+                if _failures[change] < FLUSH_MAX_RETRIES: _dirty.setdefault(change, None); continue
+                del _failures[change]
+                PERSIST_STATS["dropped"] += 1
+                logging.error(f"DB Flush: dropped {change} after {FLUSH_MAX_RETRIES} failed flushes: {err}")
+            bad = {change for change, _ in failed}
+            for change in changes:
+                if change not in bad: _failures.pop(change, None)
+            if WORKER_ID == 0: publish_content([change for change in changes if change not in bad])
+            return
+        if _failures:
+            for change in changes: _failures.pop(change, None)
+        ms = (time.perf_counter() - t0) * 1000
+        PERSIST_STATS["flushes"] += 1
+        PERSIST_STATS["last_ms"] = ms; PERSIST_STATS["total_ms"] += ms
+        PERSIST_STATS["max_ms"] = max(PERSIST_STATS["max_ms"], ms)
+        PERSIST_STATS["last_coalesced"] = marks; PERSIST_STATS["total_coalesced"] += marks
+        PERSIST_STATS["last_bytes"] = size
+        if WORKER_ID == 0: publish_content(changes)
+
+async def flush_db_job(context: ContextTypes.DEFAULT_TYPE):
+    await flush_db()
+
+# ==========================================
+# 3.2 BACKUPS
+# ==========================================
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))                           # full backups (with their incrementals) kept
+BACKUP_INTERVAL = float(os.getenv('BACKUP_INTERVAL_HOURS', '6')) * 3600
+BACKUP_FULL_EVERY = int(os.getenv('BACKUP_FULL_EVERY', '4'))               # every Nth scheduled backup is full
+BACKUP_INDEX = os.path.join(BACKUP_DIR, 'index.json')
+BACKUP_MAX_CHANGES = int(os.getenv('BACKUP_MAX_CHANGES', '200000'))       # past this many tags the next backup is full
+BACKUP_TRANSIENT = ('poll', 'quiz', 'quiz_cursor', 'quiz_score')   # in-flight state; a restore keeps the live copy anyway
+
+_backup_changes = {}   # change tags since the last backup, for incremental mode
+_backup_lock = asyncio.Lock()
+BACKUP_STATS = {"count": 0, "last_type": None, "last_size": 0, "last_ms": 0.0, "last_at": 0.0, "since_full": 0}
+
+def snapshot_delta(data, changes):
+    # Incremental payload: the current value (or None if deleted) of everything touched since the last backup
+    delta = {"questions": {}, "stats": {}, "user_data": {}, "current_polls": {}, "quiz_sessions": {}, "qstats": {}, "reviews": {}, "meta": {}, "admins": None, "all_users": None}
+    for change in changes:
+        kind = change[0]
+        if kind in ('chapter', 'question'):
+            cat, sub, chap = change[1:4]
+            qs = data["questions"].get(cat, {}).get(sub, {}).get(chap)
+            delta["questions"].setdefault(cat, {}).setdefault(sub, {})[chap] = None if qs is None else list(qs)
+        elif kind == 'stats':
+            uid = str(change[1])
+            delta["stats"][uid] = clone_tree(data["stats"].get(uid))
+        elif kind in ('user', 'mistakes', 'mistake'):
+            uid = str(change[1])
+            delta["user_data"][uid] = clone_tree(data["user_data"].get(uid))
+        elif kind == 'qstat':
+            delta["qstats"][change[1]] = clone_tree(data["qstats"].get(change[1]))
+        elif kind == 'review':
+            delta["reviews"][str(change[1])] = clone_tree(data["reviews"].get(str(change[1])))
+        elif kind in ('listed', 'unlisted'):
+            delta["all_users"] = list(data["all_users"])
+        elif kind == 'admins':
+            delta["admins"] = list(data["admins"])
+        elif kind == 'meta':
+            delta["meta"] = {k: clone_tree(data.get(k)) for k in SQLiteStore.META_KEYS}
+    return delta
+
+def apply_backup_delta(data, delta):
+    for cat, subs in delta.get("questions", {}).items():
+        for sub, chaps in subs.items():
+            for chap, qs in chaps.items():
+                target = data["questions"].setdefault(cat, {}).setdefault(sub, {})
+                if qs is None: target.pop(chap, None)
+                else: target[chap] = qs
+    for section in ("stats", "user_data", "current_polls", "quiz_sessions", "qstats", "reviews"):
+        for key, value in delta.get(section, {}).items():
+            if value is None: data[section].pop(key, None)
+            else: data[section][key] = value
+    data.update(delta.get("meta", {}))
+    for section in ("admins", "all_users"):
+        if delta.get(section) is not None: data[section] = delta[section]
+    return data
+
+def read_backup_index():
+    try:
+        with open(BACKUP_INDEX, 'r') as f: return json.load(f)
+    except (OSError, ValueError): return []
+
+def write_backup(payload, mode):
+    # Worker thread: serialize, gzip, write atomically, record the manifest and rotate old backups
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    index = read_backup_index()
+    parent = index[-1] if index else None
+    root = None if mode == 'full' else next((m["file"] for m in reversed(index) if m["type"] == 'full'), None)
+    created = time.time()
+    name = f"backup-{time.strftime('%Y%m%d-%H%M%S', time.localtime(created))}{int(created * 1000) % 1000:03d}-{mode}.json.gz"
+    manifest = {"format": 1, "type": mode, "created": created, "parent": None, "root": root}
+    if mode != 'full' and parent: manifest.update(parent=parent["file"], parent_sha256=parent["sha256"])
+    if mode == 'full':
+        data = payload["data"]
+        manifest["counts"] = {"questions": sum(len(qs) for subs in data["questions"].values() for chaps in subs.values() for qs in chaps.values()),
+                              "users": len(data["user_data"]), "admins": len(data["admins"])}
+    body = json.dumps({"manifest": manifest, **payload}, default=json_default).encode('utf-8')
+    blob = gzip.compress(body, compresslevel=6)
+    write_file_atomic(os.path.join(BACKUP_DIR, name), blob)
+    manifest.update(file=name, size=len(blob), raw_size=len(body), sha256=hashlib.sha256(blob).hexdigest())
+    index.append(manifest)
+
+    # Rotation: keep the newest BACKUP_KEEP full backups and the incrementals built on them
+    fulls = [m["file"] for m in index if m["type"] == 'full']
+    keep_roots = set(fulls[-BACKUP_KEEP:])
+    kept = [m for m in index if (m["file"] if m["type"] == 'full' else m["root"]) in keep_roots or m is manifest]
+    for m in index:
+        if m not in kept:
+            try: os.remove(os.path.join(BACKUP_DIR, m["file"]))
+            except OSError: pass
+    write_file_atomic(BACKUP_INDEX, json.dumps(kept, indent=2).encode('utf-8'))
+    return os.path.join(BACKUP_DIR, name), manifest
+
+async def create_backup(mode='full'):
+    async with _backup_lock:
+        if mode == 'incremental' and (WORKERS > 1 or FULL_SYNC in _backup_changes or not any(m["type"] == 'full' for m in read_backup_index())):
+            mode = 'full'
+        changes = list(_backup_changes)
+        _backup_changes.clear()
+        t0 = time.perf_counter()
+        if WORKERS > 1: payload = {"data": normalize_db(await asyncio.to_thread(get_store().load))}   # every worker's rows, as committed
+        elif mode == 'full': payload = {"data": snapshot_db(db)}
+        else: payload = {"delta": snapshot_delta(db, changes)}
+        try: path, manifest = await asyncio.to_thread(write_backup, payload, mode)
+        except Exception:
+            for change in changes: _backup_changes.setdefault(change, None)
+            raise
+        manifest["ms"] = (time.perf_counter() - t0) * 1000
+        BACKUP_STATS.update(count=BACKUP_STATS["count"] + 1, last_type=mode, last_size=manifest["size"],
+                            last_ms=manifest["ms"], last_at=time.time(),
+                            since_full=0 if mode == 'full' else BACKUP_STATS["since_full"] + 1)
+        return path, manifest
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    mode = 'incremental' if 0 < BACKUP_STATS["since_full"] + 1 < BACKUP_FULL_EVERY and BACKUP_STATS["count"] else 'full'
+    try: await create_backup(mode)
+    except Exception as e: logging.error(f"Backup Error: {e}")
+
+def read_backup_file(path):
+    # Accepts a plain database.json (legacy backup) or a .json.gz backup; returns (manifest, body)
+    with open(path, 'rb') as f: raw = f.read()
+    if raw[:2] == b'\x1f\x8b': raw = gzip.decompress(raw)
+    body = json.loads(raw.decode('utf-8'))
+    if isinstance(body, dict) and "manifest" in body: return body["manifest"], body
+    return {"type": "full", "format": 0}, {"data": body}
+
+def format_size(n):
+    for unit in ("B", "KB", "MB"):
+        if n < 1024: return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+async def on_startup(app):
+    ROUTER.compile()
+    WATCHDOG.start(app)
+    QUIZ.start(app)
+    if db.get("broadcast") and WORKER_ID <= 0: start_broadcast_task(app)
+
+async def on_shutdown(app):
+    WATCHDOG.stop()
+    await flush_db()
+
+# ==========================================
+# 3.3 QUESTION INDEX
+# ==========================================
+def to_base36(n):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n: return out
+
+def subject_token(cat, sub):
+    return to_base36(zlib.crc32(f"{cat}\x00{sub}".encode()))
+
+class QuestionIndex:
+    # Deduplicated question ids per (cat, sub, chap) and per subject, so sampling costs O(count)
+    UNION_CACHE_SIZE = 64
+
+    def __init__(self):
+        self.bank = {}        # qid -> question dict (same object as in db["questions"])
+        self.loc = {}         # qid -> (cat, sub, chap)
+        self.chapters = {}    # (cat, sub, chap) -> array of qids, unique by text within the chapter
+        self.subjects = {}    # (cat, sub) -> array of qids, unique by text within the subject
+        self._chap_texts = {} # (cat, sub, chap) -> set of question texts
+        self._sub_texts = {}  # (cat, sub) -> set of question texts
+        self._unions = {}     # (cat, sub) -> {tuple(chaps): array}
+        self._chap_names = {} # (cat, sub) -> set of chapter names
+        self._sorted = {}     # (cat, sub) -> (sorted chapter names, version); dropped when chapters come or go
+        self._sub_tokens = {} # subject token -> (cat, sub)
+
+    def rebuild(self, data):
+        self.__init__()
+        for cat, subs in data["questions"].items():
+            for sub in subs: self.rebuild_subject(data, cat, sub)
+
+    def rebuild_subject(self, data, cat, sub):
+        for key in [k for k in self.chapters if k[:2] == (cat, sub)]:
+            for qid in self.chapters.pop(key):
+                self.bank.pop(qid, None); self.loc.pop(qid, None)
+            self._chap_texts.pop(key, None)
+        # chapter arrays only hold unique texts, so sweep any duplicates left behind
+        for qid in [qid for qid, l in self.loc.items() if l[:2] == (cat, sub)]:
+            self.bank.pop(qid, None); self.loc.pop(qid, None)
+        self._register_subject(cat, sub)
+        self._chap_names[(cat, sub)] = set()
+        self._sorted.pop((cat, sub), None)
+        self._unions.pop((cat, sub), None)
+        for chap, qs in data["questions"].get(cat, {}).get(sub, {}).items():
+            self.add_chapter(cat, sub, chap)
+            for q in qs: self.add(cat, sub, chap, q)
+
+    def _register_subject(self, cat, sub):
+        self.subjects[(cat, sub)] = array('q')
+        self._sub_texts[(cat, sub)] = set()
+        self._sub_tokens[subject_token(cat, sub)] = (cat, sub)
+
+    def add_chapter(self, cat, sub, chap):
+        key = (cat, sub, chap)
+        if key not in self.chapters:
+            self.chapters[key] = array('q')
+            self._chap_texts[key] = set()
+        if (cat, sub) not in self.subjects: self._register_subject(cat, sub)
+        names = self._chap_names.setdefault((cat, sub), set())
+        if chap not in names:
+            names.add(chap)
+            self._sorted.pop((cat, sub), None)
+
+    def add(self, cat, sub, chap, q):
+        key = (cat, sub, chap)
+        self.add_chapter(cat, sub, chap)
+        qid, text = q["id"], q["question"]
+        self.bank[qid] = q
+        self.loc[qid] = key
+        if text not in self._chap_texts[key]:
+            self._chap_texts[key].add(text)
+            self.chapters[key].append(qid)
+        if text not in self._sub_texts[(cat, sub)]:
+            self._sub_texts[(cat, sub)].add(text)
+            self.subjects[(cat, sub)].append(qid)
+        self._unions.pop((cat, sub), None)
+
+    def drop_chapter(self, data, cat, sub, chap):
+        # Removing ids shifts the subject's dedup winners, so rebuild just that subject
+        self.rebuild_subject(data, cat, sub)
+
+    # --- Sorted chapter lists and stateless (subject, version, index) callback tokens ---
+    def chapter_list(self, cat, sub):
+        # (sorted names, version). The version is a hash of the names, so it only moves when an admin
+        # adds or removes a chapter and stays the same across restarts.
+        entry = self._sorted.get((cat, sub))
+        if entry is None:
+            names = tuple(sorted(self._chap_names.get((cat, sub), ())))
+            entry = self._sorted[(cat, sub)] = (names, to_base36(zlib.crc32("\x00".join(names).encode()) & 0xFFFFF))
+        return entry
+
+    def chapter_token(self, cat, sub, idx):
+        return f"{subject_token(cat, sub)}.{self.chapter_list(cat, sub)[1]}.{to_base36(idx)}"
+
+    def resolve_chapter_token(self, token):
+        # -> (cat, sub, chap, idx); chap is None when the list changed since the button was drawn.
+        # None for tokens that don't parse or name an unknown subject.
+        try:
+            sub_tok, version, idx = token.split('.')
+            idx = int(idx, 36)
+        except ValueError: return None
+        key = self._sub_tokens.get(sub_tok)
+        if key is None: return None
+        names, current = self.chapter_list(*key)
+        chap = names[idx] if version == current and idx < len(names) else None
+        return key[0], key[1], chap, idx
+
+    def subject_texts(self, cat, sub):
+        return self._sub_texts.get((cat, sub), set())
+
+    def has_text(self, cat, sub, text):
+        return text in self._sub_texts.get((cat, sub), ())
+
+    def has_questions(self, cat, sub):
+        return bool(self.subjects.get((cat, sub)))
+
+    def pool(self, cat, sub, chapters_list=None):
+        if not chapters_list: return self.subjects.get((cat, sub), array('q'))
+        if len(chapters_list) == 1: return self.chapters.get((cat, sub, chapters_list[0]), array('q'))
+        chaps = tuple(sorted(set(chapters_list)))
+        unions = self._unions.setdefault((cat, sub), {})
+        if chaps not in unions:
+            seen, merged = set(), array('q')
+            for chap in chaps:
+                for qid in self.chapters.get((cat, sub, chap), ()):
+                    text = self.bank[qid]["question"]
+                    if text not in seen:
+                        seen.add(text); merged.append(qid)
+            if len(unions) >= self.UNION_CACHE_SIZE: unions.pop(next(iter(unions)))
+            unions[chaps] = merged
+        return unions[chaps]
+
+    def sample(self, cat, sub, chapters_list, count):
+        ids = self.pool(cat, sub, chapters_list)
+        return random.sample(ids, min(len(ids), count))
+
+QINDEX = QuestionIndex()
+
+# ==========================================
+# 3.4 IN-FLIGHT POLLS
+# ==========================================
+POLL_GRACE = 15           # seconds an answer may still arrive after open_period
+MAX_INFLIGHT_POLLS = int(os.getenv('MAX_INFLIGHT_POLLS', '50000'))
+
+class PollRegistry:
+    # Sent quiz polls waiting for an answer. Entries expire with the poll's open_period;
+    # the persisted record holds only what grading needs so answers survive a restart.
+    def __init__(self):
+        self.polls = {}   # poll_id -> {"cat", "sub", "user", "mode", "qid", "correct", "exp", "sent"}
+        self._heap = []   # (exp, poll_id), stale entries are skipped lazily
+
+    def bind(self, polls):
+        # Adopt db["current_polls"]; drops the legacy backlog (q_data copies, no expiry) and anything expired
+        self.polls = polls
+        now = time.time()
+        dropped = [pid for pid, rec in polls.items() if "exp" not in rec or rec["exp"] <= now]
+        for pid in dropped:
+            del polls[pid]
+            mark_dirty(("poll", pid))
+        if dropped: print(f"🧹 Dropped {len(dropped)} stale polls")
+        self._heap = [(rec["exp"], pid) for pid, rec in polls.items()]
+        heapq.heapify(self._heap)
+
+    def add(self, poll_id, cat, sub, user_id, mode, q, open_period):
+        exp = time.time() + open_period + POLL_GRACE
+        self.polls[poll_id] = {"cat": cat, "sub": sub, "user": user_id, "mode": mode,
+                               "qid": q['id'], "correct": q['correct'], "exp": exp, "sent": round(time.time(), 2)}
+        heapq.heappush(self._heap, (exp, poll_id))
+        mark_dirty(("poll", poll_id))
+        while len(self.polls) > MAX_INFLIGHT_POLLS and self._heap:
+            self._evict(heapq.heappop(self._heap))
+        self.evict_expired()
+
+    def pop(self, poll_id):
+        rec = self.polls.pop(poll_id, None)
+        if rec is not None: mark_dirty(("poll", poll_id))
+        return rec
+
+    def _evict(self, entry):
+        exp, poll_id = entry
+        rec = self.polls.get(poll_id)
+        if rec is not None and rec["exp"] == exp:
+            del self.polls[poll_id]
+            mark_dirty(("poll", poll_id))
+
+    def evict_expired(self, now=None):
+        now = now or time.time()
+        while self._heap and self._heap[0][0] <= now:
+            self._evict(heapq.heappop(self._heap))
+
+    def __len__(self):
+        return len(self.polls)
+
+POLLS = PollRegistry()
+
+async def evict_polls_job(context: ContextTypes.DEFAULT_TYPE):
+    POLLS.evict_expired()
+
+# ==========================================
+# 3.5 STAGED RESTORE
+# ==========================================
+RESTORE = {"staged": None, "previous": None}   # staged: validated db waiting for confirm; previous: rollback copy
+
+def validate_db_payload(data):
+    # Schema check for an uploaded database; raises ValueError describing the first problem
+    if not isinstance(data, dict): raise ValueError("top level must be an object")
+    questions = data.get("questions")
+    if not isinstance(questions, dict): raise ValueError("'questions' must be an object")
+    for cat, subs in questions.items():
+        if not isinstance(subs, dict): raise ValueError(f"questions/{cat} must be an object")
+        for sub, chaps in subs.items():
+            if not isinstance(chaps, dict): raise ValueError(f"questions/{cat}/{sub} must be an object")
+            for chap, qs in chaps.items():
+                if not isinstance(qs, list): raise ValueError(f"chapter '{chap}' must be a list")
+                for i, q in enumerate(qs):
+                    if isinstance(q, Question): continue   # already validated at ingest
+                    where = f"{cat}/{sub}/{chap}#{i + 1}"
+                    if not isinstance(q, dict) or not isinstance(q.get("question"), str): raise ValueError(f"{where}: missing question text")
+                    opts = q.get("options")
+                    if not isinstance(opts, list) or not 2 <= len(opts) <= 10: raise ValueError(f"{where}: needs 2-10 options")
+                    if not isinstance(q.get("correct"), int) or not 0 <= q["correct"] < len(opts): raise ValueError(f"{where}: bad correct index")
+    for key in ("stats", "user_data", "current_polls", "quiz_sessions", "qstats", "reviews"):
+        if not isinstance(data.get(key, {}), dict): raise ValueError(f"'{key}' must be an object")
+    for key in ("admins", "all_users"):
+        values = data.get(key, [])
+        if not isinstance(values, list) or not all(isinstance(v, int) for v in values): raise ValueError(f"'{key}' must be a list of user ids")
+
+def db_counts(data):
+    return {
+        "questions": sum(len(qs) for subs in data["questions"].values() for chaps in subs.values() for qs in chaps.values()),
+        "chapters": sum(len(chaps) for subs in data["questions"].values() for chaps in subs.values()),
+        "users": len(set(data["user_data"]) | {str(u) for u in data["all_users"]}),
+        "admins": len(data["admins"]),
+    }
+
+def load_backup_base(manifest):
+    # State an incremental was taken against: its full root plus every incremental up to its parent,
+    # replayed from BACKUP_DIR with each file checked against the sha256 in the index
+    by_file = {m["file"]: m for m in read_backup_index()}
+    chain, name = [], manifest.get("parent")
+    while True:
+        m = by_file.get(name)
+        if m is None: raise ValueError(f"base backup {name} is not on this server; restore a full backup instead")
+        chain.append(m)
+        if m["type"] == 'full': break
+        name = m["parent"]
+    if manifest.get("parent_sha256", chain[0]["sha256"]) != chain[0]["sha256"]: raise ValueError("base backup does not match (sha256)")
+    if manifest.get("root") != chain[-1]["file"]: raise ValueError("base chain does not lead to the recorded full backup")
+    data = None
+    for m in reversed(chain):
+        path = os.path.join(BACKUP_DIR, m["file"])
+        try:
+            with open(path, 'rb') as f: digest = hashlib.sha256(f.read()).hexdigest()
+        except OSError: raise ValueError(f"base backup {m['file']} is missing from {BACKUP_DIR}")
+        if digest != m["sha256"]: raise ValueError(f"{m['file']} is corrupt (sha256 mismatch)")
+        body = read_backup_file(path)[1]
+        data = body["data"] if m["type"] == 'full' else apply_backup_delta(data, body["delta"])
+    return data
+
+def stage_restore_file(path):
+    # Worker thread: parse, validate and normalize an uploaded backup without touching live state
+    manifest, body = read_backup_file(path)
+    if manifest.get("type") == 'incremental': data = apply_backup_delta(load_backup_base(manifest), body["delta"])
+    else: data = body["data"]
+    validate_db_payload(data)
+    return manifest, normalize_db(data)
+
+def live_qids(data):
+    # Question ids that running quizzes and in-flight polls still point at
+    ids = {rec.get("qid") for rec in data["current_polls"].values()}
+    for rec in data["quiz_sessions"].values(): ids.update(rec["qids"])
+    return ids
+
+def remap_restored_ids(new_db, refs):
+    # A restored question whose id a live quiz or poll uses for a different live question gets a fresh
+    # id, and the restored mistake books, reviews and analytics follow it; the live reference then
+    # points at no question (skipped when sending) instead of grading against the wrong one
+    next_qid = max(new_db["next_qid"], db["next_qid"])
+    remap = {}
+    for subs in new_db["questions"].values():
+        for chaps in subs.values():
+            for qs in chaps.values():
+                for i, q in enumerate(qs):
+                    if q.id not in refs: continue
+                    old = QINDEX.bank.get(q.id)
+                    if old is None or (old.question, old.options, old.correct) == (q.question, q.options, q.correct): continue
+                    remap[q.id] = next_qid
+                    qs[i] = Question(next_qid, q.question, q.options, q.correct)
+                    next_qid += 1
+    new_db["next_qid"] = next_qid
+    if not remap: return 0
+    for ud in new_db["user_data"].values():
+        for subs in ud.get("mistakes", {}).values():
+            for sub, ids in subs.items(): subs[sub] = {remap.get(qid, qid) for qid in ids}
+    for uid, items in new_db["reviews"].items():
+        new_db["reviews"][uid] = {remap.get(qid, qid): st for qid, st in items.items()}
+    new_db["qstats"] = {remap.get(qid, qid): rec for qid, rec in new_db["qstats"].items()}
+    logging.info(f"Restore: {len(remap)} question ids in use by live quizzes renumbered")
+    return len(remap)
+
+def install_db(new_db, persist=True, refs=()):
+    # Atomic swap of the live database. In-flight polls, running quizzes and a running broadcast
+    # belong to the running process, so they carry over. persist=False: new_db is what the store
+    # already holds (a worker reloading after a restore on worker 0). refs: question ids other
+    # workers' quizzes and polls use.
+    global db
+    if persist: remap_restored_ids(new_db, live_qids(db) | set(refs))
+    new_db["current_polls"] = db["current_polls"]
+    new_db["quiz_sessions"] = db["quiz_sessions"]
+    new_db["broadcast"] = db.get("broadcast")
+    new_db["next_qid"] = max(new_db["next_qid"], db["next_qid"])
+    old, db = db, new_db
+    QINDEX.rebuild(db)
+    POLLS.bind(db["current_polls"])
+    QSTATS.bind(db["qstats"])
+    SRS.reset()
+    if persist: mark_dirty()
+    return old
 
 db = load_db()
-save_db(db)
+if DB_BACKEND != 'sqlite': mark_dirty()
+QINDEX.rebuild(db)
+POLLS.bind(db["current_polls"])
+
+# ==========================================
+# 3.6 QUESTION ANALYTICS
+# ==========================================
+ANALYTICS_MIN_ATTEMPTS = int(os.getenv('ANALYTICS_MIN_ATTEMPTS', '10'))   # below this a question is not ranked
+ANSWER_TIME_BUCKETS = [1, 2, 3, 5, 7, 10, 15, 20, 30, 45, 60]             # upper edges (s); one overflow bucket after
+QS_ATTEMPTS, QS_CORRECT, QS_OPTS = 0, 1, 2
+QS_TIMES = QS_OPTS + 10
+QS_LEN = QS_TIMES + len(ANSWER_TIME_BUCKETS) + 1
+
+class QuestionStats:
+    # Per-question counters in one flat uint32 array per qid: attempts, correct, picks per option
+    # and a time-to-answer histogram. An answer is a few increments; per-chapter rankings are
+    # rebuilt only for chapters that received answers since they were last computed.
+    def __init__(self):
+        self.recs = {}        # qid -> array('I', QS_LEN)
+        self.chapters = {}    # (cat, sub, chap) -> {"hardest": [...], "wrong_keys": [...], "answers": n}
+        self.dirty = set()    # chapters whose aggregates are stale
+
+    def bind(self, recs):
+        self.recs = recs
+        self.chapters = {}
+        self.dirty = set(QINDEX.chapters)
+
+    def record(self, qid, selected, correct, seconds=None):
+        if WORKER_ID > 0:
+            # qstats rows have a single writer: other workers hand their answers to worker 0
+            send_to_front(("qstat", qid, selected, correct, seconds)); return
+        rec = self.recs.get(qid)
+        if rec is None: rec = self.recs[qid] = array('I', [0]) * QS_LEN
+        rec[QS_ATTEMPTS] += 1
+        if selected == correct: rec[QS_CORRECT] += 1
+        if 0 <= selected < 10: rec[QS_OPTS + selected] += 1
+        if seconds is not None: rec[QS_TIMES + bisect.bisect_left(ANSWER_TIME_BUCKETS, seconds)] += 1
+        loc = QINDEX.loc.get(qid)
+        if loc: self.dirty.add(loc)
+        mark_dirty(("qstat", qid))
+
+    @staticmethod
+    def median_seconds(rec):
+        # Midpoint of the histogram bucket holding the median answer
+        timed = sum(rec[QS_TIMES:QS_LEN])
+        if not timed: return None
+        half, seen = (timed + 1) // 2, 0
+        for i in range(QS_LEN - QS_TIMES):
+            seen += rec[QS_TIMES + i]
+            if seen >= half:
+                lo = ANSWER_TIME_BUCKETS[i - 1] if i else 0
+                hi = ANSWER_TIME_BUCKETS[i] if i < len(ANSWER_TIME_BUCKETS) else lo * 1.5
+                return (lo + hi) / 2
+
+    def _aggregate(self, key):
+        rows, answers = [], 0
+        for qid in QINDEX.chapters.get(key, ()):
+            rec = self.recs.get(qid)
+            if rec is None: continue
+            answers += rec[QS_ATTEMPTS]
+            if rec[QS_ATTEMPTS] < ANALYTICS_MIN_ATTEMPTS: continue
+            q = QINDEX.bank[qid]
+            picks = list(rec[QS_OPTS:QS_OPTS + len(q.options)])
+            top = max(range(len(picks)), key=picks.__getitem__)
+            rows.append((rec[QS_CORRECT] / rec[QS_ATTEMPTS], qid, top, picks[top] / rec[QS_ATTEMPTS]))
+        rows.sort()
+        # Suspected wrong key: most answers agree on one option that isn't the keyed one
+        wrong = [(qid, top, share) for rate, qid, top, share in rows if top != QINDEX.bank[qid].correct and share >= 0.5]
+        self.chapters[key] = {"hardest": [(qid, rate) for rate, qid, _, _ in rows[:5]], "wrong_keys": wrong[:5], "answers": answers}
+
+    def chapter_report(self, cat, sub, chap):
+        key = (cat, sub, chap)
+        if key in self.dirty or key not in self.chapters:
+            self.dirty.discard(key)
+            self._aggregate(key)
+        return self.chapters[key]
+
+    def refresh(self):
+        while self.dirty: self._aggregate(self.dirty.pop())
+
+QSTATS = QuestionStats()
+QSTATS.bind(db["qstats"])
+
+async def analytics_job(context: ContextTypes.DEFAULT_TYPE):
+    QSTATS.refresh()
 
 # ==========================================
 # 4. HELPER FUNCTIONS
@@ -115,60 +1680,234 @@ save_db(db)
 def is_admin(user_id):
     return user_id in db["admins"] or user_id == OWNER_ID
 
-def esc(text):
-    if not text: return ""
-    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-
 def get_random_questions(category, subject, chapters_list, count=10):
-    all_q = []
-    if not chapters_list:
-        chapters_data = db["questions"].get(category, {}).get(subject, {})
-        for chap in chapters_data:
-            all_q.extend(chapters_data[chap])
-    else:
-        for chap in chapters_list:
-            qs = db["questions"].get(category, {}).get(subject, {}).get(chap, [])
-            all_q.extend(qs)
-    
-    if not all_q: return []
-    unique_q = list({q['question']: q for q in all_q}.values())
-    return random.sample(unique_q, min(len(unique_q), count))
+    return [QINDEX.bank[qid] for qid in QINDEX.sample(category, subject, chapters_list, count)]
+
+def get_mistake_targets(category, subject):
+    if category == "BSEB" and subject == "Hindi":
+        return ["Hindi-Gadya", "Hindi-Padya", "Hindi-Grammar", "Hindi-PYQ", "Hindi-YouTube"]
+    if category == "BSEB" and subject == "English":
+        return ["English-Prose", "English-Poetry", "English-Grammar", "English-PYQ", "English-YouTube"]
+    if subject in ["Physics", "Chemistry", "Biology", "Maths"]:
+        return [subject, f"{subject}-PYQ", f"{subject}-YouTube"]
+    if subject != "Any": return [subject]
+    return []
+
+SRS_INTERVALS = [float(d) * 86400 for d in os.getenv('SRS_INTERVALS_DAYS', '1,3,7,21').split(',')]
+SRS_CACHE_SIZE = int(os.getenv('SRS_CACHE_SIZE', '10000'))   # users whose review heaps stay in memory
+
+class ReviewScheduler:
+    # Leitner boxes for the mistake book. A new or failed question sits in box 0 and is due at once;
+    # each correct review moves it up a box, due again after SRS_INTERVALS[box - 1], and a correct
+    # answer from the last box clears it from the book. db["reviews"][uid][qid] = [box, due]; rows
+    # missing there (older mistake books) count as box 0, due now.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.heaps = OrderedDict()   # uid -> {(cat, sub): [(due, qid)]}, LRU; built on first use, stale entries skipped lazily
+
+    def reset(self):
+        self.heaps = OrderedDict()
+
+    def _mistakes(self, uid):
+        return db["user_data"].get(uid, {}).get("mistakes", {})
+
+    def _state(self, uid, qid):
+        return db["reviews"].get(uid, {}).get(qid, (0, 0.0))
+
+    def _heaps(self, uid):
+        h = self.heaps.get(uid)
+        if h is not None:
+            self.heaps.move_to_end(uid)
+        else:
+            # Evicted (or never built): rebuilt from db["reviews"], which stays the source of truth
+            h = self.heaps[uid] = {}
+            while len(self.heaps) > self.max_size: self.heaps.popitem(last=False)
+            for cat, subs in self._mistakes(uid).items():
+                for sub, ids in subs.items():
+                    heap = [(self._state(uid, qid)[1], qid) for qid in ids]
+                    heapq.heapify(heap)
+                    h[(cat, sub)] = heap
+        return h
+
+    def _live(self, uid, cat, sub, entry):
+        due, qid = entry
+        return qid in self._mistakes(uid).get(cat, {}).get(sub, ()) and qid in QINDEX.bank and self._state(uid, qid)[1] == due
+
+    def _sections(self, uid, cat, subject):
+        targets = get_mistake_targets(cat, subject) or list(self._mistakes(uid).get(cat, {}))
+        heaps = self._heaps(uid)
+        return [(sub, heaps[(cat, sub)]) for sub in targets if heaps.get((cat, sub))]
+
+    def due(self, user_id, cat, subject, count, now=None):
+        # Up to `count` due ids, most overdue first, in O(k log n). Picked entries go straight back
+        # on the heap: they stay scheduled until an answer moves them.
+        uid, now = str(user_id), now or time.time()
+        sections = self._sections(uid, cat, subject)
+        picked, seen = [], set()
+        while len(picked) < count:
+            best = None
+            for sub, heap in sections:
+                while heap and not self._live(uid, cat, sub, heap[0]): heapq.heappop(heap)
+                if heap and heap[0][0] <= now and (best is None or heap[0] < best[0]): best = heap
+            if best is None: break
+            entry = heapq.heappop(best)
+            if entry[1] not in seen: seen.add(entry[1]); picked.append((best, entry))
+        for heap, entry in picked: heapq.heappush(heap, entry)
+        return [entry[1] for _, entry in picked]
+
+    def count_due(self, user_id, cat, subject, now=None):
+        # Walks only the part of each heap that is already due
+        uid, now = str(user_id), now or time.time()
+        n = 0
+        for sub, heap in self._sections(uid, cat, subject):
+            stack = [0]
+            while stack:
+                i = stack.pop()
+                if i >= len(heap) or heap[i][0] > now: continue
+                if self._live(uid, cat, sub, heap[i]): n += 1
+                stack += (2 * i + 1, 2 * i + 2)
+        return n
+
+    def next_due(self, user_id, cat, subject):
+        uid = str(user_id)
+        tops = []
+        for sub, heap in self._sections(uid, cat, subject):
+            while heap and not self._live(uid, cat, sub, heap[0]): heapq.heappop(heap)
+            if heap: tops.append(heap[0][0])
+        return min(tops) if tops else None
+
+    def _schedule(self, uid, cat, sub, qid, box, due):
+        db["reviews"].setdefault(uid, {})[qid] = [box, due]
+        h = self.heaps.get(uid)
+        if h is not None: heapq.heappush(h.setdefault((cat, sub), []), (due, qid))
+        return ("review", uid, qid)
+
+    def add(self, user_id, cat, sub, qid):
+        # A wrong answer in a normal quiz: (re)enters box 0
+        return self._schedule(str(user_id), cat, sub, qid, 0, time.time())
+
+    def answer(self, user_id, cat, subject, qid, correct):
+        # An improve-mode answer; returns the change tags to persist
+        uid = str(user_id)
+        user_mistakes = self._mistakes(uid).get(cat, {})
+        sections = [t for t in get_mistake_targets(cat, subject) or list(user_mistakes) if qid in user_mistakes.get(t, ())]
+        if not sections: return []
+        box = self._state(uid, qid)[0] + 1 if correct else 0
+        if box > len(SRS_INTERVALS):
+            db["reviews"].get(uid, {}).pop(qid, None)
+            changes = [("review", uid, qid)]
+            for t in sections:
+                user_mistakes[t].discard(qid); changes.append(("mistake", uid, cat, t, qid))
+            return changes
+        due = time.time() + (SRS_INTERVALS[box - 1] if box else 0)
+        return [self._schedule(uid, cat, t, qid, box, due) for t in sections]
+
+SRS = ReviewScheduler(SRS_CACHE_SIZE)
+
+def format_wait(seconds):
+    if seconds < 3600: return f"{max(1, int(seconds // 60))}m"
+    if seconds < 86400: return f"{int(seconds // 3600)}h"
+    return f"{int(seconds // 86400)}d {int(seconds % 86400 // 3600)}h"
+
+MEMBER_TTL_POS = int(os.getenv('MEMBER_TTL_POS', '900'))   # seconds a "joined" answer is trusted
+MEMBER_TTL_NEG = int(os.getenv('MEMBER_TTL_NEG', '30'))    # "not joined" expires quickly
+MEMBER_CACHE_SIZE = int(os.getenv('MEMBER_CACHE_SIZE', '50000'))
+
+class MembershipCache:
+    # (chat_id, user_id) -> (is_member, expires_at), LRU-bounded; concurrent misses share one API call
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = self.misses = self.coalesced = 0
+
+    async def check(self, bot, chat_id, user_id, force=False):
+        key = (chat_id, user_id)
+        if not force:
+            entry = self.entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        fut = self.inflight.get(key)
+        if fut:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self.inflight[key] = fut
+        result = False
+        try:
+            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+            result = member.status not in ['left', 'kicked', 'banned']
+            self.entries[key] = (result, time.monotonic() + (MEMBER_TTL_POS if result else MEMBER_TTL_NEG))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size: self.entries.popitem(last=False)
+        except Exception: pass   # API errors count as "not joined" but are not cached
+        finally:
+            self.inflight.pop(key, None)
+            fut.set_result(result)
+        return result
+
+MEMBERSHIP = MembershipCache(MEMBER_CACHE_SIZE)
+
+PROFILE_TTL = int(os.getenv('PROFILE_TTL', '21600'))
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '100000'))
+PROFILE_FETCH_CONCURRENCY = 8
+
+class ProfileDirectory:
+    # user_id -> (username, first_name, expires_at). Filled from every incoming update,
+    # so get_chat is only needed for users we have not heard from recently.
+    def __init__(self, ttl, max_size):
+        self.ttl, self.max_size = ttl, max_size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def remember(self, user_id, username, first_name):
+        self.entries[user_id] = (username, first_name, time.monotonic() + self.ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size: self.entries.popitem(last=False)
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry and entry[2] > time.monotonic(): return entry
+        return None
+
+    def label(self, user_id):
+        entry = self.get(user_id)
+        if not entry: return None
+        return entry[0] or entry[1]
+
+    async def resolve(self, bot, user_ids):
+        missing = []
+        for uid in user_ids:
+            if self.get(uid): self.hits += 1
+            else: missing.append(uid)
+        self.misses += len(missing)
+        sem = asyncio.Semaphore(PROFILE_FETCH_CONCURRENCY)
+
+        async def fetch(uid):
+            async with sem:
+                try:
+                    chat = await bot.get_chat(uid)
+                    self.remember(uid, chat.username, chat.first_name)
+                except TelegramError: pass
+        await asyncio.gather(*(fetch(uid) for uid in missing))
 
-def get_mistake_questions(user_id, category, subject):
-    try:
-        user_mistakes = db["user_data"].get(str(user_id), {}).get("mistakes", {}).get(category, {})
-        all_mistakes = []
-        targets = []
-        
-        if category == "BSEB" and subject == "Hindi":
-            targets = ["Hindi-Gadya", "Hindi-Padya", "Hindi-Grammar", "Hindi-PYQ", "Hindi-YouTube"]
-        elif category == "BSEB" and subject == "English":
-            targets = ["English-Prose", "English-Poetry", "English-Grammar", "English-PYQ", "English-YouTube"]
-        elif subject in ["Physics", "Chemistry", "Biology", "Maths"]:
-             targets = [subject, f"{subject}-PYQ", f"{subject}-YouTube"]
-        elif subject != "Any":
-            targets = [subject]
-        
-        if targets:
-            for t in targets:
-                qs = user_mistakes.get(t, [])
-                all_mistakes.extend(qs)
-            return all_mistakes
-        
-        for sub, qs in user_mistakes.items():
-            all_mistakes.extend(qs)
-        return all_mistakes
-    except: return []
+PROFILES = ProfileDirectory(PROFILE_TTL, PROFILE_CACHE_SIZE)
 
-async def check_membership(chat_id, user_id, context):
-    try:
-        member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-        if member.status in ['left', 'kicked', 'banned']: return False
-        return True
-    except: return False
+async def record_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user: PROFILES.remember(user.id, user.username, user.first_name)
+    for kind in UPDATE_TYPES:
+        if getattr(update, kind) is not None:
+            UPDATES.inc((kind,)); break
+
+async def check_membership(chat_id, user_id, context, force=False):
+    return await MEMBERSHIP.check(context.bot, chat_id, user_id, force)
 
-async def check_gate(query, context, gid, link, success_cb, cb_data):
-    if await check_membership(gid, query.from_user.id, context):
+async def check_gate(query, context, gid, link, success_cb, cb_data, force=False):
+    if await check_membership(gid, query.from_user.id, context, force):
         await success_cb(query, context)
     else:
         btns = [[InlineKeyboardButton("🚀 Join Group", url=link)], [InlineKeyboardButton("✅ I have Joined", callback_data=cb_data)]]
@@ -182,10 +1921,10 @@ async def send_force_join_msg(update, link):
     else: 
         await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(btns), parse_mode='HTML')
 
-async def send_main_menu_direct(context, chat_id, user_id):
+async def send_main_menu_direct(bot, chat_id, user_id):
     try:
         btns = [[InlineKeyboardButton("📚 BSEB (Bihar Board)", callback_data='gate_bseb')], [InlineKeyboardButton("⚙️ Menu", callback_data='main_menu')]]
-        await context.bot.send_message(chat_id, "🏠 <b>Main Menu:</b>", reply_markup=InlineKeyboardMarkup(btns), parse_mode='HTML')
+        await bot.send_message(chat_id, "🏠 <b>Main Menu:</b>", reply_markup=InlineKeyboardMarkup(btns), parse_mode='HTML')
     except: pass
 
 async def safe_edit_message(query, text, reply_markup=None):
@@ -213,66 +1952,277 @@ async def send_maintenance_msg(update):
 # ==========================================
 # 5. CORE QUIZ ENGINE
 # ==========================================
-async def run_quiz_sequence(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    job_data = job.data 
-    chat_id = job.chat_id
-    user_id = job_data['u']
-    
-    if not context.user_data and context.user_data is not {}: return
-    if 'futures' not in context.user_data: context.user_data['futures'] = {}
-        
-    context.user_data['quiz_active'] = True
-
-    for i, q in enumerate(job_data['q']):
-        if context.user_data.get('stop_quiz_flag'): 
-            await context.bot.send_message(chat_id, "🛑 <b>Quiz Aborted!</b>\nReturning to menu...", parse_mode='HTML')
-            await send_main_menu_direct(context, chat_id, user_id)
-            context.user_data['quiz_active'] = False
-            context.user_data['stop_quiz_flag'] = False
-            if context.user_data: context.user_data.pop('futures', None) 
-            return
-
+ANSWER_GRACE = 2      # extra seconds after open_period before a question counts as timed out
+GROUP_MAX_QUESTIONS = 50
+GROUP_BOARD_SIZE = 10
+NEXT_QUESTION_DELAY = 0.5
+QUIZ_RESUME_MAX_AGE = float(os.getenv('QUIZ_RESUME_HOURS', '6')) * 3600   # older checkpoints are dropped on startup
+
+class QuizSession:
+    # Compact per-quiz state; the scheduler owns every active session
+    __slots__ = ("sid", "chat_id", "user_id", "cat", "sub", "mode", "t", "qids", "cursor",
+                 "poll_id", "message_id", "deadline", "seq", "board", "resend")
+
+    def __init__(self, sid, chat_id, user_id, cat, sub, mode, t, qids):
+        self.sid, self.chat_id, self.user_id = sid, chat_id, user_id
+        self.cat, self.sub, self.mode, self.t = cat, sub, mode, t
+        self.qids = qids
+        self.cursor = 0          # index of the question in flight / next to send
+        self.poll_id = None      # set while waiting for an answer
+        self.message_id = None
+        self.deadline = None
+        self.seq = 0             # bumps on every reschedule; stale heap entries are skipped
+        self.board = {} if mode == 'group' else None   # group quizzes: uid -> [correct, answered, total_ms]
+        self.resend = False      # resumed with a poll that closed during the restart: unanswered -> send it again
+
+    @property
+    def key(self):
+        # Private quizzes are one per user; a group runs one quiz per chat
+        return self.chat_id if self.mode == 'group' else self.user_id
+
+class QuizScheduler:
+    # One task and one heap of deadlines drive every running quiz. A deadline either sends the
+    # next question or times out the one in flight; private answers advance sessions directly.
+    # Group quizzes only move on the timer and buffer their answers per poll until it closes.
+    def __init__(self):
+        self.sessions = {}   # sid -> QuizSession
+        self.by_user = {}    # session key (user id, or chat id for groups) -> sid
+        self.by_poll = {}    # poll_id -> sid
+        self.buffers = {}    # group poll_id -> {user_id: (selected, seconds)}
+        self.heap = []       # (deadline, seq, sid)
+        self.bot = None
+        self.task = None
+        self._wake = asyncio.Event()
+        self._next_sid = 1
+        self.stats = {"started": 0, "completed": 0, "aborted": 0, "resumed": 0, "sent": 0, "timeouts": 0,
+                      "fired": 0, "lag_last_ms": 0.0, "lag_max_ms": 0.0, "lag_total_ms": 0.0}
+
+    def start(self, application):
+        self.bot = application.bot
+        self.resume()
+        self.task = application.create_task(self._run())
+
+    # --- Checkpoints: the full row once per quiz, then a constant-size cursor update per question ---
+    def _checkpoint_new(self, s):
+        db["quiz_sessions"][str(s.sid)] = {"user": s.user_id, "chat": s.chat_id, "cat": s.cat, "sub": s.sub, "mode": s.mode,
+                                           "t": s.t, "qids": list(s.qids), "cursor": s.cursor, "poll": None, "msg": None,
+                                           "at": time.time(), "board": s.board}
+        mark_dirty(("quiz", str(s.sid)))
+
+    def _checkpoint(self, s):
+        rec = db["quiz_sessions"].get(str(s.sid))
+        if rec is None: return
+        rec["cursor"], rec["poll"], rec["msg"], rec["at"], rec["board"] = s.cursor, s.poll_id, s.message_id, time.time(), s.board
+        mark_dirty(("quiz_cursor", str(s.sid)))
+
+    def resume(self):
+        # Rebuild sessions from checkpoints. A poll that is still open keeps waiting for its answer;
+        # otherwise the pending question is sent again.
+        now = time.time()
+        resumed = 0
+        # Worker mode loads only this worker's sessions; sids stay clear of every worker's
+        if WORKERS > 1: self._next_sid = max(self._next_sid, get_store().max_quiz_sid() + 1)
+        for key, rec in sorted(db["quiz_sessions"].items(), key=lambda kv: kv[1]["at"]):
+            self._next_sid = max(self._next_sid, int(key) + 1)
+            if now - rec["at"] > QUIZ_RESUME_MAX_AGE or rec["cursor"] >= len(rec["qids"]):
+                del db["quiz_sessions"][key]
+                mark_dirty(("quiz", key))
+                continue
+            sid = int(key)
+            s = QuizSession(sid, rec["chat"], rec["user"], rec["cat"], rec["sub"], rec["mode"], rec["t"], array('q', rec["qids"]))
+            s.cursor = rec["cursor"]
+            if s.board is not None: s.board = rec.get("board") or {}
+            if s.key in self.by_user: self._drop(self.sessions[self.by_user[s.key]])
+            self.sessions[sid] = s
+            self.by_user[s.key] = sid
+            poll = POLLS.polls.get(rec["poll"]) if rec["poll"] else None
+            if poll:
+                # Still open, or closed during the restart with an answer possibly still queued: the poll
+                # stays answerable for ANSWER_GRACE before the question is sent again
+                open_left = max(0, poll["exp"] - POLL_GRACE - now)
+                s.poll_id, s.message_id = rec["poll"], rec["msg"]
+                s.resend = not open_left and s.board is None
+                self.by_poll[s.poll_id] = sid
+                self.schedule(s, open_left + ANSWER_GRACE + resumed * 0.05)
+            else:
+                self.schedule(s, 1 + resumed * 0.05)   # staggered so a big resume doesn't burst the API
+                asyncio.create_task(self._notify_resume(s))
+            resumed += 1
+        self.stats["resumed"] = resumed
+        if resumed: print(f"♻️ Resumed {resumed} quiz sessions")
+
+    async def _notify_resume(self, s):
+        try: await self.bot.send_message(s.chat_id, f"♻️ <b>Bot restarted</b> — resuming your quiz from question {s.cursor + 1}/{len(s.qids)}.", parse_mode='HTML')
+        except TelegramError: pass
+
+    def active(self, user_id):
+        return user_id in self.by_user
+
+    def schedule(self, s, delay):
+        s.seq += 1
+        s.deadline = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self.heap, (s.deadline, s.seq, s.sid))
+        if self.heap[0][1] == s.seq and self.heap[0][2] == s.sid: self._wake.set()
+
+    def begin(self, chat_id, user_id, cat, sub, mode, t, qids, delay=1):
+        sid = self._next_sid
+        if WORKERS > 1: sid += (WORKER_ID - sid) % WORKERS   # worker k only hands out sids = k (mod WORKERS)
+        self._next_sid = sid + 1
+        s = QuizSession(sid, chat_id, user_id, cat, sub, mode, t, array('q', qids))
+        if s.key in self.by_user: self._drop(self.sessions[self.by_user[s.key]])
+        self.sessions[sid] = s
+        self.by_user[s.key] = sid
+        self.stats["started"] += 1
+        self._checkpoint_new(s)
+        self.schedule(s, delay)
+        return s
+
+    def _drop(self, s):
+        self.sessions.pop(s.sid, None)
+        if self.by_user.get(s.key) == s.sid: self.by_user.pop(s.key, None)
+        if s.poll_id: self.by_poll.pop(s.poll_id, None)
+        s.seq += 1
+        if db["quiz_sessions"].pop(str(s.sid), None) is not None: mark_dirty(("quiz", str(s.sid)))
+
+    async def _run(self):
         loop = asyncio.get_running_loop()
-        future = loop.create_future()
-        poll_id = None
-        
+        while True:
+            now = loop.time()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, seq, sid = heapq.heappop(self.heap)
+                s = self.sessions.get(sid)
+                if s is None or s.seq != seq: continue
+                lag_ms = (now - deadline) * 1000
+                st = self.stats
+                st["fired"] += 1; st["lag_last_ms"] = lag_ms; st["lag_total_ms"] += lag_ms
+                st["lag_max_ms"] = max(st["lag_max_ms"], lag_ms)
+                s.deadline = None
+                if s.poll_id and s.resend:
+                    # resumed poll got no late answer: send the same question again
+                    self.by_poll.pop(s.poll_id, None); POLLS.pop(s.poll_id)
+                    s.poll_id = None; s.resend = False
+                    asyncio.create_task(self._notify_resume(s))
+                elif s.poll_id:
+                    # no answer before open_period ran out (group polls always close this way)
+                    if s.board is not None: self._close_group_poll(s)
+                    else: st["timeouts"] += 1
+                    self.by_poll.pop(s.poll_id, None)
+                    s.poll_id = None; s.cursor += 1
+                    self._checkpoint(s)
+                asyncio.create_task(self._send_next(s))
+            self._wake.clear()
+            timeout = self.heap[0][0] - loop.time() if self.heap else None
+            try: await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError: pass
+
+    async def _send_next(self, s):
+        while s.cursor < len(s.qids) and s.qids[s.cursor] not in QINDEX.bank: s.cursor += 1
+        if s.cursor >= len(s.qids):
+            await self._finish(s); return
+        q = QINDEX.bank[s.qids[s.cursor]]
         try:
-            safe_options = [str(opt).replace('<', '').replace('>', '') for opt in q['options']]
-            msg = await context.bot.send_poll(
-                chat_id=chat_id, 
-                question=f"[{i+1}/{len(job_data['q'])}] {esc(q['question'])}", 
-                options=safe_options, 
-                correct_option_id=q['correct'], 
+            msg = await self.bot.send_poll(
+                chat_id=s.chat_id, 
+                question=f"[{s.cursor+1}/{len(s.qids)}] {q.poll_text}", 
+                options=q.poll_options, 
+                correct_option_id=q.correct, 
                 type='quiz', 
-                open_period=job_data['t'], 
+                open_period=s.t, 
                 is_anonymous=False,
                 protect_content=True  # <--- FORWARDING DISABLED HERE
             )
-            poll_id = str(msg.poll.id)
-            context.user_data['futures'][poll_id] = future
-            
-            if "current_polls" not in db: db["current_polls"] = {}
-            db["current_polls"][poll_id] = {
-                "cat": job_data['c'], "sub": job_data['s'], "user": user_id, "mode": job_data['mode'], "q_data": q
-            }
-            
-            try: await asyncio.wait_for(future, timeout=job_data['t'] + 2)
-            except: pass
-            await asyncio.sleep(0.5) 
-        except Exception as e: 
-            print(f"Quiz Loop Error: {e}")
-            await asyncio.sleep(2)
-            continue
-        
-        if poll_id and poll_id in context.user_data['futures']:
-             context.user_data['futures'].pop(poll_id, None)
+        except RetryAfter as e:
+            if s.sid in self.sessions: self.schedule(s, retry_after_seconds(e) + 1)   # same question, later
+            return
+        except Forbidden as e:
+            # Blocked bot or kicked from the group: the rest of the quiz can't be delivered either
+            logging.warning(f"Quiz {s.sid} dropped: {e}")
+            if s.sid in self.sessions:
+                self._drop(s); self.stats["aborted"] += 1
+            return
+        except Exception as e:
+            # A question Telegram refuses (BadRequest), a network error or a bug: skip it and carry on
+            if isinstance(e, TelegramError): logging.error(f"Quiz Loop Error: {e}")
+            else: logging.exception(f"Quiz Loop Error: {e}")
+            if s.sid in self.sessions:
+                s.cursor += 1
+                self._checkpoint(s)
+                self.schedule(s, 2)
+            return
+        poll_id = str(msg.poll.id)
+        POLLS.add(poll_id, s.cat, s.sub, s.user_id, s.mode, q, s.t)
+        # Worker mode: the front learns which worker holds the poll (group answers come from everyone)
+        if WORKERS > 1: send_to_front(("poll", poll_id, WORKER_ID))
+        self.stats["sent"] += 1
+        if s.sid not in self.sessions: return   # aborted while the poll was being sent
+        s.poll_id, s.message_id, s.resend = poll_id, msg.message_id, False
+        self.by_poll[poll_id] = s.sid
+        self._checkpoint(s)
+        self.schedule(s, s.t + ANSWER_GRACE)
+
+    def on_answer(self, poll_id):
+        s = self.sessions.get(self.by_poll.get(poll_id))
+        if s is None or s.poll_id != poll_id or s.board is not None: return
+        del self.by_poll[poll_id]
+        s.poll_id = None; s.cursor += 1
+        self._checkpoint(s)
+        asyncio.create_task(self._stop_poll(s.chat_id, s.message_id))
+        self.schedule(s, NEXT_QUESTION_DELAY)
+
+    async def _stop_poll(self, chat_id, message_id):
+        try: await self.bot.stop_poll(chat_id, message_id)
+        except TelegramError: pass
+
+    def buffer_answer(self, poll_id, user_id, selected, seconds):
+        # O(1) per group answer; nothing is written until the poll closes
+        self.buffers.setdefault(poll_id, {}).setdefault(user_id, (selected, seconds))
+
+    def _close_group_poll(self, s):
+        answers = self.buffers.pop(s.poll_id, {})
+        p_data = POLLS.pop(s.poll_id)
+        if p_data: apply_group_answers(p_data, answers, s)
+
+    async def _finish(self, s):
+        self._drop(s)
+        self.stats["completed"] += 1
+        try:
+            if s.board is not None:
+                await self.bot.send_message(s.chat_id, format_scoreboard(s, "🏁 <b>Group Quiz Finished!</b>"), parse_mode='HTML')
+                return
+            await self.bot.send_message(s.chat_id, "🏁 <b>Quiz Completed!</b>\nCheck 'Improve Mistakes' if you got any wrong.", parse_mode='HTML')
+            await send_main_menu_direct(self.bot, s.chat_id, s.user_id)
+        except TelegramError as e: logging.warning(f"Quiz {s.sid} finish message failed: {e}")
+
+    async def abort(self, user_id):
+        sid = self.by_user.get(user_id)
+        s = self.sessions.get(sid)
+        if s is None: return False
+        self._drop(s)
+        self.stats["aborted"] += 1
+        if s.message_id and s.poll_id: asyncio.create_task(self._stop_poll(s.chat_id, s.message_id))
+        if s.board is not None and s.poll_id: self._close_group_poll(s)
+        try:
+            if s.board is not None:
+                await self.bot.send_message(s.chat_id, format_scoreboard(s, "🛑 <b>Group Quiz Stopped</b>"), parse_mode='HTML')
+                return True
+            await self.bot.send_message(s.chat_id, "🛑 <b>Quiz Aborted!</b>\nReturning to menu...", parse_mode='HTML')
+            await send_main_menu_direct(self.bot, s.chat_id, s.user_id)
+        except TelegramError as e: logging.warning(f"Quiz {s.sid} abort message failed: {e}")
+        return True
 
-    await context.bot.send_message(chat_id, "🏁 <b>Quiz Completed!</b>\nCheck 'Improve Mistakes' if you got any wrong.", parse_mode='HTML')
-    context.user_data['quiz_active'] = False
-    if context.user_data: context.user_data.pop('futures', None)
-    save_db(db)
-    await send_main_menu_direct(context, chat_id, user_id)
+QUIZ = QuizScheduler()
+
+def format_scoreboard(s, title):
+    # Rank by correct answers, then by total answer time
+    ranked = sorted(s.board.items(), key=lambda kv: (-kv[1][0], kv[1][2]))
+    txt = f"{title}\n📚 {esc(s.sub)} • {len(s.qids)} questions • {len(ranked)} players\n"
+    medals = ["🥇", "🥈", "🥉"]
+    for i, (uid, (correct, answered, total_ms)) in enumerate(ranked[:GROUP_BOARD_SIZE]):
+        name = PROFILES.label(int(uid)) or f"User {uid}"
+        avg = total_ms / answered / 1000 if answered else 0
+        txt += f"\n{medals[i] if i < 3 else f'{i + 1}.'} {esc(name)} — {correct}/{answered} (avg {avg:.1f}s)"
+    if not ranked: txt += "\nNo answers this time."
+    return txt
 
 async def start_private_quiz(query, context):
     cat = context.user_data.get('quiz_cat')
@@ -281,19 +2231,14 @@ async def start_private_quiz(query, context):
     req_count = context.user_data.get('quiz_count', 10)
     mode = context.user_data.get('quiz_mode', 'normal')
     
-    context.user_data['stop_quiz_flag'] = False
-    context.user_data['quiz_active'] = True
-    
     questions = []
     
     if mode == 'improve':
-        mistakes = get_mistake_questions(query.from_user.id, cat, sub)
-        if not mistakes:
-            await safe_edit_message(query, "🎉 <b>No mistakes found!</b>\nGood job!", InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Menu", callback_data='main_menu')]]))
+        questions = [QINDEX.bank[qid] for qid in SRS.due(query.from_user.id, cat, sub, req_count)]
+        if not questions:
+            await safe_edit_message(query, "🎉 <b>No reviews due!</b>\nGood job!", InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Menu", callback_data='main_menu')]]))
             return
-        random.shuffle(mistakes)
-        questions = mistakes[:req_count]
-        await safe_edit_message(query, esc(f"🚀 Improving Mistakes...\nTopic: {sub}\nCount: {len(questions)}"), None)
+        await safe_edit_message(query, esc(f"🚀 Improving Mistakes...\nTopic: {sub}\nDue reviews: {len(questions)}"), None)
     else:
         chaps = context.user_data.get('final_chapters')
         questions = get_random_questions(cat, sub, chaps, req_count)
@@ -303,8 +2248,118 @@ async def start_private_quiz(query, context):
             return
         await safe_edit_message(query, esc(f"🚀 Starting Quiz...\nTopic: {disp_sub}"), None)
     
-    data_packet = {'q': questions, 't': time_limit, 'u': query.from_user.id, 'c': cat, 's': sub, 'mode': mode, 'stop': False}
-    context.job_queue.run_once(run_quiz_sequence, 1, chat_id=query.message.chat_id, user_id=query.from_user.id, data=data_packet)
+    QUIZ.begin(query.message.chat_id, query.from_user.id, cat, sub, mode, time_limit, [q['id'] for q in questions])
+
+# ==========================================
+# 5.1 BROADCAST ENGINE
+# ==========================================
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))        # msgs/sec (Telegram allows ~30 globally)
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_CHUNK = 200                                             # users per persisted cursor step
+BROADCAST_PROGRESS_EVERY = 5                                      # seconds between progress edits
+BROADCAST = {"task": None, "stop": False}
+
+class TokenBucket:
+    # Spaces sends to `rate`/s with up to `burst` back-to-back; pause() blocks everyone after a RetryAfter
+    def __init__(self, rate, burst=1):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now); continue
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1; return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def retry_after_seconds(e):
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, 'total_seconds') else float(ra)
+
+async def broadcast_targets():
+    # Worker mode: users register on their own worker, so the listed set comes from the store
+    users = await asyncio.to_thread(get_store().listed_users) if WORKERS > 1 else db.get("all_users", [])
+    if not users: users = list(map(int, db["stats"].keys()))
+    return sorted(set(users))
+
+def broadcast_progress_text(job, final=False):
+    done = job["sent"] + job["failed"] + len(job["blocked"])
+    elapsed = max(time.time() - job["started"], 1e-6)
+    rate = done / elapsed
+    left = max(job["total"] - done, 0)
+    head = "✅ <b>Broadcast Done.</b>" if final else "📢 <b>Broadcasting...</b>"
+    if final and job.get("stopped"): head = "⏹️ <b>Broadcast Stopped.</b>"
+    by = PROFILES.label(job.get("by"))
+    if by: head += f"\n👤 By: {esc(by)}"
+    txt = (f"{head}\n\n📨 Sent: {job['sent']}/{job['total']}\n"
+           f"🚫 Blocked (removed): {len(job['blocked'])}\n❌ Failed: {job['failed']}\n"
+           f"⚡ Rate: {rate:.1f}/s")
+    if not final and rate > 0: txt += f"\n⏳ ETA: {int(left / rate) // 60}m {int(left / rate) % 60}s"
+    return txt
+
+async def update_broadcast_status(bot, job, final=False):
+    markup = None if final else InlineKeyboardMarkup([[InlineKeyboardButton("⏹️ Stop", callback_data='bc_stop')]])
+    try: await bot.edit_message_text(broadcast_progress_text(job, final), chat_id=job["chat"], message_id=job["msg"], parse_mode='HTML', reply_markup=markup)
+    except TelegramError: pass
+
+async def run_broadcast(bot):
+    # Resumable: db["broadcast"] holds the text and a cursor (highest user id fully processed)
+    job = db.get("broadcast")
+    if not job: return
+    BROADCAST["stop"] = False
+    bucket = TokenBucket(BROADCAST_RATE, burst=BROADCAST_CONCURRENCY)
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    users = await broadcast_targets()
+    pending = users[bisect.bisect_right(users, job["cursor"]):]
+
+    async def deliver(uid):
+        async with sem:
+            for attempt in range(3):
+                await bucket.acquire()
+                try:
+                    await bot.send_message(uid, job["text"], parse_mode='HTML')
+                    job["sent"] += 1; return
+                except RetryAfter as e: bucket.pause(retry_after_seconds(e) + 1)
+                except Forbidden: job["blocked"].append(uid); return
+                except BadRequest: break
+                except NetworkError: await asyncio.sleep(1 + attempt)
+                except TelegramError: break
+            job["failed"] += 1
+
+    last_report = 0
+    for i in range(0, len(pending), BROADCAST_CHUNK):
+        if BROADCAST["stop"]:
+            job["stopped"] = True; break
+        chunk = pending[i:i + BROADCAST_CHUNK]
+        await asyncio.gather(*(deliver(uid) for uid in chunk))
+        job["cursor"] = chunk[-1]
+        mark_dirty(("meta",))
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_EVERY:
+            last_report = time.monotonic()
+            await update_broadcast_status(bot, job)
+
+    # Prune users who blocked the bot
+    blocked = set(job["blocked"])
+    if blocked:
+        db["all_users"] = [u for u in db.get("all_users", []) if u not in blocked]
+        mark_dirty(*(("unlisted", u) for u in blocked))
+    db["broadcast"] = None
+    mark_dirty(("meta",))
+    await update_broadcast_status(bot, job, final=True)
+
+def start_broadcast_task(application):
+    BROADCAST["task"] = application.create_task(run_broadcast(application.bot))
 
 # ==========================================
 # 6. POLL ANSWER HANDLER
@@ -316,19 +2371,19 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
         user_id = update.poll_answer.user.id
         selected = update.poll_answer.option_ids[0]
 
-        if context.user_data and 'futures' in context.user_data:
-            future = context.user_data['futures'].pop(poll_id, None)
-            if future and not future.done():
-                try: future.set_result(True)
-                except: pass
-                try: await context.bot.stop_poll(update.effective_chat.id, update.poll_answer.poll_id)
-                except: pass
-
-        if "current_polls" in db and poll_id in db["current_polls"]:
-            p_data = db["current_polls"][poll_id]
-            cat, sub, mode, q = p_data['cat'], p_data['sub'], p_data['mode'], p_data['q_data']
+        rec = POLLS.polls.get(poll_id)
+        if rec and rec["mode"] == 'group':
+            QUIZ.buffer_answer(poll_id, user_id, selected, time.time() - rec["sent"])
+            return
+
+        QUIZ.on_answer(poll_id)
+
+        p_data = POLLS.pop(poll_id)
+        if p_data:
+            cat, sub, mode, qid = p_data['cat'], p_data['sub'], p_data['mode'], p_data['qid']
             uid_str = str(user_id)
-            corr = q['correct']
+            corr = p_data['correct']
+            QSTATS.record(qid, selected, corr, time.time() - p_data["sent"] if "sent" in p_data else None)
             
             if uid_str not in db["stats"]: db["stats"][uid_str] = {}
             if cat not in db["stats"][uid_str]: db["stats"][uid_str][cat] = {}
@@ -339,44 +2394,193 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
             if 'wrong' not in stats_entry: stats_entry['wrong'] = 0
 
             stats_entry['total'] += 1
+            changes = [("stats", uid_str)]
             if selected == corr:
                 stats_entry['correct'] += 1
-                if mode == 'improve':
-                    mistakes_list = db["user_data"].get(uid_str, {}).get("mistakes", {}).get(cat, {}).get(sub, [])
-                    new_list = [mq for mq in mistakes_list if mq['question'] != q['question']]
-                    db["user_data"][uid_str]["mistakes"][cat][sub] = new_list
             else:
                 stats_entry['wrong'] += 1
                 if mode == 'normal':
                     if uid_str not in db["user_data"]: db["user_data"][uid_str] = {}
                     if "mistakes" not in db["user_data"][uid_str]: db["user_data"][uid_str]["mistakes"] = {}
                     if cat not in db["user_data"][uid_str]["mistakes"]: db["user_data"][uid_str]["mistakes"][cat] = {}
-                    if sub not in db["user_data"][uid_str]["mistakes"][cat]: db["user_data"][uid_str]["mistakes"][cat][sub] = []
-                    mistakes_list = db["user_data"][uid_str]["mistakes"][cat][sub]
-                    if not any(mq['question'] == q['question'] for mq in mistakes_list): mistakes_list.append(q)
+                    if sub not in db["user_data"][uid_str]["mistakes"][cat]: db["user_data"][uid_str]["mistakes"][cat][sub] = set()
+                    mistake_ids = db["user_data"][uid_str]["mistakes"][cat][sub]
+                    if qid not in mistake_ids:
+                        mistake_ids.add(qid); changes.append(("mistake", uid_str, cat, sub, qid))
+                    changes.append(SRS.add(uid_str, cat, sub, qid))
+            if mode == 'improve':
+                # Improve quizzes run per base subject (e.g. "Hindi"); the id lives under one of its sections
+                changes += SRS.answer(uid_str, cat, sub, qid, selected == corr)
             
-            db["current_polls"].pop(poll_id, None)
-            save_db(db)
+            mark_dirty(*changes)
     except Exception as e: print(f"Poll Answer Error: {e}")
 
+def apply_group_answers(p_data, answers, s):
+    # Folds one closed group poll into stats, question analytics and the session's scoreboard with a
+    # single mark_dirty: a stats row and a score row per answering user, however many answered at once
+    cat, sub, qid, corr = p_data['cat'], p_data['sub'], p_data['qid'], p_data['correct']
+    board, sid = s.board, str(s.sid)
+    changes = []
+    for user_id, (selected, seconds) in answers.items():
+        uid_str = str(user_id)
+        ok = selected == corr
+        # Stats rows are written only by the user's own worker
+        if owns_user(user_id):
+            count_answer(uid_str, cat, sub, ok)
+            changes.append(("stats", uid_str))
+        else: send_to_front(("stats", uid_str, cat, sub, ok))
+        QSTATS.record(qid, selected, corr, seconds)
+        row = board.setdefault(uid_str, [0, 0, 0])
+        row[0] += ok; row[1] += 1; row[2] += int(seconds * 1000)
+        changes.append(("quiz_score", sid, uid_str))
+    if changes: mark_dirty(*changes)
+
+def count_answer(uid_str, cat, sub, ok):
+    entry = db["stats"].setdefault(uid_str, {}).setdefault(cat, {}).setdefault(sub, {'total': 0, 'correct': 0, 'wrong': 0})
+    entry['total'] = entry.get('total', 0) + 1
+    if ok: entry['correct'] = entry.get('correct', 0) + 1
+    else: entry['wrong'] = entry.get('wrong', 0) + 1
+
 # ==========================================
 # 7. MENUS & CALLBACKS
 # ==========================================
+class CallbackRouter:
+    # Declarative callback table. Fixed ids resolve through a dict; parameterized ids
+    # ("src_book_<cat>_<sub>") walk a prefix trie to their longest registered prefix.
+    def __init__(self):
+        self.exact = {}     # callback data -> (handler, access, route name)
+        self.prefixes = {}  # prefix -> (handler, access, route name)
+        self.trie = {}      # char -> node; node[None] holds the entry of a prefix ending there
+        self.stats = {}     # route name -> [calls, total_ms, max_ms]
+
+    def route(self, *keys, prefix=False, access=None):
+        # access: None (everyone), 'admin' or 'owner'
+        def register(fn):
+            for key in keys:
+                if prefix: self.prefixes[key] = (fn, access, key + '*')
+                else: self.exact[key] = (fn, access, key)
+            return fn
+        return register
+
+    def compile(self):
+        trie = {}
+        for key, entry in self.prefixes.items():
+            node = trie
+            for ch in key: node = node.setdefault(ch, {})
+            node[None] = entry
+        self.trie = trie
+
+    def resolve(self, data):
+        entry = self.exact.get(data)
+        if entry is not None: return entry
+        node, found = self.trie, None
+        for ch in data:
+            node = node.get(ch)
+            if node is None: break
+            found = node.get(None, found)
+        return found
+
+    async def dispatch(self, update, context, data):
+        entry = self.resolve(data)
+        if entry is None: return
+        fn, access, name = entry
+        user_id = update.callback_query.from_user.id
+        if access == 'owner' and user_id != OWNER_ID: return
+        if access == 'admin' and not is_admin(user_id): return
+        t0 = time.perf_counter()
+        try: await fn(update, context, data)
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            ROUTE_SECONDS.observe(ms / 1000, (name,))
+            st = self.stats.get(name)
+            if st is None: st = self.stats[name] = [0, 0.0, 0.0]
+            st[0] += 1; st[1] += ms
+            if ms > st[2]: st[2] = ms
+
+    def hot_routes(self, n=5):
+        return sorted(self.stats.items(), key=lambda kv: kv[1][0], reverse=True)[:n]
+
+ROUTER = CallbackRouter()
+route = ROUTER.route
+
+# --- Static keyboards: built once, InlineKeyboardMarkup is immutable so they are shared ---
+def back_keyboard(callback_data, label="Back"):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=callback_data)]])
+
+@lru_cache(maxsize=None)
+def main_menu_keyboard(owner, admin):
+    btns = [
+        [InlineKeyboardButton("📚 BSEB (Bihar Board)", callback_data='gate_bseb')],
+        [InlineKeyboardButton("🚀 Improve Mistakes", callback_data='menu_improve')],
+        [InlineKeyboardButton("⚙️ Settings", callback_data='menu_settings'), InlineKeyboardButton("ℹ️ Help", callback_data='show_help')]
+    ]
+    if owner: btns.append([InlineKeyboardButton("👑 Owner Panel", callback_data='menu_owner')])
+    if admin: btns.append([InlineKeyboardButton("🛡️ Content Admin", callback_data='menu_admin')])
+    return InlineKeyboardMarkup(btns)
+
+@lru_cache(maxsize=None)
+def owner_panel_keyboard(m_status, can_rollback):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("➕ Add Admin", callback_data='add_admin_prompt'), InlineKeyboardButton("📜 Admin List", callback_data='view_admin_list')],
+        [InlineKeyboardButton("💾 Backup", callback_data='get_backup'), InlineKeyboardButton("📦 Incremental", callback_data='get_backup_inc')],
+        [InlineKeyboardButton("♻️ Restore", callback_data='restore_prompt')] + ([InlineKeyboardButton("↩️ Rollback", callback_data='restore_rollback')] if can_rollback else []),
+        [InlineKeyboardButton(f"Maintenance: {m_status}", callback_data='toggle_maint')],
+        [InlineKeyboardButton("⬅️ Back", callback_data='main_menu')]
+    ])
+
+@lru_cache(maxsize=32)
+def admin_deep_keyboard(sub):
+    if sub == "Hindi":
+        opts = ["Hindi-Gadya", "Hindi-Padya", "Hindi-Grammar", "Hindi-PYQ", "Hindi-YouTube"]
+    elif sub == "English":
+        opts = ["English-Prose", "English-Poetry", "English-Grammar", "English-PYQ", "English-YouTube"]
+    else:
+        opts = [sub, f"{sub}-PYQ", f"{sub}-YouTube"]
+    btns = [[InlineKeyboardButton(f"{sub} (Book)" if o == sub else o, callback_data=f'adm_sub_{o}')] for o in opts]
+    btns.append([InlineKeyboardButton("Back", callback_data='adm_main_BSEB')])
+    return InlineKeyboardMarkup(btns)
+
+HELP_TEXT = (
+    "━━━━━━━━━━━━━━━━━━\n"
+    "ℹ️ <b>HELP & GUIDE</b>\n"
+    "━━━━━━━━━━━━━━━━━━\n\n"
+    "1. <b>Start Quiz:</b> Select a Category > Subject > Source (Book/PYQ/YT).\n"
+    "2. <b>PYQ:</b> Directly tests past questions.\n"
+    "3. <b>YouTube:</b> Tests based on specific channels/videos.\n"
+    "4. <b>Admin:</b> Only owners can add questions.\n\n"
+    "👨‍💻 <b>Developer:</b> @errorkid_05"
+)
+HELP_KB = back_keyboard('main_menu', "⬅️ Back")
+SETTINGS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Stats", callback_data='view_stats')],
+    [InlineKeyboardButton("🔔 Bot Updates", url=LINKS["UPDATE"])],
+    [InlineKeyboardButton("✋ Request Admin", callback_data='req_admin')],
+    [InlineKeyboardButton("⬅️ Back", callback_data='main_menu')]
+])
+ADMIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Add BSEB", callback_data='adm_main_BSEB')],
+    [InlineKeyboardButton("🗑️ Delete Data", callback_data='adm_del_menu')],
+    [InlineKeyboardButton("📢 Broadcast", callback_data='adm_broadcast_prompt')],
+    [InlineKeyboardButton("Back", callback_data='main_menu')]
+])
+ADMIN_SUBJECTS_KB = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(s, callback_data=f'adm_deep_{s}')] for s in BASE_SUBJECTS] + [[InlineKeyboardButton("Back", callback_data='menu_admin')]])
+DELETE_MENU_KB = InlineKeyboardMarkup([[InlineKeyboardButton("BSEB", callback_data='del_sel_BSEB')], [InlineKeyboardButton("Back", callback_data='menu_admin')]])
+IMPROVE_MENU_KB = InlineKeyboardMarkup([[InlineKeyboardButton("BSEB", callback_data='imp_cat_BSEB')], [InlineKeyboardButton("Back", callback_data='main_menu')]])
+YT_MODE_KB = InlineKeyboardMarkup([[InlineKeyboardButton("▶️ Channel Wise (Single)", callback_data='mode_single')], [InlineKeyboardButton("🔀 Mix Channels", callback_data='mode_mix')], [InlineKeyboardButton("Back", callback_data='main_menu')]])
+OWNER_BACK_KB = back_keyboard('menu_owner')
+OWNER_CANCEL_KB = back_keyboard('menu_owner', "Cancel")
+ADMIN_CANCEL_KB = back_keyboard('menu_admin', "Cancel")
+SETTINGS_BACK_KB = back_keyboard('menu_settings')
+
 async def show_main_menu(update, context):
     user_id = update.effective_user.id
     fname = esc(update.effective_user.first_name)
     if "all_users" not in db: db["all_users"] = []
-    if user_id not in db["all_users"]: db["all_users"].append(user_id); save_db(db)
+    if user_id not in db["all_users"]: db["all_users"].append(user_id); mark_dirty(("listed", user_id))
     if str(user_id) not in db["stats"]: db["stats"][str(user_id)] = {}
 
-    btns = [
-        [InlineKeyboardButton("📚 BSEB (Bihar Board)", callback_data='gate_bseb')],
-        [InlineKeyboardButton("🚀 Improve Mistakes", callback_data='menu_improve')],
-        [InlineKeyboardButton("⚙️ Settings", callback_data='menu_settings'), InlineKeyboardButton("ℹ️ Help", callback_data='show_help')]
-    ]
-    if user_id == OWNER_ID: btns.append([InlineKeyboardButton("👑 Owner Panel", callback_data='menu_owner')])
-    if is_admin(user_id): btns.append([InlineKeyboardButton("🛡️ Content Admin", callback_data='menu_admin')])
-    
+    kb = main_menu_keyboard(user_id == OWNER_ID, is_admin(user_id))
     text = (
         f"━━━━━━━━━━━━━━━━━━\n"
         f"👋 <b>Namaste {fname}!</b>\n"
@@ -384,461 +2588,505 @@ async def show_main_menu(update, context):
         f"🎯 <b>Select Your Goal:</b>\n"
         f"👇 <i>Choose an option below to start:</i>"
     )
-    if update.callback_query: await safe_edit_message(update.callback_query, text, InlineKeyboardMarkup(btns))
-    else: await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(btns), parse_mode='HTML')
+    if update.callback_query: await safe_edit_message(update.callback_query, text, kb)
+    else: await update.message.reply_text(text, reply_markup=kb, parse_mode='HTML')
 
 async def show_help(update, context):
-    query = update.callback_query
-    txt = (
-        "━━━━━━━━━━━━━━━━━━\n"
-        "ℹ️ <b>HELP & GUIDE</b>\n"
-        "━━━━━━━━━━━━━━━━━━\n\n"
-        "1. <b>Start Quiz:</b> Select a Category > Subject > Source (Book/PYQ/YT).\n"
-        "2. <b>PYQ:</b> Directly tests past questions.\n"
-        "3. <b>YouTube:</b> Tests based on specific channels/videos.\n"
-        "4. <b>Admin:</b> Only owners can add questions.\n\n"
-        "👨‍💻 <b>Developer:</b> @errorkid_05"
-    )
-    await safe_edit_message(query, txt, InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data='main_menu')]]))
+    await safe_edit_message(update.callback_query, HELP_TEXT, HELP_KB)
 
 async def show_owner_panel(update, context):
     m_status = "🟢 ON" if db.get("maintenance_mode") else "🔴 OFF"
-    btns = [
-        [InlineKeyboardButton("➕ Add Admin", callback_data='add_admin_prompt'), InlineKeyboardButton("📜 Admin List", callback_data='view_admin_list')],
-        [InlineKeyboardButton("💾 Backup", callback_data='get_backup'), InlineKeyboardButton("♻️ Restore", callback_data='restore_prompt')],
-        [InlineKeyboardButton(f"Maintenance: {m_status}", callback_data='toggle_maint')],
-        [InlineKeyboardButton("⬅️ Back", callback_data='main_menu')]
-    ]
-    await safe_edit_message(update.callback_query, "👑 <b>Owner Control Panel</b>", InlineKeyboardMarkup(btns))
+    ps = PERSIST_STATS
+    avg_ms = ps["total_ms"] / ps["flushes"] if ps["flushes"] else 0
+    avg_batch = ps["total_coalesced"] / ps["flushes"] if ps["flushes"] else 0
+    text = (
+        "👑 <b>Owner Control Panel</b>\n\n"
+        f"💾 <b>DB Flushes:</b> {ps['flushes']} (errors: {ps['errors']})\n"
+        f"⏱️ Last {ps['last_ms']:.1f}ms | Avg {avg_ms:.1f}ms | Max {ps['max_ms']:.1f}ms\n"
+        f"📦 Coalesced: last {ps['last_coalesced']} | avg {avg_batch:.1f} changes/flush\n"
+        f"👥 Member cache: {MEMBERSHIP.hits} hits | {MEMBERSHIP.misses} misses | {MEMBERSHIP.coalesced} coalesced\n"
+        f"🪪 Profiles: {len(PROFILES.entries)} cached | {PROFILES.hits} hits | {PROFILES.misses} misses"
+    )
+    qs = QUIZ.stats
+    avg_lag = qs["lag_total_ms"] / qs["fired"] if qs["fired"] else 0
+    text += (f"\n🎯 Quizzes: {len(QUIZ.sessions)} active | {len(POLLS)} polls in flight | {qs['resumed']} resumed\n"
+             f"⏲️ Scheduler lag: last {qs['lag_last_ms']:.0f}ms | avg {avg_lag:.0f}ms | max {qs['lag_max_ms']:.0f}ms")
+    lag = LOOP_LAG.values.get(())
+    if lag:
+        beats = sum(lag[:-1])
+        text += f"\n🐢 Loop lag: avg {lag[-1] / beats * 1000:.0f}ms | max {WATCHDOG.max_ms:.0f}ms | {WATCHDOG.stalls} stalls >{LOOP_STALL_MS:.0f}ms"
+    blocking = WATCHDOG.top_sites()
+    if blocking:
+        text += "\n🧱 Top blocking sites:" + "".join(f"\n  <code>{esc(site)}</code> {n}× max {mx:.0f}ms ({esc(handler)})"
+                                                   for site, (n, total, mx, handler) in blocking)
+    bs = BACKUP_STATS
+    if bs["count"]:
+        text += f"\n🗄️ Last backup: {bs['last_type']} {format_size(bs['last_size'])} in {bs['last_ms']:.0f}ms"
+    hot = ROUTER.hot_routes()
+    if hot:
+        text += "\n🔥 Hot routes:" + "".join(f"\n  <code>{esc(name)}</code> {calls}× avg {total / calls:.0f}ms max {mx:.0f}ms"
+                                          for name, (calls, total, mx) in hot)
+    await safe_edit_message(update.callback_query, text, owner_panel_keyboard(m_status, bool(RESTORE["previous"])))
 
 async def show_settings(update, context):
+    await safe_edit_message(update.callback_query, "⚙️ <b>Settings</b>", SETTINGS_KB)
+
+# --- Gate & basic menus ---
+@route('recheck_main')
+async def on_recheck_main(update, context, data):
+    if await check_membership(IDS["MAIN"], update.callback_query.from_user.id, context, force=True): await show_main_menu(update, context)
+    else: await update.callback_query.answer("❌ Join First!", show_alert=True)
+
+@route('gate_bseb', 'recheck_bseb')
+async def on_gate_bseb(update, context, data):
+    # "I have Joined" taps arrive as recheck_bseb and bypass the cached answer
+    await check_gate(update.callback_query, context, IDS["BSEB"], LINKS["BSEB"], open_bseb_menu, 'recheck_bseb', force=(data == 'recheck_bseb'))
+
+@route('main_menu')
+async def on_main_menu(update, context, data): await show_main_menu(update, context)
+
+@route('menu_settings')
+async def on_settings(update, context, data): await show_settings(update, context)
+
+@route('show_help')
+async def on_help(update, context, data): await show_help(update, context)
+
+# --- Owner panel ---
+@route('menu_owner', access='owner')
+async def on_owner_panel(update, context, data): await show_owner_panel(update, context)
+
+@route('get_backup', 'get_backup_inc', access='owner')
+async def on_get_backup(update, context, data):
+    await flush_db()
+    path, manifest = await create_backup('full' if data == 'get_backup' else 'incremental')
+    caption = (f"🗄️ {manifest['type']} backup • {format_size(manifest['size'])} "
+               f"({format_size(manifest['raw_size'])} raw) • {manifest['ms']:.0f}ms\nsha256: {manifest['sha256'][:16]}…")
+    with open(path, 'rb') as fh:
+        await context.bot.send_document(update.callback_query.message.chat_id, document=fh, filename=manifest["file"], caption=caption)
+
+@route('toggle_maint', access='owner')
+async def on_toggle_maint(update, context, data):
+    db["maintenance_mode"] = not db.get("maintenance_mode", False)
+    mark_dirty(("meta",))
+    await show_owner_panel(update, context)
+
+@route('restore_confirm', 'restore_cancel', 'restore_rollback', access='owner')
+async def on_restore_action(update, context, data): await handle_restore_action(update.callback_query, context, data)
+
+@route('restore_prompt', access='owner')
+async def on_restore_prompt(update, context, data):
+    await safe_edit_message(update.callback_query, "📤 <b>Send backup file</b> (database.json / backup.json / .json.gz):", OWNER_CANCEL_KB)
+
+@route('add_admin_prompt', access='owner')
+async def on_add_admin_prompt(update, context, data):
+    context.user_data['awaiting_admin_id'] = True
+    await safe_edit_message(update.callback_query, "⌨️ <b>Send User ID to add as Admin:</b>", OWNER_CANCEL_KB)
+
+@route('view_admin_list', access='owner')
+async def on_admin_list(update, context, data):
     query = update.callback_query
-    btns = [
-        [InlineKeyboardButton("📊 Stats", callback_data='view_stats')],
-        [InlineKeyboardButton("🔔 Bot Updates", url=LINKS["UPDATE"])],
-        [InlineKeyboardButton("✋ Request Admin", callback_data='req_admin')],
-        [InlineKeyboardButton("⬅️ Back", callback_data='main_menu')]
-    ]
-    await safe_edit_message(query, "⚙️ <b>Settings</b>", InlineKeyboardMarkup(btns))
-
-    
-async def handle_admin(update, context):
-    query = update.callback_query
-    data = query.data
-    
-    # 1. Main Menu
-    if data == 'menu_admin':
-        btns = [
-            [InlineKeyboardButton("➕ Add BSEB", callback_data='adm_main_BSEB')],
-            [InlineKeyboardButton("🗑️ Delete Data", callback_data='adm_del_menu')],
-            [InlineKeyboardButton("📢 Broadcast", callback_data='adm_broadcast_prompt')],
-            [InlineKeyboardButton("Back", callback_data='main_menu')]
-        ]
-        await safe_edit_message(query, "🛡️ <b>Content Admin Panel</b>", InlineKeyboardMarkup(btns))
-        return
+    await safe_edit_message(query, "👮‍♂️ <b>Admin List:</b>\nLoading details...", None)
+    final_txt = "👮‍♂️ <b>Admin List:</b>\n"
+    await PROFILES.resolve(context.bot, db["admins"])
+    for aid in db["admins"]:
+        name = PROFILES.label(aid)
+        if name: final_txt += f"👤 @{esc(name)} ({aid})\n"
+        else: final_txt += f"👤 Unknown User ({aid})\n"
+    await safe_edit_message(query, final_txt, OWNER_BACK_KB)
+
+# --- Content admin ---
+@route('menu_admin', access='admin')
+async def on_admin_menu(update, context, data):
+    await safe_edit_message(update.callback_query, "🛡️ <b>Content Admin Panel</b>", ADMIN_MENU_KB)
+
+@route('adm_main_BSEB', access='admin')
+async def on_admin_subjects(update, context, data):
+    await safe_edit_message(update.callback_query, "📂 <b>BSEB > Select Subject:</b>", ADMIN_SUBJECTS_KB)
+
+@route('adm_deep_', prefix=True, access='admin')
+async def on_admin_deep(update, context, data):
+    sub = data.split('_')[2]
+    await safe_edit_message(update.callback_query, f"📂 <b>{sub} > Select Type:</b>", admin_deep_keyboard(sub))
+
+@route('adm_broadcast_prompt', access='admin')
+async def on_broadcast_prompt(update, context, data):
+    await safe_edit_message(update.callback_query, "📢 <b>Send broadcast message:</b>", ADMIN_CANCEL_KB)
+    context.user_data['awaiting_broadcast_msg'] = True
+
+@route('adm_del_menu', access='admin')
+async def on_delete_menu(update, context, data):
+    await safe_edit_message(update.callback_query, "🗑️ <b>Select Category:</b>", DELETE_MENU_KB)
+
+@route('del_sel_', 'adm_sel_', prefix=True, access='admin')
+async def on_admin_category(update, context, data):
+    mode = 'del' if 'del' in data else 'adm'
+    cat = data.split('_')[2]; context.user_data[f'{mode}_cat'] = cat
+    subs = sorted(list(db["questions"].get(cat, {}).keys()))
+    btns = [[InlineKeyboardButton(s, callback_data=f'{mode}_sub_{s}')] for s in subs]
+    btns.append([InlineKeyboardButton("Back", callback_data='menu_admin')])
+    await safe_edit_message(update.callback_query, f"📂 <b>{cat} > Select Subject:</b>", InlineKeyboardMarkup(btns))
+
+@route('del_sub_', 'adm_sub_', 'pg_adm_', 'pg_del_', prefix=True, access='admin')
+async def on_admin_chapters(update, context, data):
+    mode = 'del' if 'del' in data else 'adm'
+    if data.startswith('pg_'):
+        # Format: pg_adm_PAGE_SUB...
+        parts = data.split('_')
+        page = int(parts[2])
+        sub = "_".join(parts[3:])
+    else:
+        sub = data.replace(f'{mode}_sub_', '')
+        page = 0
+    await show_admin_chapters(update.callback_query, context, mode, sub, page)
 
-    # 2. Select Subject
-    if data == 'adm_main_BSEB':
-        subjects = ["Hindi", "English", "Maths", "Biology", "Chemistry", "Physics"]
-        btns = [[InlineKeyboardButton(s, callback_data=f'adm_deep_{s}')] for s in subjects]
-        btns.append([InlineKeyboardButton("Back", callback_data='menu_admin')])
-        await safe_edit_message(query, "📂 <b>BSEB > Select Subject:</b>", InlineKeyboardMarkup(btns))
-        return
+async def show_admin_chapters(query, context, mode, sub, page=0):
+    context.user_data[f'{mode}_sub'] = sub
+    cat = context.user_data.get(f'{mode}_cat', 'BSEB')
+    context.user_data[f'{mode}_cat'] = cat
 
-    # 3. Handle Subject Click
-    if data.startswith('adm_deep_'):
-        sub = data.split('_')[2] 
-        if sub == "Hindi":
-            opts = ["Hindi-Gadya", "Hindi-Padya", "Hindi-Grammar", "Hindi-PYQ", "Hindi-YouTube"]
-        elif sub == "English":
-            opts = ["English-Prose", "English-Poetry", "English-Grammar", "English-PYQ", "English-YouTube"]
-        else:
-            opts = [sub, f"{sub}-PYQ", f"{sub}-YouTube"]
-            
-        btns = []
-        for o in opts:
-            label = o
-            if o == sub: label = f"{sub} (Book)" 
-            btns.append([InlineKeyboardButton(label, callback_data=f'adm_sub_{o}')])
-            
-        btns.append([InlineKeyboardButton("Back", callback_data='adm_main_BSEB')])
-        await safe_edit_message(query, f"📂 <b>{sub} > Select Type:</b>", InlineKeyboardMarkup(btns))
-        return
+    all_keys, version = QINDEX.chapter_list(cat, sub)
+    token = f"{subject_token(cat, sub)}.{version}."
 
-    # 4. Admin Tools (List, Backup, etc.)
-    if data == 'view_admin_list':
-        msg = "👮‍♂️ <b>Admin List:</b>\nLoading details..."
-        await safe_edit_message(query, msg, None)
-        final_txt = "👮‍♂️ <b>Admin List:</b>\n"
-        for aid in db["admins"]:
-            try:
-                chat = await context.bot.get_chat(aid)
-                name = chat.username if chat.username else chat.first_name
-                final_txt += f"👤 @{esc(name)} ({aid})\n"
-            except: final_txt += f"👤 Unknown User ({aid})\n"
-        await safe_edit_message(query, final_txt, InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data='menu_owner')]]))
-        return
-        
-    if data == 'restore_prompt':
-        await safe_edit_message(query, "📤 <b>Send database.json:</b>", InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data='menu_owner')]]))
-        return
-    if data == 'adm_broadcast_prompt':
-        await safe_edit_message(query, "📢 <b>Send broadcast message:</b>", InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data='menu_admin')]]))
-        context.user_data['awaiting_broadcast_msg'] = True
-        return
+    ITEMS_PER_PAGE = 10
+    total_items = len(all_keys)
+    total_pages = (total_items + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
+    if total_pages == 0: total_pages = 1
 
-    # 5. Delete Menu
-    if data == 'adm_del_menu':
-        btns = [[InlineKeyboardButton("BSEB", callback_data='del_sel_BSEB')], [InlineKeyboardButton("Back", callback_data='menu_admin')]]
-        await safe_edit_message(query, "🗑️ <b>Select Category:</b>", InlineKeyboardMarkup(btns))
-        return
-    
-    if data.startswith(('del_sel_', 'adm_sel_')): 
-        mode = 'del' if 'del' in data else 'adm'
-        cat = data.split('_')[2]; context.user_data[f'{mode}_cat'] = cat
-        # Safe get keys
-        subs = sorted(list(db["questions"].get(cat, {}).keys()))
-        btns = [[InlineKeyboardButton(s, callback_data=f'{mode}_sub_{s}')] for s in subs]
-        btns.append([InlineKeyboardButton("Back", callback_data='menu_admin')])
-        await safe_edit_message(query, f"📂 <b>{cat} > Select Subject:</b>", InlineKeyboardMarkup(btns))
-        return
+    start_idx = page * ITEMS_PER_PAGE
+    chaps = all_keys[start_idx:start_idx + ITEMS_PER_PAGE]
 
-    # ==================================================================
-    # 6. PAGINATION & LISTING LOGIC (UPDATED FOR FIX)
-    # ==================================================================
-    if data.startswith(('del_sub_', 'adm_sub_', 'pg_adm_', 'pg_del_')):
-        mode = 'del' if 'del' in data else 'adm'
-        
-        # --- Determine Page & Subject ---
-        page = 0
-        if data.startswith('pg_'):
-            # Format: pg_adm_PAGE_SUB...
-            parts = data.split('_')
-            page = int(parts[2])
-            sub = "_".join(parts[3:]) 
-        else:
-            # First load
-            sub = data.replace(f'{mode}_sub_', '')
-            page = 0
+    btns = []
+    if mode == 'del':
+        for i, c in enumerate(chaps):
+            btns.append([InlineKeyboardButton(f"❌ {c}", callback_data=f'del_idx_{token}{to_base36(start_idx + i)}')])
+        title = f"🗑️ <b>Delete ({page+1}/{total_pages}):</b>"
+    else:
+        for i, c in enumerate(chaps):
+            btns.append([InlineKeyboardButton(c, callback_data=f'adm_idx_{token}{to_base36(start_idx + i)}')])
+        btns.append([InlineKeyboardButton("➕ Add New", callback_data='adm_new_chap')])
+        title = f"📂 <b>{sub} ({page+1}/{total_pages}):</b>"
 
-        context.user_data[f'{mode}_sub'] = sub
-        cat = context.user_data.get(f'{mode}_cat', 'BSEB') 
-        context.user_data[f'{mode}_cat'] = cat 
-        
-        # Get all chapters/channels and sort them
-        all_keys = sorted(list(db["questions"].get(cat, {}).get(sub, {}).keys()))
-        
-        ITEMS_PER_PAGE = 10
-        total_items = len(all_keys)
-        total_pages = (total_items + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
-        if total_pages == 0: total_pages = 1
-        
-        # Slice for current page
-        start_idx = page * ITEMS_PER_PAGE
-        end_idx = start_idx + ITEMS_PER_PAGE
-        chaps = all_keys[start_idx:end_idx]
-        
-        btns = []
-        if mode == 'del':
-            for i, c in enumerate(chaps):
-                global_idx = start_idx + i
-                # Save mapping: Index -> Real Name
-                context.user_data[f'del_chap_idx_{global_idx}'] = c
-                # Send Index in callback to save bytes
-                btns.append([InlineKeyboardButton(f"❌ {c}", callback_data=f'del_idx_{global_idx}')])
-            title = f"🗑️ <b>Delete ({page+1}/{total_pages}):</b>"
-        else:
-            for i, c in enumerate(chaps):
-                global_idx = start_idx + i
-                context.user_data[f'adm_chap_idx_{global_idx}'] = c
-                btns.append([InlineKeyboardButton(c, callback_data=f'adm_idx_{global_idx}')])
-            
-            btns.append([InlineKeyboardButton("➕ Add New", callback_data='adm_new_chap')])
-            title = f"📂 <b>{sub} ({page+1}/{total_pages}):</b>"
-
-        # --- Pagination Buttons ---
-        pag_btns = []
-        if page > 0:
-            pag_btns.append(InlineKeyboardButton("⬅️ Prev", callback_data=f'pg_{mode}_{page-1}_{sub}'))
-        if page < total_pages - 1:
-            pag_btns.append(InlineKeyboardButton("Next ➡️", callback_data=f'pg_{mode}_{page+1}_{sub}'))
-        if pag_btns: btns.append(pag_btns)
-
-        # --- Back Button ---
-        back_data = 'menu_admin'
-        if mode == 'adm' and cat == 'BSEB':
-             # Try to go back to deep selection if possible
-             base_sub = sub.split('-')[0]
-             back_data = f'adm_deep_{base_sub}'
-        elif mode == 'del':
-             back_data = f'del_sel_{cat}'
-        
-        btns.append([InlineKeyboardButton("Back", callback_data=back_data)])
-        
-        await safe_edit_message(query, title, InlineKeyboardMarkup(btns))
-        return
+    pag_btns = []
+    if page > 0: pag_btns.append(InlineKeyboardButton("⬅️ Prev", callback_data=f'pg_{mode}_{page-1}_{sub}'))
+    if page < total_pages - 1: pag_btns.append(InlineKeyboardButton("Next ➡️", callback_data=f'pg_{mode}_{page+1}_{sub}'))
+    if pag_btns: btns.append(pag_btns)
 
-    # ==================================================================
-    # 7. INDEX HANDLERS (UPDATED)
-    # ==================================================================
-    if data.startswith('del_idx_'):
-        idx = int(data.split('_')[2])
-        chap = context.user_data.get(f'del_chap_idx_{idx}')
-        if not chap:
-             await query.answer("❌ Item missing/refresh needed", show_alert=True)
-             return
-        context.user_data['del_chap'] = chap
-        btns = [[InlineKeyboardButton("✅ YES, DELETE", callback_data='confirm_del')], [InlineKeyboardButton("❌ CANCEL", callback_data=f'del_sub_{context.user_data["del_sub"]}')]]
-        await safe_edit_message(query, f"⚠️ <b>Delete '{chap}'?</b>", InlineKeyboardMarkup(btns))
-        return
+    back_data = 'menu_admin'
+    if mode == 'adm' and cat == 'BSEB': back_data = f'adm_deep_{sub.split("-")[0]}'
+    elif mode == 'del': back_data = f'del_sel_{cat}'
+    btns.append([InlineKeyboardButton("Back", callback_data=back_data)])
 
-    if data.startswith('adm_idx_'):
-        idx = int(data.split('_')[2])
-        chap = context.user_data.get(f'adm_chap_idx_{idx}')
-        if not chap:
-             await query.answer("❌ Item missing/refresh needed", show_alert=True)
-             return
-        context.user_data['adm_chap'] = chap; context.user_data['adm_mode'] = 'active'
-        await safe_edit_message(query, f"📂 <b>Active:</b> {chap}\n\n👇 <b>Forward Polls / Send .txt</b>", InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data=f'adm_sub_{context.user_data["adm_sub"]}')]]))
-        return
+    await safe_edit_message(query, title, InlineKeyboardMarkup(btns))
 
-    # 8. Confirmation & Input Actions
-    if data == 'confirm_del':
-        try:
-            del db["questions"][context.user_data['del_cat']][context.user_data['del_sub']][context.user_data['del_chap']]
-            save_db(db)
-            await query.answer("✅ Deleted!", show_alert=True)
-            # Return to list
-            await handle_admin(update, context) # This reloads the menu
-        except: await query.answer("❌ Error", show_alert=True)
+async def resolve_chapter_button(query, context, mode, data):
+    # Chapter buttons carry a (subject, version, index) token. If the chapter list changed since the
+    # message was drawn, redraw the current list at the same page instead of guessing.
+    hit = QINDEX.resolve_chapter_token(data.split('_', 2)[2])
+    if hit is None:
+        await query.answer("❌ Item missing/refresh needed", show_alert=True)
+        return None
+    cat, sub, chap, idx = hit
+    context.user_data[f'{mode}_cat'] = cat
+    if chap is None:
+        await query.answer("🔄 List was updated, please pick again")
+        await show_admin_chapters(query, context, mode, sub, idx // 10)
+        return None
+    context.user_data[f'{mode}_sub'] = sub
+    return chap
+
+@route('del_idx_', prefix=True, access='admin')
+async def on_delete_pick(update, context, data):
+    query = update.callback_query
+    chap = await resolve_chapter_button(query, context, 'del', data)
+    if chap is None: return
+    context.user_data['del_chap'] = chap
+    btns = [[InlineKeyboardButton("✅ YES, DELETE", callback_data='confirm_del')], [InlineKeyboardButton("❌ CANCEL", callback_data=f'del_sub_{context.user_data["del_sub"]}')]]
+    await safe_edit_message(query, f"⚠️ <b>Delete '{chap}'?</b>", InlineKeyboardMarkup(btns))
+
+@route('adm_idx_', prefix=True, access='admin')
+async def on_admin_pick(update, context, data):
+    query = update.callback_query
+    chap = await resolve_chapter_button(query, context, 'adm', data)
+    if chap is None: return
+    context.user_data['adm_chap'] = chap; context.user_data['adm_mode'] = 'active'
+    btns = [[InlineKeyboardButton("📈 Analytics", callback_data=f'ana_{data.split("_", 2)[2]}')],
+            [InlineKeyboardButton("Back", callback_data=f'adm_sub_{context.user_data["adm_sub"]}')]]
+    await safe_edit_message(query, f"📂 <b>Active:</b> {chap}\n\n👇 <b>Forward Polls / Send .txt</b>", InlineKeyboardMarkup(btns))
+
+@route('ana_', prefix=True, access='admin')
+async def on_chapter_analytics(update, context, data):
+    query = update.callback_query
+    hit = QINDEX.resolve_chapter_token(data.split('_', 1)[1])
+    if hit is None or hit[2] is None:
+        await query.answer("❌ Item missing/refresh needed", show_alert=True); return
+    cat, sub, chap, _ = hit
+    rep = QSTATS.chapter_report(cat, sub, chap)
+    txt = f"📈 <b>{esc(chap)}</b> • {rep['answers']} answers\n\n🔥 <b>Hardest</b> (min {ANALYTICS_MIN_ATTEMPTS} attempts):"
+    for qid, rate in rep["hardest"]:
+        rec = QSTATS.recs[qid]
+        med = QSTATS.median_seconds(rec)
+        txt += f"\n• {rate:.0%} of {rec[QS_ATTEMPTS]}" + (f" • ~{med:.0f}s" if med is not None else "") + f"\n  <i>{esc(QINDEX.bank[qid].question[:80])}</i>"
+    if not rep["hardest"]: txt += "\n— not enough answers yet"
+    if rep["wrong_keys"]:
+        txt += "\n\n⚠️ <b>Suspected wrong keys:</b>"
+        for qid, top, share in rep["wrong_keys"]:
+            q = QINDEX.bank[qid]
+            txt += f"\n• key {q.correct + 1}, but {share:.0%} chose {top + 1} ({esc(q.options[top][:40])})\n  <i>{esc(q.question[:80])}</i>"
+    await safe_edit_message(query, txt, back_keyboard(f'adm_sub_{sub}'))
+
+@route('confirm_del', access='admin')
+async def on_confirm_delete(update, context, data):
+    query = update.callback_query
+    try:
+        cat, sub, chap = context.user_data['del_cat'], context.user_data['del_sub'], context.user_data['del_chap']
+        async with DB_LOCK:
+            del db["questions"][cat][sub][chap]
+            QINDEX.drop_chapter(db, cat, sub, chap)
+            mark_dirty(("chapter", cat, sub, chap))
+    except KeyError:
+        await query.answer("❌ Error", show_alert=True); return
+    await query.answer("✅ Deleted!", show_alert=True)
+    await show_admin_chapters(query, context, 'del', sub)   # back to the (refreshed) list
+
+@route('adm_new_chap', access='admin')
+async def on_new_chapter(update, context, data):
+    await safe_edit_message(update.callback_query, "⌨️ <b>Type Name (Chapter/Channel):</b>", ADMIN_CANCEL_KB)
+    context.user_data['awaiting_chap_name'] = True
+
+# --- Improve mistakes ---
+@route('menu_improve')
+async def on_improve_menu(update, context, data):
+    await safe_edit_message(update.callback_query, "🎯 <b>Select Category:</b>", IMPROVE_MENU_KB)
+
+@route('imp_cat_', prefix=True)
+async def on_improve_category(update, context, data):
+    cat = data.split('_')[2]
+    user_id = update.callback_query.from_user.id
+    subjects = BASE_SUBJECTS if cat == 'BSEB' else list(db["questions"].get(cat, {}).keys())
+    btns = []
+    for s in subjects:
+        n = SRS.count_due(user_id, cat, s)
+        btns.append([InlineKeyboardButton(f"📖 {s}" + (f" • {n} due" if n else ""), callback_data=f'imp_run_{cat}_{s}')])
+    btns.append([InlineKeyboardButton("Back", callback_data='menu_improve')])
+    await safe_edit_message(update.callback_query, f"🛠️ <b>Improve {cat} > Select Subject:</b>", InlineKeyboardMarkup(btns))
+
+@route('imp_run_', prefix=True)
+async def on_improve_run(update, context, data):
+    query = update.callback_query
+    parts = data.split('_')
+    cat, sub = parts[2], parts[3]
+    if not SRS.count_due(query.from_user.id, cat, sub):
+        nxt = SRS.next_due(query.from_user.id, cat, sub)
+        if nxt is None: await query.answer("🎉 No mistakes found!", show_alert=True)
+        else: await query.answer(f"🎉 No reviews due! Next one in {format_wait(nxt - time.time())}.", show_alert=True)
         return
+    context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = sub; context.user_data['quiz_mode'] = 'improve'
+    await ask_time(query)
+
+# --- Subject & source selection ---
+@route('section_BSEB_Hindi')
+async def on_hindi_sections(update, context, data): await open_bseb_hindi_sections(update.callback_query, context)
+
+@route('section_BSEB_English')
+async def on_english_sections(update, context, data): await open_bseb_english_sections(update.callback_query, context)
+
+@route('ask_src_', prefix=True)
+async def on_ask_source(update, context, data): await ask_source_menu(update.callback_query, context, data.replace("ask_src_", ""))
+
+@route('src_book_', prefix=True)
+async def on_source_book(update, context, data):
+    parts = data.split('_')
+    cat, sub = parts[2], parts[3]
+    context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = sub; context.user_data['quiz_mode'] = 'normal'
+    context.user_data['is_youtube_mode'] = False
+    await safe_edit_message(update.callback_query, f"📚 <b>{sub.split('-')[-1]} (Book)</b>", get_book_btns())
+
+@route('src_pyq_', prefix=True)
+async def on_source_pyq(update, context, data):
+    parts = data.split('_')
+    cat, sub_base = parts[2], parts[3]
+    pyq_key = f"{sub_base}-PYQ"
+    context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = pyq_key; context.user_data['quiz_mode'] = 'normal'
+    context.user_data['final_chapters'] = []
+    if not check_q_exists(cat, pyq_key):
+        await update.callback_query.answer("⚠️ Not uploaded yet!", show_alert=True); return
+    await ask_time(update.callback_query)
+
+@route('src_yt_', prefix=True)
+async def on_source_youtube(update, context, data):
+    parts = data.split('_')
+    cat, sub_base = parts[2], parts[3]
+    yt_key = f"{sub_base}-YouTube"
+    context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = yt_key; context.user_data['quiz_mode'] = 'normal'
+    context.user_data['is_youtube_mode'] = True
+    if not check_q_exists(cat, yt_key):
+        await update.callback_query.answer("⚠️ No channels added!", show_alert=True); return
+    await safe_edit_message(update.callback_query, f"▶️ <b>{sub_base} > YouTube</b>", YT_MODE_KB)
+
+@route('sel_sub_', prefix=True)
+async def on_select_subject(update, context, data):
+    parts = data.split('_', 3)
+    cat = parts[2]; sub = parts[3]
+    context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = sub; context.user_data['quiz_mode'] = 'normal'
+    context.user_data['is_youtube_mode'] = False
+    await safe_edit_message(update.callback_query, f"📂 <b>{sub.split('-')[-1]}</b>", get_book_btns())
+
+# --- Chapter selection ---
+@route('mode_single')
+async def on_mode_single(update, context, data): await show_chapter_selection(update.callback_query, context, multi=False, page=0)
+
+@route('mode_mix')
+async def on_mode_mix(update, context, data):
+    context.user_data['selected_chapters'] = []
+    await show_chapter_selection(update.callback_query, context, multi=True, page=0)
+
+@route('pg_sng_', 'pg_mix_', prefix=True)
+async def on_chapter_page(update, context, data):
+    await show_chapter_selection(update.callback_query, context, multi=data.startswith('pg_mix_'), page=int(data.split('_')[2]))
+
+async def resolve_quiz_chapter(query, context, data, multi):
+    # Same token scheme as the admin lists; a stale token redraws the chapter page
+    hit = QINDEX.resolve_chapter_token(data.split('_', 1)[1])
+    if hit is None:
+        await query.answer("⚠️ Please refresh menu", show_alert=True)
+        return None, 0
+    cat, sub, chap, idx = hit
+    if (cat, sub) != (context.user_data.get('quiz_cat'), context.user_data.get('quiz_sub')):
+        context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = sub
+        context.user_data['selected_chapters'] = []
+    if chap is None:
+        await query.answer("🔄 List was updated, please pick again")
+        await show_chapter_selection(query, context, multi=multi, page=idx // 10)
+    return chap, idx
+
+@route('tgl_', prefix=True)
+async def on_toggle_chapter(update, context, data):
+    chap, idx = await resolve_quiz_chapter(update.callback_query, context, data, multi=True)
+    if chap is None: return
+    sel = context.user_data.get('selected_chapters', [])
+    if chap in sel: sel.remove(chap)
+    else: sel.append(chap)
+    context.user_data['selected_chapters'] = sel
+    # Stay on same page
+    await show_chapter_selection(update.callback_query, context, multi=True, page=idx // 10)
+
+@route('confirm_mix')
+async def on_confirm_mix(update, context, data):
+    if not context.user_data.get('selected_chapters'): await update.callback_query.answer("Select one!", show_alert=True); return
+    context.user_data['final_chapters'] = context.user_data['selected_chapters']; await ask_time(update.callback_query)
+
+@route('sng_', prefix=True)
+async def on_single_chapter(update, context, data):
+    chap, _ = await resolve_quiz_chapter(update.callback_query, context, data, multi=False)
+    if chap is None: return
+    context.user_data['final_chapters'] = [chap]
+    await ask_time(update.callback_query)
+
+# --- Quiz settings & stats ---
+@route('time_', prefix=True)
+async def on_time(update, context, data):
+    context.user_data['quiz_time'] = int(data.split('_')[1]); await ask_count(update.callback_query)
+
+@route('count_', prefix=True)
+async def on_count(update, context, data):
+    context.user_data['quiz_count'] = int(data.split('_')[1]); await start_private_quiz(update.callback_query, context)
+
+@route('view_stats')
+async def on_view_stats(update, context, data):
+    query = update.callback_query
+    uid = str(query.from_user.id); stats = db["stats"].get(uid, {})
+    txt = "━━━━━━━━━━━━━━━━━━\n📊 <b>USER STATS</b>\n━━━━━━━━━━━━━━━━━━\n"
+    name = PROFILES.label(query.from_user.id)
+    if name: txt += f"👤 {esc(name)}\n"
+    if stats:
+        for cat, subs in stats.items():
+            txt += f"\n📂 <b>{cat}:</b>"
+            for sub, e in subs.items():
+                d_sub = sub.split('-')[-1]
+                correct = e.get('correct', 0); wrong = e.get('wrong', 0); total = e.get('total', 0)
+                txt += f"\n  - {d_sub}: {total} Qs (✅{correct} | ❌{wrong})"
+    else: txt += "\n❌ No data found."
+    await safe_edit_message(query, txt, SETTINGS_BACK_KB)
+
+@route('bc_stop', access='admin')
+async def on_broadcast_stop(update, context, data):
+    if db.get("broadcast"):
+        BROADCAST["stop"] = True
+        await update.callback_query.answer("⏹️ Stopping after the current batch...")
+
+@route('req_admin')
+async def on_request_admin(update, context, data):
+    query = update.callback_query
+    await context.bot.send_message(OWNER_ID, f"User {query.from_user.id} requested admin."); await query.answer("Request Sent!")
 
-    if data == 'adm_new_chap':
-        await safe_edit_message(query, "⌨️ <b>Type Name (Chapter/Channel):</b>", InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data='menu_admin')]]))
-        context.user_data['awaiting_chap_name'] = True
-        return
 async def master_callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    user_id = query.from_user.id
-    data = query.data
-
-    # 1. MAINTENANCE CHECK
-    if db.get("maintenance_mode", False) and not is_admin(user_id):
+    if db.get("maintenance_mode", False) and not is_admin(query.from_user.id):
         await query.answer("🚧 Bot is under maintenance!", show_alert=True)
         await send_maintenance_msg(update)
         return
-    
-    # 2. JOIN CHECK
-    if data == 'recheck_main':
-        if await check_membership(IDS["MAIN"], user_id, context): await show_main_menu(update, context)
-        else: await query.answer("❌ Join First!", show_alert=True)
-        return
-    
-    if data == 'gate_bseb': 
-        gid = IDS["BSEB"]; link = LINKS["BSEB"]
-        await check_gate(query, context, gid, link, open_bseb_menu, data)
-
-    # 3. BASIC MENUS
-    if data == 'main_menu': await show_main_menu(update, context)
-    elif data == 'menu_settings': await show_settings(update, context)
-    elif data == 'show_help': await show_help(update, context)
-    
-    # 4. ADMIN ROUTING (UPDATED FOR PAGINATION)
-    elif data == 'menu_owner' or data in ['view_admin_list', 'restore_prompt', 'get_backup', 'toggle_maint']: 
-        if data == 'menu_owner': await show_owner_panel(update, context)
-        elif data == 'get_backup': save_db(db); await context.bot.send_document(query.message.chat_id, document=open(DB_FILE, 'rb'), filename="backup.json")
-        elif data == 'toggle_maint':
-            db["maintenance_mode"] = not db.get("maintenance_mode", False)
-            save_db(db)
-            await show_owner_panel(update, context)
-        else: await handle_admin(update, context)
-    elif data == 'add_admin_prompt':
-        context.user_data['awaiting_admin_id'] = True
-        await safe_edit_message(query, "⌨️ <b>Send User ID to add as Admin:</b>", InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data='menu_owner')]]))
-    
-    # *** IMPORTANT: Include new tags (pg_, idx_) here ***
-    elif data.startswith(('menu_admin', 'adm_', 'del_', 'confirm_del', 'pg_adm_', 'pg_del_')): 
-        await handle_admin(update, context)
-    
-    # 5. IMPROVE MISTAKES
-    elif data == 'menu_improve':
-        btns = [[InlineKeyboardButton("BSEB", callback_data='imp_cat_BSEB')], [InlineKeyboardButton("Back", callback_data='main_menu')]]
-        await safe_edit_message(query, "🎯 <b>Select Category:</b>", InlineKeyboardMarkup(btns))
-    elif data.startswith('imp_cat_'):
-        cat = data.split('_')[2]
-        if cat == 'BSEB': subjects = ["Hindi", "English", "Maths", "Biology", "Chemistry", "Physics"]
-        else: subjects = db["questions"].get(cat, {}).keys()
-        btns = [[InlineKeyboardButton(f"📖 {s}", callback_data=f'imp_run_{cat}_{s}')] for s in subjects]
-        btns.append([InlineKeyboardButton("Back", callback_data='menu_improve')])
-        await safe_edit_message(query, f"🛠️ <b>Improve {cat} > Select Subject:</b>", InlineKeyboardMarkup(btns))
-    elif data.startswith('imp_run_'):
-        parts = data.split('_')
-        cat, sub = parts[2], parts[3]
-        mistakes = get_mistake_questions(query.from_user.id, cat, sub)
-        if not mistakes:
-            await query.answer("🎉 No mistakes found!", show_alert=True); return
-        context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = sub; context.user_data['quiz_mode'] = 'improve' 
-        await ask_time(query)
-
-    # 6. SUBJECT SELECTION
-    elif data == 'section_BSEB_Hindi': await open_bseb_hindi_sections(query, context)
-    elif data == 'section_BSEB_English': await open_bseb_english_sections(query, context)
-
-    elif data.startswith('ask_src_'):
-        full_sub = data.replace("ask_src_", "")
-        await ask_source_menu(query, context, full_sub)
-
-    elif data.startswith('src_book_'):
-        parts = data.split('_')
-        cat, sub = parts[2], parts[3]
-        context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = sub; context.user_data['quiz_mode'] = 'normal'
-        context.user_data['is_youtube_mode'] = False
-        await safe_edit_message(query, f"📚 <b>{sub.split('-')[-1]} (Book)</b>", get_book_btns())
-
-    elif data.startswith('src_pyq_'):
-        parts = data.split('_')
-        cat, sub_base = parts[2], parts[3]
-        pyq_key = f"{sub_base}-PYQ"
-        context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = pyq_key; context.user_data['quiz_mode'] = 'normal'
-        context.user_data['final_chapters'] = []
-        if not check_q_exists(cat, pyq_key): 
-            await query.answer("⚠️ Not uploaded yet!", show_alert=True); return
-        await ask_time(query)
-
-    elif data.startswith('src_yt_'):
-        parts = data.split('_')
-        cat, sub_base = parts[2], parts[3]
-        yt_key = f"{sub_base}-YouTube"
-        context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = yt_key; context.user_data['quiz_mode'] = 'normal'
-        context.user_data['is_youtube_mode'] = True
-        if not check_q_exists(cat, yt_key): 
-            await query.answer("⚠️ No channels added!", show_alert=True); return
-        btns = [[InlineKeyboardButton("▶️ Channel Wise (Single)", callback_data='mode_single')], [InlineKeyboardButton("🔀 Mix Channels", callback_data='mode_mix')], [InlineKeyboardButton("Back", callback_data='main_menu')]]
-        await safe_edit_message(query, f"▶️ <b>{sub_base} > YouTube</b>", InlineKeyboardMarkup(btns))
-
-    elif data.startswith('sel_sub_'): 
-        parts = data.split('_', 3)
-        cat = parts[2]; sub = parts[3]
-        context.user_data['quiz_cat'] = cat; context.user_data['quiz_sub'] = sub; context.user_data['quiz_mode'] = 'normal'
-        context.user_data['is_youtube_mode'] = False
-        await safe_edit_message(query, f"📂 <b>{sub.split('-')[-1]}</b>", get_book_btns())
-    
-    # 7. CHAPTER SELECTION (UPDATED FOR PAGINATION)
-    elif data == 'mode_single': await show_chapter_selection(query, context, multi=False, page=0)
-    elif data == 'mode_mix': context.user_data['selected_chapters'] = []; await show_chapter_selection(query, context, multi=True, page=0)
-    
-    # Pagination Handlers
-    elif data.startswith('pg_sng_'):
-        page = int(data.split('_')[2])
-        await show_chapter_selection(query, context, multi=False, page=page)
-    elif data.startswith('pg_mix_'):
-        page = int(data.split('_')[2])
-        await show_chapter_selection(query, context, multi=True, page=page)
-
-    # Index Handlers (Toggle)
-    elif data.startswith('tgl_'):
-        idx = int(data.split('_')[1])
-        chap = context.user_data.get(f'chap_idx_{idx}')
-        
-        if chap:
-            sel = context.user_data.get('selected_chapters', [])
-            if chap in sel: sel.remove(chap)
-            else: sel.append(chap)
-            context.user_data['selected_chapters'] = sel
-            
-            # Stay on same page
-            ITEMS_PER_PAGE = 10
-            current_page = idx // ITEMS_PER_PAGE
-            await show_chapter_selection(query, context, multi=True, page=current_page)
-        else:
-            await query.answer("⚠️ Please refresh menu", show_alert=True)
-
-    elif data == 'confirm_mix':
-        if not context.user_data.get('selected_chapters'): await query.answer("Select one!", show_alert=True); return
-        context.user_data['final_chapters'] = context.user_data['selected_chapters']; await ask_time(query)
-    
-    # Index Handlers (Single)
-    elif data.startswith('sng_'):
-        idx = int(data.split('_')[1])
-        chap = context.user_data.get(f'chap_idx_{idx}')
-        if chap:
-            context.user_data['final_chapters'] = [chap]
-            await ask_time(query)
-        else:
-            await query.answer("⚠️ Please refresh menu", show_alert=True)
-
-    # 8. QUIZ SETTINGS & STATS
-    elif data.startswith('time_'): context.user_data['quiz_time'] = int(data.split('_')[1]); await ask_count(query)
-    elif data.startswith('count_'): context.user_data['quiz_count'] = int(data.split('_')[1]); await start_private_quiz(query, context)
-    
-    elif data == 'view_stats': 
-        uid = str(query.from_user.id); stats = db["stats"].get(uid, {})
-        txt = "━━━━━━━━━━━━━━━━━━\n📊 <b>USER STATS</b>\n━━━━━━━━━━━━━━━━━━\n"
-        if stats:
-            for cat, subs in stats.items():
-                txt += f"\n📂 <b>{cat}:</b>"
-                for sub, data in subs.items():
-                    d_sub = sub.split('-')[-1]
-                    correct = data.get('correct', 0); wrong = data.get('wrong', 0); total = data.get('total', 0)
-                    txt += f"\n  - {d_sub}: {total} Qs (✅{correct} | ❌{wrong})"
-        else: txt += "\n❌ No data found."
-        await safe_edit_message(query, txt, InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data='menu_settings')]]))
-    elif data == 'req_admin': 
-        await context.bot.send_message(OWNER_ID, f"User {query.from_user.id} requested admin."); await query.answer("Request Sent!")
-
-
-            
+    await ROUTER.dispatch(update, context, query.data)
 
 
 # ==========================================
 # 8. MENU LOGIC FUNCTIONS
 # ==========================================
+BOOK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("📖 Chapter Wise", callback_data='mode_single')], [InlineKeyboardButton("🔀 Mix / Custom", callback_data='mode_mix')], [InlineKeyboardButton("Back", callback_data='main_menu')]])
+BSEB_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📖 Hindi", callback_data='section_BSEB_Hindi'), InlineKeyboardButton("📖 English", callback_data='section_BSEB_English')],
+    [InlineKeyboardButton("🔢 Maths", callback_data='ask_src_BSEB_Maths'), InlineKeyboardButton("🧬 Biology", callback_data='ask_src_BSEB_Biology')],
+    [InlineKeyboardButton("🧪 Chemistry", callback_data='ask_src_BSEB_Chemistry'), InlineKeyboardButton("⚛️ Physics", callback_data='ask_src_BSEB_Physics')],
+    [InlineKeyboardButton("Back", callback_data='main_menu')]
+])
+HINDI_SECTIONS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 गद्य खण्ड", callback_data='sel_sub_BSEB_Hindi-Gadya')],
+    [InlineKeyboardButton("📜 पद्य खण्ड", callback_data='sel_sub_BSEB_Hindi-Padya')],
+    [InlineKeyboardButton("🔤 व्याकरण", callback_data='sel_sub_BSEB_Hindi-Grammar')],
+    [InlineKeyboardButton("🧩 PYQ", callback_data='src_pyq_BSEB_Hindi')],
+    [InlineKeyboardButton("▶️ YouTube", callback_data='src_yt_BSEB_Hindi')],
+    [InlineKeyboardButton("Back", callback_data='gate_bseb')]
+])
+ENGLISH_SECTIONS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Prose", callback_data='sel_sub_BSEB_English-Prose')],
+    [InlineKeyboardButton("📜 Poetry", callback_data='sel_sub_BSEB_English-Poetry')],
+    [InlineKeyboardButton("🔤 Grammar", callback_data='sel_sub_BSEB_English-Grammar')],
+    [InlineKeyboardButton("🧩 PYQ", callback_data='src_pyq_BSEB_English')],
+    [InlineKeyboardButton("▶️ YouTube", callback_data='src_yt_BSEB_English')],
+    [InlineKeyboardButton("Back", callback_data='gate_bseb')]
+])
+TIME_KB = InlineKeyboardMarkup([[InlineKeyboardButton(f"{t}s", callback_data=f"time_{t}") for t in [15, 30, 45, 60]],
+                                [InlineKeyboardButton("Cancel", callback_data='main_menu')]])
+QUIZ_COUNTS = [10, 20, 30, 50, 100, 150, 200, 300, 400, 500]
+COUNT_KB = InlineKeyboardMarkup([[InlineKeyboardButton(f"{c} Qs", callback_data=f"count_{c}") for c in QUIZ_COUNTS[i:i+3]] for i in range(0, len(QUIZ_COUNTS), 3)]
+                                + [[InlineKeyboardButton("Cancel", callback_data='main_menu')]])
+
+@lru_cache(maxsize=32)
+def source_keyboard(subject):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📚 Book", callback_data=f'src_book_{subject}')],
+        [InlineKeyboardButton("🧩 PYQ", callback_data=f'src_pyq_{subject}')],
+        [InlineKeyboardButton("▶️ YouTube", callback_data=f'src_yt_{subject}')],
+        [InlineKeyboardButton("⬅️ Back", callback_data='gate_bseb')]
+    ])
+
 def get_book_btns():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("📖 Chapter Wise", callback_data='mode_single')], [InlineKeyboardButton("🔀 Mix / Custom", callback_data='mode_mix')], [InlineKeyboardButton("Back", callback_data='main_menu')]])
+    return BOOK_KB
 
 def check_q_exists(cat, sub):
     return bool(db["questions"].get(cat, {}).get(sub))
 
 async def open_bseb_menu(query, context):
-    btns = [
-        [InlineKeyboardButton("📖 Hindi", callback_data='section_BSEB_Hindi'), InlineKeyboardButton("📖 English", callback_data='section_BSEB_English')],
-        [InlineKeyboardButton("🔢 Maths", callback_data='ask_src_BSEB_Maths'), InlineKeyboardButton("🧬 Biology", callback_data='ask_src_BSEB_Biology')],
-        [InlineKeyboardButton("🧪 Chemistry", callback_data='ask_src_BSEB_Chemistry'), InlineKeyboardButton("⚛️ Physics", callback_data='ask_src_BSEB_Physics')],
-        [InlineKeyboardButton("Back", callback_data='main_menu')]
-    ]
-    await safe_edit_message(query, "📚 <b>BSEB Subjects</b>", InlineKeyboardMarkup(btns))
+    await safe_edit_message(query, "📚 <b>BSEB Subjects</b>", BSEB_MENU_KB)
 
 async def open_bseb_hindi_sections(query, context):
-    btns = [
-        [InlineKeyboardButton("📝 गद्य खण्ड", callback_data='sel_sub_BSEB_Hindi-Gadya')],
-        [InlineKeyboardButton("📜 पद्य खण्ड", callback_data='sel_sub_BSEB_Hindi-Padya')],
-        [InlineKeyboardButton("🔤 व्याकरण", callback_data='sel_sub_BSEB_Hindi-Grammar')],
-        [InlineKeyboardButton("🧩 PYQ", callback_data='src_pyq_BSEB_Hindi')],
-        [InlineKeyboardButton("▶️ YouTube", callback_data='src_yt_BSEB_Hindi')],
-        [InlineKeyboardButton("Back", callback_data='gate_bseb')]
-    ]
-    await safe_edit_message(query, "📚 <b>Hindi Sections:</b>", InlineKeyboardMarkup(btns))
+    await safe_edit_message(query, "📚 <b>Hindi Sections:</b>", HINDI_SECTIONS_KB)
 
 async def open_bseb_english_sections(query, context):
-    btns = [
-        [InlineKeyboardButton("📝 Prose", callback_data='sel_sub_BSEB_English-Prose')],
-        [InlineKeyboardButton("📜 Poetry", callback_data='sel_sub_BSEB_English-Poetry')],
-        [InlineKeyboardButton("🔤 Grammar", callback_data='sel_sub_BSEB_English-Grammar')],
-        [InlineKeyboardButton("🧩 PYQ", callback_data='src_pyq_BSEB_English')],
-        [InlineKeyboardButton("▶️ YouTube", callback_data='src_yt_BSEB_English')],
-        [InlineKeyboardButton("Back", callback_data='gate_bseb')]
-    ]
-    await safe_edit_message(query, "📚 <b>English Sections:</b>", InlineKeyboardMarkup(btns))
+    await safe_edit_message(query, "📚 <b>English Sections:</b>", ENGLISH_SECTIONS_KB)
 
 async def ask_source_menu(query, context, subject):
     real_sub = subject.replace("BSEB_", "") 
-    btns = [
-        [InlineKeyboardButton("📚 Book", callback_data=f'src_book_{subject}')],
-        [InlineKeyboardButton("🧩 PYQ", callback_data=f'src_pyq_{subject}')],
-        [InlineKeyboardButton("▶️ YouTube", callback_data=f'src_yt_{subject}')],
-        [InlineKeyboardButton("⬅️ Back", callback_data='gate_bseb')]
-    ]
-    await safe_edit_message(query, f"📂 <b>{real_sub} > Select Source:</b>", InlineKeyboardMarkup(btns))
+    await safe_edit_message(query, f"📂 <b>{real_sub} > Select Source:</b>", source_keyboard(subject))
 
 async def show_chapter_selection(query, context, multi, page=0):
     cat = context.user_data.get('quiz_cat')
@@ -847,23 +3095,20 @@ async def show_chapter_selection(query, context, multi, page=0):
     # Database Initialization Check
     if cat not in db["questions"] or sub not in db["questions"][cat]:
         if cat in db["questions"]: db["questions"][cat][sub] = {}
-        save_db(db)
     
     chapters = db["questions"][cat][sub]
     disp_sub = sub.split('-')[-1]
     is_yt = context.user_data.get('is_youtube_mode', False)
     
-    if not chapters: 
+    # 1. SORTED CHAPTERS (cached in the index until an admin adds/removes one)
+    all_chaps, version = QINDEX.chapter_list(cat, sub)
+    if not all_chaps: 
         await query.answer(f"⚠️ No {'Channels' if is_yt else 'Chapters'} available!", show_alert=True)
         return
         
     btns = []
     sel = context.user_data.get('selected_chapters', [])
     
-    # 1. SORTING & PAGINATION LOGIC
-    # Always sort keys to ensure index stays consistent
-    all_chaps = sorted(list(chapters.items()), key=lambda x: x[0]) 
-    
     ITEMS_PER_PAGE = 10 
     total_items = len(all_chaps)
     total_pages = (total_items + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
@@ -876,22 +3121,17 @@ async def show_chapter_selection(query, context, multi, page=0):
     end_idx = start_idx + ITEMS_PER_PAGE
     current_page_chaps = all_chaps[start_idx:end_idx]
     
-    # 2. GENERATE BUTTONS WITH INDEX MAPPING
-    for i, (chap, qs) in enumerate(current_page_chaps):
-        count = len(qs)
-        global_idx = start_idx + i  # Unique ID for this chapter across all pages
-        
-        # SAVE MAPPING: Index -> Real Name (Crucial Step)
-        context.user_data[f'chap_idx_{global_idx}'] = chap
-        
+    # 2. BUTTONS: callback data is a (subject, version, index) token resolved against the index
+    token = f"{subject_token(cat, sub)}.{version}."
+    for i, chap in enumerate(current_page_chaps):
+        count = len(chapters.get(chap, ()))
+        global_idx = to_base36(start_idx + i)
         if multi:
             icon = "✅" if chap in sel else "⬜"
-            # Callback data is now short: tgl_0, tgl_1, etc.
-            btns.append([InlineKeyboardButton(f"{icon} {chap} [{count}]", callback_data=f'tgl_{global_idx}')])
+            btns.append([InlineKeyboardButton(f"{icon} {chap} [{count}]", callback_data=f'tgl_{token}{global_idx}')])
         else:
             icon = "▶️" if is_yt else "📄"
-            # Callback data is now short: sng_0, sng_1, etc.
-            btns.append([InlineKeyboardButton(f"{icon} {chap} [{count}]", callback_data=f'sng_{global_idx}')])
+            btns.append([InlineKeyboardButton(f"{icon} {chap} [{count}]", callback_data=f'sng_{token}{global_idx}')])
             
     # 3. NAVIGATION BUTTONS
     pag_btns = []
@@ -921,14 +3161,156 @@ async def show_chapter_selection(query, context, multi, page=0):
 
             
 async def ask_time(query):
-    btns = [InlineKeyboardButton(f"{t}s", callback_data=f"time_{t}") for t in [15, 30, 45, 60]]
-    await safe_edit_message(query, "⏱️ <b>Per Question Time:</b>", InlineKeyboardMarkup([btns, [InlineKeyboardButton("Cancel", callback_data='main_menu')]]))
+    await safe_edit_message(query, "⏱️ <b>Per Question Time:</b>", TIME_KB)
 
 async def ask_count(query):
-    counts = [10, 20, 30, 50, 100, 150, 200, 300, 400, 500]
-    btns = [[InlineKeyboardButton(f"{c} Qs", callback_data=f"count_{c}") for c in counts[i:i+3]] for i in range(0, len(counts), 3)]
-    btns.append([InlineKeyboardButton("Cancel", callback_data='main_menu')])
-    await safe_edit_message(query, "🔢 <b>Question Count:</b>", InlineKeyboardMarkup(btns))
+    await safe_edit_message(query, "🔢 <b>Question Count:</b>", COUNT_KB)
+
+# ==========================================
+# 8.1 STAGED RESTORE FLOW
+# ==========================================
+async def stage_restore(update, context, doc):
+    fd, path = tempfile.mkstemp(suffix='.restore')
+    os.close(fd)
+    status = await update.message.reply_text("⏳ Checking backup...")
+    try:
+        f = await doc.get_file()
+        await f.download_to_drive(path)
+        manifest, staged = await asyncio.to_thread(stage_restore_file, path)
+    except Exception as e:
+        await status.edit_text(f"❌ <b>Restore rejected:</b> {esc(e)}\nLive database unchanged.", parse_mode='HTML')
+        return
+    finally:
+        try: os.remove(path)
+        except OSError: pass
+
+    RESTORE["staged"] = staged
+    live, new = db_counts(db), db_counts(staged)
+    if WORKERS > 1: live["users"] = await asyncio.to_thread(get_store().count_users)   # db holds only our users
+    lines = [f"{'Questions':<10} {live['questions']:>7} → {new['questions']}",
+             f"{'Chapters':<10} {live['chapters']:>7} → {new['chapters']}",
+             f"{'Users':<10} {live['users']:>7} → {new['users']}",
+             f"{'Admins':<10} {live['admins']:>7} → {new['admins']}"]
+    txt = (f"♻️ <b>Restore ready</b> ({esc(manifest.get('type', 'full'))})\n"
+           f"<pre>{esc(chr(10).join(lines))}</pre>\n"
+           "Running quizzes and in-flight polls are kept.")
+    btns = [[InlineKeyboardButton("✅ Confirm Restore", callback_data='restore_confirm'), InlineKeyboardButton("❌ Cancel", callback_data='restore_cancel')]]
+    await status.edit_text(txt, reply_markup=InlineKeyboardMarkup(btns), parse_mode='HTML')
+
+async def swap_db(new_db):
+    # install_db + flush, under DB_LOCK; returns the rollback copy. Worker mode: the live db holds only
+    # this worker's users and sessions, so the copy is every row in the store, taken after our pending
+    # writes, and afterwards we keep only our own rows again like the other workers do
+    if WORKERS < 2:
+        old = install_db(new_db)
+        await flush_db()
+        return old
+    await flush_db()
+    old = await asyncio.to_thread(lambda: normalize_db(get_store().load()))
+    install_db(new_db, refs=live_qids(old))
+    await reload_from_store()
+    return old
+
+async def handle_restore_action(query, context, data):
+    if query.from_user.id != OWNER_ID: return
+    if data == 'restore_cancel':
+        RESTORE["staged"] = None
+        await safe_edit_message(query, "❌ Restore cancelled. Live database unchanged.", InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data='menu_owner')]]))
+    elif data == 'restore_confirm':
+        staged = RESTORE["staged"]
+        if not staged:
+            await query.answer("⚠️ Nothing staged. Upload the backup again.", show_alert=True); return
+        RESTORE["staged"] = None
+        async with DB_LOCK:
+            RESTORE["previous"] = await swap_db(staged)
+        btns = [[InlineKeyboardButton("↩️ Rollback", callback_data='restore_rollback')], [InlineKeyboardButton("Back", callback_data='menu_owner')]]
+        await safe_edit_message(query, "♻️ <b>DB Restored!</b>\nThe previous database is kept for rollback.", InlineKeyboardMarkup(btns))
+    elif data == 'restore_rollback':
+        previous = RESTORE["previous"]
+        if not previous:
+            await query.answer("⚠️ Nothing to roll back.", show_alert=True); return
+        async with DB_LOCK:
+            RESTORE["previous"] = await swap_db(previous)
+        btns = [[InlineKeyboardButton("↪️ Redo Restore", callback_data='restore_rollback')], [InlineKeyboardButton("Back", callback_data='menu_owner')]]
+        await safe_edit_message(query, "↩️ <b>Rolled back</b> to the previous database.", InlineKeyboardMarkup(btns))
+
+# ==========================================
+# 8.2 BULK QUESTION IMPORTER
+# ==========================================
+IMPORT_BATCH = 500
+
+def parse_question_file(path, known_texts):
+    # Runs in a worker thread. Streams "question | a | b | c | d | n" lines (with optional
+    # "Chapter: name" headers) and returns (records, duplicates, rejects).
+    records, rejects = [], []
+    duplicates = 0
+    seen = set()
+    cur_chap = "General"
+    with open(path, 'r', encoding='utf-8-sig', errors='replace') as f:
+        for line_no, raw in enumerate(f, 1):
+            line = raw.strip()
+            if not line: continue
+            if line.lower().startswith('chapter:'):
+                name = line.split(':', 1)[1].strip()
+                if name: cur_chap = name
+                else: rejects.append((line_no, "empty chapter name", line))
+                continue
+            parts = [p.strip() for p in line.split('|')]
+            if len(parts) != 6:
+                rejects.append((line_no, f"expected 6 fields, got {len(parts)}", line)); continue
+            question, options, correct = parts[0], parts[1:5], parts[5]
+            if not question or not all(options):
+                rejects.append((line_no, "empty question or option", line)); continue
+            try: correct = int(correct)
+            except ValueError:
+                rejects.append((line_no, f"answer '{correct}' is not a number", line)); continue
+            correct -= 1
+            problem = question_problem(question, options, correct)
+            if problem:
+                rejects.append((line_no, problem, line)); continue
+            if question in known_texts or question in seen:
+                duplicates += 1; continue
+            seen.add(question)
+            records.append((cur_chap, question, options, correct))
+    return records, duplicates, rejects
+
+async def import_question_file(update, context, doc, cat, sub):
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        f = await doc.get_file()
+        await f.download_to_drive(path)
+        records, duplicates, rejects = await asyncio.to_thread(parse_question_file, path, QINDEX.subject_texts(cat, sub))
+    finally:
+        try: os.remove(path)
+        except OSError: pass
+
+    # Commit in batches so a huge file never holds the event loop for long; DB_LOCK keeps
+    # other content edits (or a restore swapping db) out between batches
+    imported = 0
+    async with DB_LOCK:
+        chapters = db["questions"][cat][sub]
+        for i in range(0, len(records), IMPORT_BATCH):
+            changes = [("meta",)]
+            for chap, question, options, correct in records[i:i + IMPORT_BATCH]:
+                if QINDEX.has_text(cat, sub, question):
+                    duplicates += 1; continue
+                if chap not in chapters:
+                    chapters[chap] = []
+                    changes.append(("chapter", cat, sub, chap))
+                q = new_question(question, options, correct)
+                chapters[chap].append(q)
+                QINDEX.add(cat, sub, chap, q)
+                changes.append(("question", cat, sub, chap, len(chapters[chap]) - 1))
+                imported += 1
+            mark_dirty(*changes)
+            await asyncio.sleep(0)
+
+    await update.message.reply_text(
+        f"✅ {imported} Questions Imported!\n♻️ Duplicates skipped: {duplicates}\n❌ Rejected: {len(rejects)}")
+    if rejects:
+        report = "\n".join(f"line {n}: {reason} :: {line}" for n, reason, line in rejects)
+        await update.message.reply_document(document=report.encode('utf-8'), filename="rejected_lines.txt")
 
 # ==========================================
 # 9. HANDLERS (COMMANDS)
@@ -946,7 +3328,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get('awaiting_admin_id') and user_id == OWNER_ID:
         try:
             new_id = int(text)
-            if new_id not in db["admins"]: db["admins"].append(new_id); save_db(db)
+            if new_id not in db["admins"]:
+                db["admins"].append(new_id); mark_dirty(("admins",))
+                await adopt_users([new_id])   # worker mode: the new admin's updates now come here
             await update.message.reply_text("✅ User Added")
         except: await update.message.reply_text("Invalid ID")
         context.user_data['awaiting_admin_id'] = False
@@ -954,31 +3338,50 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if context.user_data.get('awaiting_chap_name') and is_admin(user_id):
         cat, sub = context.user_data['adm_cat'], context.user_data['adm_sub']
-        if text not in db["questions"][cat][sub]: 
-            db["questions"][cat][sub][text] = []
-            save_db(db)
-            await update.message.reply_text(f"✅ Created: '{text}'")
+        async with DB_LOCK:
+            created = text not in db["questions"][cat][sub]
+            if created:
+                db["questions"][cat][sub][text] = []
+                QINDEX.add_chapter(cat, sub, text)
+                mark_dirty(("chapter", cat, sub, text))
+        if created: await update.message.reply_text(f"✅ Created: '{text}'")
         context.user_data['awaiting_chap_name'] = False
         return
 
     if context.user_data.get('awaiting_broadcast_msg') and is_admin(user_id):
-        users = db.get("all_users", [])
-        if not users: users = list(map(int, db["stats"].keys()))
-        await update.message.reply_text(f"⏳ Sending to {len(users)} users...")
-        for uid in users:
-            try: 
-                await context.bot.send_message(uid, f"📢 <b>Announcement:</b>\n\n{esc(text)}", parse_mode='HTML')
-                await asyncio.sleep(0.1)
-            except: pass
-        await update.message.reply_text("✅ Broadcast Done."); context.user_data['awaiting_broadcast_msg'] = False
+        context.user_data['awaiting_broadcast_msg'] = False
+        async with DB_LOCK:
+            if db.get("broadcast"):
+                await update.message.reply_text("⚠️ A broadcast is already running.")
+                return
+            users = await broadcast_targets()
+            status = await update.message.reply_text(f"⏳ Sending to {len(users)} users...")
+            db["broadcast"] = {
+                "text": f"📢 <b>Announcement:</b>\n\n{esc(text)}", "chat": status.chat_id, "msg": status.message_id,
+                "by": user_id, "started": time.time(), "cursor": 0, "total": len(users),
+                "sent": 0, "failed": 0, "blocked": []
+            }
+            mark_dirty(("meta",))
+        start_broadcast_task(context.application)
 
 async def handle_poll_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id): return
     if context.user_data.get('adm_mode') != 'active': return
     poll = update.message.poll
     cat, sub, chap = context.user_data['adm_cat'], context.user_data['adm_sub'], context.user_data['adm_chap']
-    q_data = {"question": poll.question, "options": [o.text for o in poll.options], "correct": poll.correct_option_id}
-    db["questions"][cat][sub][chap].append(q_data); save_db(db); await update.message.reply_text("✅ Saved!")
+    options = [o.text for o in poll.options]
+    problem = question_problem(poll.question, options, poll.correct_option_id)
+    if problem:
+        await update.message.reply_text(f"❌ Not saved: {problem}")
+        return
+    q_data = new_question(poll.question, options, poll.correct_option_id)
+    async with DB_LOCK:
+        qs = db["questions"].get(cat, {}).get(sub, {}).get(chap)
+        if qs is not None:
+            qs.append(q_data); QINDEX.add(cat, sub, chap, q_data)
+            mark_dirty(("question", cat, sub, chap, len(qs) - 1), ("meta",))
+    if qs is None: await update.message.reply_text("❌ Not saved: this chapter was deleted.")
+    else: await update.message.reply_text("✅ Saved!")
 
 
 
@@ -987,63 +3390,50 @@ async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE)
     doc = update.message.document
     
     # Database/Backup Restore Logic
-    if user_id == OWNER_ID and (doc.file_name == 'database.json' or doc.file_name == 'backup.json'):
-        f = await doc.get_file()
-        await f.download_to_drive(DB_FILE)
-        global db
-        db = load_db()
-        await update.message.reply_text("♻️ DB Restored!")
+    if user_id == OWNER_ID and (doc.file_name in ('database.json', 'backup.json') or doc.file_name.endswith('.json.gz')):
+        await stage_restore(update, context, doc)
         return
 
     # Text File Upload Logic (Questions Add karna)
     if is_admin(user_id) and doc.file_name.endswith('.txt'):
-        f = await doc.get_file()
-        content = await f.download_as_bytearray()
-        text_data = content.decode('utf-8')
-        
         cat, sub = context.user_data.get('adm_cat'), context.user_data.get('adm_sub')
         if not cat or not sub: 
             await update.message.reply_text("⚠️ Select Subject First!")
             return
-            
-        cur_chap = "General"
-        count = 0
-        
-        # YEH HAI WO LOOP JO SAHI JAGAH HONA CHAHIYE
-        for line in text_data.split('\n'):
-            line = line.strip()
-            if not line: continue
-            
-            # Chapter detect karna aur naam chhota karna
-            if line.lower().startswith('chapter:'): 
-                raw_chap = line.split(':', 1)[1].strip()
-                cur_chap = raw_chap[:30]  # Crash fix: Limit name to 30 chars
-                continue
-            
-            # Question parse karna
-            parts = [p.strip() for p in line.split('|')]
-            if len(parts) >= 6:
-                try:
-                    q = {"question": parts[0], "options": parts[1:5], "correct": int(parts[-1])-1}
-                    if cur_chap not in db["questions"][cat][sub]: 
-                        db["questions"][cat][sub][cur_chap] = []
-                    db["questions"][cat][sub][cur_chap].append(q)
-                    count += 1
-                except: pass
-                
-        save_db(db)
-        await update.message.reply_text(f"✅ {count} Questions Imported!")
+        await import_question_file(update, context, doc, cat, sub)
 
 
 async def done_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.user_data.get('quiz_active'):
+    chat, user_id = update.effective_chat, update.effective_user.id
+    if chat.type in ('group', 'supergroup'):
+        # Only an admin can stop the chat's group quiz
+        if is_admin(user_id): await QUIZ.abort(chat.id)
+        return
+    if not await QUIZ.abort(user_id):
         await update.message.reply_text("⚠️ Koi quiz chal nahi raha hai.")
         await show_main_menu(update, context)
+
+async def group_quiz_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /groupquiz [count] [seconds] in a group: runs the admin's last private subject/chapter pick for everyone
+    chat, user_id = update.effective_chat, update.effective_user.id
+    if chat.type not in ('group', 'supergroup') or not is_admin(user_id): return
+    cat, sub = context.user_data.get('quiz_cat'), context.user_data.get('quiz_sub')
+    if not cat or not sub:
+        await update.message.reply_text("⚠️ Pick a subject/chapter in private chat with the bot first, then run /groupquiz here.")
         return
-    context.user_data['stop_quiz_flag'] = True
-    if 'futures' in context.user_data:
-        for poll_id, future in context.user_data['futures'].items():
-            if not future.done(): future.cancel() 
+    try:
+        count = max(1, min(int(context.args[0]), GROUP_MAX_QUESTIONS)) if context.args else 10
+        seconds = max(10, min(int(context.args[1]), 300)) if len(context.args) > 1 else 30
+    except ValueError:
+        await update.message.reply_text("❌ Usage: /groupquiz [count] [seconds]")
+        return
+    chaps = context.user_data.get('final_chapters') if context.user_data.get('quiz_mode') != 'improve' else None
+    questions = get_random_questions(cat, sub, chaps, count)
+    if not questions:
+        await update.message.reply_text("❌ No questions available.")
+        return
+    QUIZ.begin(chat.id, user_id, cat, sub, 'group', seconds, [q.id for q in questions], delay=3)
+    await update.message.reply_text(f"🎯 <b>Group Quiz:</b> {esc(sub)}\n{len(questions)} questions • {seconds}s each\nStarting in 3s — everyone can answer!", parse_mode='HTML')
 
 async def remove_admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID: return
@@ -1055,7 +3445,7 @@ async def remove_admin_command(update: Update, context: ContextTypes.DEFAULT_TYP
         target_id = int(context.args[0])
         if target_id in db["admins"]:
             db["admins"].remove(target_id)
-            save_db(db)
+            mark_dirty(("admins",))
             await update.message.reply_text(f"✅ User ID {target_id} removed.")
         else:
             await update.message.reply_text("⚠️ User not in admin list.")
@@ -1122,27 +3512,281 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
             db["user_data"][uid_str]["seen_intro"] = True
-            save_db(db)
+            mark_dirty(("user", uid_str))
             
             await update.message.reply_text(intro_text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔥 Let's Start", callback_data='main_menu')]]))
             return
 
         await show_main_menu(update, context)
 
+class UserOrderedProcessor(BaseUpdateProcessor):
+    # Runs up to `limit` updates at once while updates from the same user (or chat, for updates
+    # without a user) run one at a time in arrival order. The base-class semaphore only bounds how
+    # many updates may be pending, so one user's backlog waiting on its lock never starves the rest.
+    def __init__(self, limit):
+        super().__init__(max(limit * 16, 256))
+        self.running = asyncio.Semaphore(limit)
+        self.keys = {}   # key -> [asyncio.Lock, updates holding or waiting for it]
+
+    @staticmethod
+    def key_of(update):
+        if not isinstance(update, Update): return None
+        if update.effective_user: return update.effective_user.id
+        return update.effective_chat.id if update.effective_chat else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.key_of(update)
+        if key is None:
+            async with self.running: await coroutine
+            return
+        entry = self.keys.get(key)
+        if entry is None: entry = self.keys[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.running: await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]: del self.keys[key]
+
+    async def initialize(self): pass
+
+    async def shutdown(self): pass
+
+def build_application(token, base_url=None):
+    # base_url points the bot at another Bot API server (e.g. the load-test fake in loadtest/)
+    req = MetricsRequest(connect_timeout=180.0, read_timeout=180.0)
+    builder = ApplicationBuilder().token(token).request(req).post_init(on_startup).post_shutdown(on_shutdown)
+    if base_url: builder = builder.base_url(base_url)
+    if CONCURRENT_UPDATES > 1: builder = builder.concurrent_updates(UserOrderedProcessor(CONCURRENT_UPDATES))
+    app = builder.build()
+    app.job_queue.run_repeating(flush_db_job, interval=FLUSH_INTERVAL, first=FLUSH_INTERVAL)
+    app.job_queue.run_repeating(evict_polls_job, interval=30, first=30)
+    if WORKER_ID <= 0: app.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL)
+    app.job_queue.run_repeating(analytics_job, interval=300, first=60)
+    app.add_handler(TypeHandler(Update, record_profile), group=-1)
+    app.add_handler(CommandHandler("start", instrumented("start", start)))
+    app.add_handler(CommandHandler("done", instrumented("done", done_command)))
+    app.add_handler(CommandHandler("groupquiz", instrumented("groupquiz", group_quiz_command)))
+    app.add_handler(CommandHandler("removeadmin", instrumented("removeadmin", remove_admin_command)))
+    app.add_handler(CallbackQueryHandler(instrumented("callback", master_callback_router)))
+    app.add_handler(MessageHandler(filters.POLL & filters.User(OWNER_ID), instrumented("poll_upload", handle_poll_upload)))
+    app.add_handler(MessageHandler(filters.Document.ALL, instrumented("file_upload", handle_file_upload)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented("text", handle_text)))
+    app.add_handler(PollAnswerHandler(instrumented("poll_answer", handle_poll_answer)))
+    return app
+
+# ==========================================
+# 10. WORKER PROCESSES
+# ==========================================
+# WORKERS > 1: this process becomes a front that receives updates (webhook, or long polling when
+# WEBHOOK_URL is unset) and queues each one to one of WORKERS bot processes. A user always lands on
+# the same worker, so their stats, mistakes and quiz stay single-writer; the owner, admins and
+# updates without a user go to worker 0, which owns the content (questions, admins, settings).
+# Every worker loads the whole question bank but only its own users, polls and quiz sessions
+# (SQLiteStore.load(owner)), so TTL eviction and checkpoints never touch another worker's rows.
+# Workers share the SQLite file (WAL). After worker 0 commits a content change the front fans out an
+# invalidation and the other workers reload just the touched chapters into their QINDEX.
+ROUTE_HOLD = 5   # seconds an answer to a poll the front hasn't heard about yet waits for its route
+FRONT = {"inboxes": None,          # front: one queue per worker
+         "polls": OrderedDict(),   # poll_id -> worker that sent it
+         "held": {},               # poll_id -> [(monotonic time, update)] waiting for that route
+         "lock": threading.Lock()}
+BUS = {"outbox": None}             # worker: queue back to the front
+
+def owns_user(user_id):
+    return WORKERS < 2 or partition(user_id) == WORKER_ID
+
+def send_to_front(msg):
+    BUS["outbox"].put_nowait(msg)
+
+# --- Front ---
+def route_update(data):
+    for kind in UPDATE_TYPES:
+        body = data.get(kind)
+        if isinstance(body, dict):
+            user = body.get("from") or body.get("user")
+            return partition(user["id"]) if user else 0
+    return 0
+
+def dispatch_update(data):
+    answer = data.get("poll_answer")
+    if answer:
+        # Poll answers go to the worker that sent the poll. Its route is reported only once send_poll
+        # returns, so an early answer waits (up to ROUTE_HOLD) instead of landing on the wrong worker.
+        poll_id = answer.get("poll_id")
+        with FRONT["lock"]:
+            worker = FRONT["polls"].get(poll_id)
+            if worker is None:
+                FRONT["held"].setdefault(poll_id, []).append((time.monotonic(), data)); return
+        FRONT["inboxes"][worker].put(("update", data)); return
+    FRONT["inboxes"][route_update(data)].put(("update", data))
+
+def release_held(poll_id=None, worker=None):
+    # With a route: flush that poll's held answers to it. Without: expired ones fall back to the user's worker.
+    with FRONT["lock"]:
+        if poll_id is not None: batches = [(worker, FRONT["held"].pop(poll_id, ()))]
+        else:
+            now = time.monotonic()
+            expired = [p for p, items in FRONT["held"].items() if now - items[0][0] > ROUTE_HOLD]
+            batches = [(None, FRONT["held"].pop(p)) for p in expired]
+    for worker, items in batches:
+        for _, data in items: FRONT["inboxes"][route_update(data) if worker is None else worker].put(("update", data))
+
+def front_listen(outbox):
+    # Worker -> front: poll routes, answers for rows another worker owns, content invalidations
+    inboxes = FRONT["inboxes"]
+    while True:
+        try: msg = outbox.get(timeout=1)
+        except Empty:
+            release_held(); continue
+        kind = msg[0]
+        if kind == "poll":
+            with FRONT["lock"]:
+                FRONT["polls"][msg[1]] = msg[2]
+                if len(FRONT["polls"]) > MAX_INFLIGHT_POLLS: FRONT["polls"].popitem(last=False)
+            release_held(msg[1], msg[2])
+        elif kind == "stats": inboxes[partition(msg[1])].put(msg)
+        elif kind == "qstat": inboxes[0].put(msg)
+        elif kind == "content":
+            if msg[2]: db["admins"] = msg[2]["admins"]
+            for inbox in inboxes[1:]: inbox.put(msg)
+        if FRONT["held"]: release_held()
+
+async def poll_updates(bot):
+    # Long-polling front: getUpdates here and hand every update to its worker
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try: updates = await bot.get_updates(offset=offset, timeout=10, allowed_updates=Update.ALL_TYPES)
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e)); continue
+        except TelegramError as e:
+            logging.error(f"getUpdates Error: {e}")
+            await asyncio.sleep(1); continue
+        for update in updates:
+            offset = update.update_id + 1
+            dispatch_update(update.to_dict())
+
+def run_workers(base_url=None):
+    if DB_BACKEND != 'sqlite':
+        print("❌ WORKERS > 1 needs DB_BACKEND=sqlite")
+        return
+    ctx = multiprocessing.get_context('spawn')
+    outbox = ctx.Queue()
+    FRONT["inboxes"] = [ctx.Queue() for _ in range(WORKERS)]
+    procs = []
+    for i, inbox in enumerate(FRONT["inboxes"]):
+        os.environ["WORKER_ID"] = str(i)   # read by the worker when it imports this module
+        procs.append(ctx.Process(target=worker_main, args=(inbox, outbox, base_url), name=f"quizbot-worker-{i}"))
+        procs[-1].start()
+    del os.environ["WORKER_ID"]
+    Thread(target=front_listen, args=(outbox,), daemon=True).start()
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+        async with Bot(TOKEN, **({"base_url": base_url} if base_url else {})) as bot:
+            if WEBHOOK_URL:
+                await register_webhook(bot)
+                await stop.wait()
+                return
+            task = asyncio.create_task(poll_updates(bot))
+            await stop.wait()
+            task.cancel()
+    asyncio.run(serve())
+    for inbox in FRONT["inboxes"]: inbox.put(None)
+    for p in procs:
+        p.join(30)
+        if p.is_alive(): p.terminate()
+
+# --- Worker ---
+def worker_main(inbox, outbox, base_url=None):
+    BUS["outbox"] = outbox
+    app = build_application(TOKEN, base_url)
+
+    async def attach(loop, stop):
+        def pump():
+            while True:
+                msg = inbox.get()
+                if msg is None: break
+                loop.call_soon_threadsafe(on_front_message, app, msg)
+            loop.call_soon_threadsafe(stop.set)
+        Thread(target=pump, daemon=True).start()
+
+    print(f"✅ Worker {WORKER_ID} is live")
+    serve_application(app, attach)
+
+def on_front_message(app, msg):
+    kind = msg[0]
+    if kind == "update":
+        try: app.update_queue.put_nowait(Update.de_json(msg[1], app.bot))
+        except Exception as e: logging.error(f"Update Parse Error: {e}")
+    elif kind == "stats":
+        count_answer(*msg[1:])
+        mark_dirty(("stats", msg[1]))
+    elif kind == "qstat": QSTATS.record(*msg[1:])
+    elif kind == "content": app.create_task(sync_content(*msg[1:]))
+
+def publish_content(changes):
+    # Worker 0, after a flush: tell the others what content it just committed
+    full = FULL_SYNC in changes
+    chapters = sorted({c[1:4] for c in changes if c[0] in ('chapter', 'question')})
+    settings = full or any(c[0] in ('admins', 'meta') for c in changes)
+    if not (full or chapters or settings): return
+    if settings: settings = {"admins": list(db["admins"]), "maintenance_mode": db.get("maintenance_mode", False)}
+    send_to_front(("content", chapters, settings, full))
+
+async def sync_content(chapters, settings, full):
+    async with DB_LOCK:
+        if full: await reload_from_store()   # restore on worker 0
+        elif chapters:
+            fresh = await asyncio.to_thread(get_store().load_chapters, chapters)
+            for (cat, sub, chap), qs in fresh.items():
+                chaps = db["questions"].setdefault(cat, {}).setdefault(sub, {})
+                if qs is None: chaps.pop(chap, None)
+                else: chaps[chap] = qs
+            for cat, sub in {key[:2] for key in fresh}: QINDEX.rebuild_subject(db, cat, sub)
+        if settings:
+            moved = set(db["admins"]) ^ set(settings["admins"])
+            db["admins"], db["maintenance_mode"] = settings["admins"], settings["maintenance_mode"]
+            await adopt_users([u for u in moved if partition(u) == WORKER_ID])
+
+async def reload_from_store():
+    # Keep our pending rows, then take the store as the new truth for this worker's share
+    await flush_db()
+    install_db(normalize_db(await asyncio.to_thread(get_store().load, WORKER_ID)), persist=False)
+
+async def adopt_users(uids):
+    # Users whose updates just started coming here (admin added or removed): take over their rows
+    # as last committed by the worker that had them
+    if WORKERS < 2 or not uids: return
+    data = await asyncio.to_thread(get_store().load_users, uids)
+    for uid in map(str, uids):
+        db["stats"][uid] = data["stats"].get(uid, {})
+        db["user_data"][uid] = data["user_data"].get(uid, {})
+        db["reviews"][uid] = data["reviews"].get(uid, {})
+    SRS.reset()
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        # python bot.py migrate [database.json] -> re-import a JSON database into SQLite
+        migrate_json_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else DB_FILE)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'memreport':
+        # python bot.py memreport -> question bank footprint, records vs. plain dicts
+        r = question_memory_report(db)
+        print(f"{r['questions']} questions: dicts {format_size(r['dict_bytes'])} -> records {format_size(r['record_bytes'])} "
+              f"({r['saved_pct']:.1f}% smaller, poll text/options included); {r['truncated']} over Telegram limits")
+        sys.exit(0)
     keep_alive()
     if not TOKEN:
         print("❌ TOKEN MISSING")
     else:
-        req = HTTPXRequest(connect_timeout=180.0, read_timeout=180.0)
-        app = ApplicationBuilder().token(TOKEN).request(req).build()
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("done", done_command))       
-        app.add_handler(CommandHandler("removeadmin", remove_admin_command))
-        app.add_handler(CallbackQueryHandler(master_callback_router))
-        app.add_handler(MessageHandler(filters.POLL & filters.User(OWNER_ID), handle_poll_upload))
-        app.add_handler(MessageHandler(filters.Document.ALL, handle_file_upload))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-        app.add_handler(PollAnswerHandler(handle_poll_answer))
-        print("✅ Bot is Live!")
-        app.run_polling()
+        print("✅ Bot is Live!" + (" (webhook)" if WEBHOOK_URL else "") + (f" ({WORKERS} workers)" if WORKERS > 1 else ""))
+        if WORKERS > 1: run_workers()
+        else:
+            app = build_application(TOKEN)
+            if WEBHOOK_URL: run_webhook(app)
+            else: app.run_polling()
@@ -0,0 +1,2 @@
+# End-to-end load test: the real bot.py Application in a subprocess against a local fake Bot API.
+#   python -m loadtest --ramp 10,50,100 --quizzes 2 --questions 5 --out load.json
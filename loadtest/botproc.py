@@ -0,0 +1,15 @@
+import os
+import sys
+
+# The bot under test, started by loadtest.run with DB paths, PORT (for /metrics) and the fake API url in env
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+# Guarded: with WORKERS > 1 the worker processes re-import this module under spawn
+if __name__ == "__main__":
+    bot.keep_alive()
+    if bot.WORKERS > 1: bot.run_workers(base_url=os.environ["LOADTEST_BASE_URL"])
+    else:
+        app = bot.build_application(os.environ["TOKEN"], base_url=os.environ["LOADTEST_BASE_URL"])
+        app.run_polling(poll_interval=0)
+    os._exit(0)   # the keep-alive Flask thread is not a daemon
@@ -0,0 +1,142 @@
+import asyncio
+import itertools
+import json
+import time
+from urllib.parse import parse_qs
+
+# Minimal Bot API stand-in over raw asyncio HTTP/1.1 (keep-alive, form or multipart bodies).
+# Outgoing bot calls addressed to a chat are pushed to that chat's queue so virtual users can react.
+BOT_USER = {"id": 1000001, "is_bot": True, "first_name": "LoadBot", "username": "load_bot"}
+CHAT_METHODS = {"sendMessage", "editMessageText", "sendPoll", "stopPoll", "sendDocument"}
+
+def user_json(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"vu{uid}", "username": f"vu{uid}"}
+
+def chat_json(chat_id):
+    return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup", "first_name": f"vu{chat_id}"}
+
+class ChatEvent:
+    __slots__ = ("method", "params", "t")
+    def __init__(self, method, params, t):
+        self.method, self.params, self.t = method, params, t
+
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host, self.port = host, port
+        self.server = None
+        self.updates = []                 # pending update dicts
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.poll_ids = itertools.count(1)
+        self.new_updates = asyncio.Event()
+        self.chats = {}                   # chat_id -> asyncio.Queue of ChatEvent
+        self.calls = {}                   # method -> count
+        self.delivered = 0                # updates acknowledged by the bot
+        self.ready = asyncio.Event()      # set on the first getUpdates
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/bot"
+
+    def queue(self, chat_id):
+        q = self.chats.get(chat_id)
+        if q is None: q = self.chats[chat_id] = asyncio.Queue()
+        return q
+
+    # --- update injection ---
+    def push_update(self, **payload):
+        payload["update_id"] = next(self.update_ids)
+        self.updates.append(payload)
+        self.new_updates.set()
+
+    def push_message(self, uid, text):
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat_json(uid), "from": user_json(uid), "text": text}
+        if text.startswith("/"): msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.push_update(message=msg)
+
+    def push_callback(self, uid, data, message_id=1):
+        self.push_update(callback_query={"id": str(next(self.update_ids)), "from": user_json(uid), "chat_instance": str(uid), "data": data,
+                                         "message": {"message_id": message_id, "date": int(time.time()), "chat": chat_json(uid), "text": "menu"}})
+
+    def push_poll_answer(self, uid, poll_id, option):
+        self.push_update(poll_answer={"poll_id": poll_id, "user": user_json(uid), "option_ids": [option], "option_persistent_ids": [str(option)]})
+
+    # --- HTTP ---
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                _, path, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""): break
+                    k, v = h.decode("latin-1").split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                result = await self.call(path.rsplit("/", 1)[-1], self._params(body, headers.get("content-type", "")))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(payload) + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError): pass
+        finally: writer.close()
+
+    @staticmethod
+    def _params(body, content_type):
+        if not body or not content_type.startswith("application/x-www-form-urlencoded"): return {}
+        params = {}
+        for k, v in parse_qs(body.decode(), keep_blank_values=True).items():
+            try: params[k] = json.loads(v[0])
+            except ValueError: params[k] = v[0]
+        return params
+
+    def _message(self, chat_id, **extra):
+        return dict({"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat_json(chat_id), "from": BOT_USER}, **extra)
+
+    async def call(self, method, p):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates": return await self._get_updates(p)
+        chat_id = p.get("chat_id")
+        if method in CHAT_METHODS and isinstance(chat_id, int): self.queue(chat_id).put_nowait(ChatEvent(method, p, time.monotonic()))
+        if method == "getMe": return BOT_USER
+        if method == "sendPoll":
+            options = [{"text": o if isinstance(o, str) else o.get("text", ""), "voter_count": 0, "persistent_id": str(i)}
+                       for i, o in enumerate(p.get("options", []))]
+            poll = {"id": str(next(self.poll_ids)), "question": p.get("question", ""), "options": options, "total_voter_count": 0,
+                    "is_closed": False, "is_anonymous": False, "type": "quiz", "allows_multiple_answers": False,
+                    "allows_revoting": False, "members_only": False, "correct_option_id": p.get("correct_option_id", 0), "open_period": p.get("open_period")}
+            p["poll_id"] = poll["id"]
+            return self._message(chat_id, poll=poll)
+        if method == "stopPoll":
+            return {"id": "0", "question": "-", "options": [], "total_voter_count": 0, "is_closed": True, "is_anonymous": False,
+                    "type": "quiz", "allows_multiple_answers": False, "allows_revoting": False, "members_only": False}
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(chat_id if isinstance(chat_id, int) else 0, text=p.get("text", ""))
+        if method == "sendDocument": return self._message(chat_id if isinstance(chat_id, int) else 0)
+        if method == "getChatMember": return {"status": "member", "user": user_json(p.get("user_id", 0))}
+        if method == "getChat": return chat_json(chat_id if isinstance(chat_id, int) else 0)
+        return True   # answerCallbackQuery, deleteWebhook, setMyCommands, ...
+
+    async def _get_updates(self, p):
+        self.ready.set()
+        offset = p.get("offset") or 0
+        if offset:
+            # Updates count as delivered once the bot acknowledges them with a higher offset
+            before = len(self.updates)
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            self.delivered += before - len(self.updates)
+        if not self.updates:
+            self.new_updates.clear()
+            try: await asyncio.wait_for(self.new_updates.wait(), timeout=min(float(p.get("timeout") or 0), 10))
+            except asyncio.TimeoutError: pass
+        return self.updates[:int(p.get("limit") or 100)]
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+
+from benchmarks.generate import add_arguments, generate_db, params_from, write_db
+from loadtest.fake_api import FakeBotAPI
+
+# Virtual users walk the real menus (/start -> BSEB -> subject -> book -> chapter -> time -> count), then
+# answer each quiz poll after a random think time. Stages ramp the number of concurrent users.
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MENU_PATH = [r"^gate_bseb$", r"^ask_src_BSEB_{sub}$", r"^src_book_BSEB_{sub}$", r"^mode_single$", r"^sng_"]
+MENU_REPLIES = {"sendMessage", "editMessageText"}
+
+class Stuck(Exception):
+    pass
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+class Stage:
+    def __init__(self, users):
+        self.users = users
+        self.menu = []        # seconds from update injection to the bot's reply
+        self.gaps = []        # seconds from a poll answer to the next poll
+        self.polls = self.answered = self.completed = self.errors = 0
+
+class VirtualUser:
+    def __init__(self, api, uid, args, stage, rng):
+        self.api, self.uid, self.args, self.stage, self.rng = api, uid, args, stage, rng
+        self.queue = api.queue(uid)
+
+    async def expect(self, methods, since, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0: raise Stuck(f"no {'/'.join(sorted(methods))} within {timeout}s")
+            try: ev = await asyncio.wait_for(self.queue.get(), left)
+            except asyncio.TimeoutError: continue
+            if ev.t >= since and ev.method in methods: return ev
+
+    async def menu_step(self, push):
+        t0 = time.monotonic()
+        push()
+        ev = await self.expect(MENU_REPLIES, t0, self.args.reply_timeout)
+        self.stage.menu.append(ev.t - t0)
+        return ev
+
+    def pick(self, ev, path):
+        buttons = [b.get("callback_data") for row in (ev.params.get("reply_markup") or {}).get("inline_keyboard", []) for b in row]
+        for data in buttons:
+            if data and re.match(path[0], data):
+                path.pop(0); return data
+        if buttons == ["main_menu"]: return "main_menu"   # one-time intro
+        raise Stuck(f"no button for {path[0]} in {buttons}")
+
+    async def quiz(self):
+        api, args = self.api, self.args
+        ev = await self.menu_step(lambda: api.push_message(self.uid, "/start"))
+        path = [p.format(sub=args.subject) for p in MENU_PATH]
+        while path:
+            data = self.pick(ev, path)
+            ev = await self.menu_step(lambda: api.push_callback(self.uid, data))
+        await self.menu_step(lambda: api.push_callback(self.uid, f"time_{args.open_period}"))
+        since = time.monotonic()
+        await self.menu_step(lambda: api.push_callback(self.uid, f"count_{args.questions}"))
+        answered_at = None
+        while True:
+            ev = await self.expect({"sendPoll", "sendMessage"}, since, args.open_period + args.reply_timeout)
+            since = ev.t
+            if ev.method == "sendMessage":
+                self.stage.completed += 1; return
+            self.stage.polls += 1
+            if answered_at is not None: self.stage.gaps.append(ev.t - answered_at)
+            answered_at = None
+            if self.rng.random() < args.skip_rate: continue
+            await asyncio.sleep(self.rng.uniform(*args.think))
+            api.push_poll_answer(self.uid, ev.params["poll_id"], self.rng.randrange(max(1, len(ev.params.get("options", [])))))
+            answered_at = time.monotonic()
+            self.stage.answered += 1
+
+    async def run(self, delay):
+        await asyncio.sleep(delay)
+        for _ in range(self.args.quizzes):
+            try: await self.quiz()
+            except Stuck as e:
+                self.stage.errors += 1
+                if self.args.verbose: print(f"  vu{self.uid}: {e}")
+                return
+
+def scrape_counter(port, name, labels):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as r: text = r.read().decode()
+    except OSError: return None
+    m = re.search(rf'^{name}\{{{re.escape(labels)}\}} ([0-9.e+]+)$', text, re.M)
+    return float(m.group(1)) if m else 0.0
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+async def run_stage(api, args, users, uids, metrics_port):
+    stage = Stage(users)
+    rng = random.Random(args.seed + users)
+    # Worker mode: quizzes run in the workers, which serve no /metrics, so the front's counter would read 0
+    scrape = (lambda: None) if args.workers > 1 else (lambda: scrape_counter(metrics_port, "quizbot_quiz_events_total", 'event="timeouts"'))
+    timeouts0 = await asyncio.to_thread(scrape)
+    delivered0, calls0 = api.delivered, sum(api.calls.values())
+    t0 = time.monotonic()
+    vus = [VirtualUser(api, uid, args, stage, random.Random(rng.random())) for uid in uids[:users]]
+    await asyncio.gather(*(vu.run(rng.uniform(0, args.spawn_window)) for vu in vus))
+    elapsed = time.monotonic() - t0
+    timeouts1 = await asyncio.to_thread(scrape)
+    ms = lambda v: round(v * 1000, 1) if v is not None else None
+    return {"users": users, "elapsed_s": round(elapsed, 2),
+            "updates_per_s": round((api.delivered - delivered0) / elapsed, 1),
+            "api_calls_per_s": round((sum(api.calls.values()) - calls0) / elapsed, 1),
+            "menu_p50_ms": ms(percentile(stage.menu, 50)), "menu_p99_ms": ms(percentile(stage.menu, 99)),
+            "gap_p50_ms": ms(percentile(stage.gaps, 50)), "gap_p99_ms": ms(percentile(stage.gaps, 99)),
+            "gap_mean_ms": ms(statistics.fmean(stage.gaps)) if stage.gaps else None,
+            "polls": stage.polls, "answered": stage.answered,
+            "timed_out_polls": int(timeouts1 - timeouts0) if timeouts0 is not None and timeouts1 is not None else None,
+            "quizzes_completed": stage.completed, "stuck_users": stage.errors}
+
+async def amain(args):
+    ramp = [int(n) for n in args.ramp.split(",")]
+    params = params_from(args)
+    params["users"] = max(params["users"], max(ramp))
+    with tempfile.TemporaryDirectory(prefix="quizload-") as workdir:
+        json_path = os.path.join(workdir, "database.json")
+        write_db(json_path, generate_db(**params))
+        api = await FakeBotAPI().start()
+        metrics_port = free_port()
+        env = dict(os.environ, TOKEN="123456:LOADTEST", LOADTEST_BASE_URL=api.base_url, PORT=str(metrics_port),
+                   DB_FILE=json_path, SQLITE_FILE=os.path.join(workdir, "load.sqlite3"), BACKUP_DIR=os.path.join(workdir, "backups"),
+                   OWNER_ID="1", WORKERS=str(args.workers))
+        out = None if args.verbose else asyncio.subprocess.DEVNULL
+        proc = await asyncio.create_subprocess_exec(sys.executable, "-m", "loadtest.botproc", cwd=REPO, env=env, stdout=out, stderr=out)
+        try:
+            await asyncio.wait_for(api.ready.wait(), args.startup_timeout)
+            print(f"Bot up on fake API {api.base_url} (metrics :{metrics_port}); generated users: {params['users']}")
+            # Virtual users are existing users of the generated database, in a fixed order
+            uids = [10_000_000 + i * 7 for i in range(params["users"])]
+            stages = []
+            print(f"{'users':>6}{'upd/s':>8}{'menu p50':>10}{'p99':>8}{'gap p50':>9}{'p99':>8}{'polls':>7}{'t/out':>6}{'stuck':>6}")
+            for users in ramp:
+                r = await run_stage(api, args, users, uids, metrics_port)
+                stages.append(r)
+                print(f"{users:>6}{r['updates_per_s']:>8}{r['menu_p50_ms'] or 0:>10.0f}{r['menu_p99_ms'] or 0:>8.0f}"
+                      f"{r['gap_p50_ms'] or 0:>9.0f}{r['gap_p99_ms'] or 0:>8.0f}{r['polls']:>7}{'-' if r['timed_out_polls'] is None else r['timed_out_polls']:>6}{r['stuck_users']:>6}")
+        finally:
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGINT)
+                try: await asyncio.wait_for(proc.wait(), 30)
+                except asyncio.TimeoutError: proc.kill()
+            await api.stop()
+    report = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "params": params, "quizzes": args.quizzes,
+                       "questions": args.questions, "workers": args.workers, "open_period": args.open_period, "think": args.think,
+                       "skip_rate": args.skip_rate, "api_calls": api.calls},
+              "stages": stages}
+    with open(args.out, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+    print(f"✅ Results -> {args.out}")
+
+def main():
+    p = argparse.ArgumentParser(description="Load-test bot.py against a local fake Bot API")
+    add_arguments(p)
+    p.set_defaults(questions_per_chapter=50, users=200, mistakes_per_user=5)
+    p.add_argument("--ramp", default="5,20,50", help="comma-separated concurrent user counts, one stage each")
+    p.add_argument("--quizzes", type=int, default=1, help="quizzes per virtual user per stage")
+    p.add_argument("--questions", type=int, default=5)
+    p.add_argument("--open-period", type=int, default=15)
+    p.add_argument("--think", type=lambda s: tuple(map(float, s.split(","))), default=(0.5, 2.0), help="min,max seconds")
+    p.add_argument("--skip-rate", type=float, default=0.0, help="share of polls left unanswered")
+    p.add_argument("--subject", default="Physics")
+    p.add_argument("--spawn-window", type=float, default=2.0, help="seconds over which a stage's users start")
+    p.add_argument("--reply-timeout", type=float, default=20.0)
+    p.add_argument("--workers", type=int, default=1, help="bot processes (WORKERS); >1 runs the front + worker mode")
+    p.add_argument("--startup-timeout", type=float, default=120.0)
+    p.add_argument("--out", default="load.json")
+    p.add_argument("-v", "--verbose", action="store_true")
+    asyncio.run(amain(p.parse_args()))
+
+if __name__ == "__main__":
+    main()